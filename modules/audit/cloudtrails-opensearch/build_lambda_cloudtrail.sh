@@ -61,9 +61,16 @@ echo -e "${YELLOW}Using Python version: $PYTHON_VERSION${NC}"
 echo "Upgrading pip..."
 pip install --upgrade pip || error_exit "Failed to upgrade pip"
 
-# Install dependencies
+# Install dependencies as Lambda x86_64 / python3.12 wheels, so compiled packages (orjson)
+# match the runtime rather than the build host
 echo "Installing dependencies..."
-pip install -r requirements.txt --target build/layer/python || error_exit "Failed to install dependencies"
+pip install -r requirements.txt --target build/layer/python \
+    --platform manylinux2014_x86_64 --implementation cp --python-version 3.12 --only-binary=:all: \
+    || error_exit "Failed to install dependencies"
+
+# boto3 and botocore come with the python3.12 runtime; drop the botocore pip installs for
+# aws-xray-sdk so the layer does not shadow it (RUNTIME_PROVIDED in src/layer_manifest.py)
+rm -rf build/layer/python/botocore build/layer/python/botocore-*.dist-info
 
 # Create Lambda function package
 echo "Creating Lambda function package..."
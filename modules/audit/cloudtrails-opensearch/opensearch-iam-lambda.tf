@@ -54,7 +54,8 @@ resource "aws_iam_role_policy" "lambda_transform" {
           "kinesis:DescribeStream",
           "kinesis:ListShards",
           "kinesis:DescribeStreamSummary",
-          "kinesis:ListStreamConsumers"
+          "kinesis:ListStreamConsumers",
+          "kinesis:PutRecords"
         ]
         Resource = "${aws_kinesis_stream.cloudtrail.arn}"
       },
@@ -81,6 +82,14 @@ resource "aws_iam_role_policy" "lambda_transform" {
         ]
         Resource = [aws_kms_key.cloudtrail.arn]
       },
+      {
+        # Spill prefix for documents that could not be indexed
+        Effect = "Allow"
+        Action = [
+          "s3:PutObject"
+        ]
+        Resource = "${aws_s3_bucket.cloudtrail.arn}/spill/*"
+      },
       {
         Effect = "Allow"
         Action = [
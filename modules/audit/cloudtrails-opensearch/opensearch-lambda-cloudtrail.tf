@@ -38,11 +38,17 @@ resource "null_resource" "build_layer" {
       # Upgrade pip and install wheel for better compatibility
       pip install --upgrade pip setuptools wheel
 
-      # Install dependencies with all subdependencies
-      pip install -r requirements.txt --target build/layer/python --no-cache-dir --force-reinstall
+      # Install dependencies with all subdependencies, as Lambda x86_64 / python3.12 wheels so that
+      # compiled packages (orjson) match the runtime rather than the build host
+      PLATFORM_FLAGS="--platform manylinux2014_x86_64 --implementation cp --python-version 3.12 --only-binary=:all:"
+      pip install -r requirements.txt --target build/layer/python --no-cache-dir --force-reinstall $PLATFORM_FLAGS
 
       # FIXED: Explicitly install missing dependencies that might not be auto-resolved
-      pip install idna>=3.4 charset-normalizer>=3.3.0 certifi>=2023.0.0 urllib3>=1.26.0 --target build/layer/python --no-cache-dir --force-reinstall
+      pip install idna>=3.4 charset-normalizer>=3.3.0 certifi>=2023.0.0 urllib3>=1.26.0 --target build/layer/python --no-cache-dir --force-reinstall $PLATFORM_FLAGS
+
+      # boto3 and botocore come with the python3.12 runtime; drop the botocore pip installs for
+      # aws-xray-sdk so the layer does not shadow it (RUNTIME_PROVIDED in src/layer_manifest.py)
+      rm -rf build/layer/python/botocore build/layer/python/botocore-*.dist-info
 
       # Clean up unnecessary files to reduce layer size
       find build/layer/python -type d -name "__pycache__" -exec rm -rf {} + 2>/dev/null || true
@@ -152,12 +158,28 @@ resource "aws_lambda_function" "cloudtrail_processor" {
       LOG_LEVEL                  = upper(var.environment[local.env])
       ERROR_SNS_TOPIC            = aws_sns_topic.cloudtrail_alerts.arn
       PYTHONWARNINGS             = "ignore:Unverified HTTPS request"
+      TRACE_GRANULARITY          = var.lambda_trace_granularity
 
       # Batching configuration variables
       OPENSEARCH_BATCH_SIZE          = var.opensearch_batch_size
       OPENSEARCH_MAX_REQUEST_SIZE_MB = var.opensearch_max_request_size_mb
+      OPENSEARCH_MAX_IN_FLIGHT       = var.opensearch_max_in_flight
+      OPENSEARCH_COMPRESSION         = var.opensearch_compression
+      OPENSEARCH_COMPRESSION_LEVEL   = var.opensearch_compression_level
+      PARSE_WORKERS                  = var.opensearch_parse_workers
+      OPENSEARCH_PREFETCH_BATCHES    = var.opensearch_prefetch_batches
+      OPENSEARCH_BREAKER_FAILURES    = var.opensearch_breaker_failures
+      OPENSEARCH_BREAKER_COOLDOWN    = var.opensearch_breaker_reset_seconds
+      OPENSEARCH_TARGET_LATENCY_MS   = var.opensearch_target_latency_ms
+      OPENSEARCH_ADAPTIVE_BATCHING   = var.opensearch_adaptive_batching
+      CORRELATE_INVOCATIONS          = var.opensearch_correlate_invocations
+      METRIC_ROLLUPS                 = var.opensearch_metric_rollups
       ENABLE_BATCH_SPLITTING         = "true"
 
+      # Documents OpenSearch permanently rejects are kept here for replay
+      SPILL_BUCKET = aws_s3_bucket.cloudtrail.id
+      SPILL_PREFIX = "spill/"
+
       # Add Python path to ensure all modules are found
       PYTHONPATH = "/opt/python:/var/runtime:/var/task"
     }
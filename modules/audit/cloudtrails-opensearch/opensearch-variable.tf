@@ -59,6 +59,102 @@ variable "opensearch_max_request_size_mb" {
   }
 }
 
+variable "opensearch_max_in_flight" {
+  description = "Maximum number of bulk requests a single Lambda invocation keeps in flight to OpenSearch"
+  type        = number
+  default     = 4
+
+  validation {
+    condition     = var.opensearch_max_in_flight > 0 && var.opensearch_max_in_flight <= 16
+    error_message = "Maximum in-flight bulk requests must be between 1 and 16."
+  }
+}
+
+variable "opensearch_compression" {
+  description = "Request body compression for OpenSearch bulk indexing (none or gzip)"
+  type        = string
+  default     = "none"
+
+  validation {
+    condition     = contains(["none", "gzip"], var.opensearch_compression)
+    error_message = "Compression must be either none or gzip."
+  }
+}
+
+variable "opensearch_compression_level" {
+  description = "Gzip compression level for OpenSearch bulk requests (1 = fastest, 9 = smallest)"
+  type        = number
+  default     = 3
+
+  validation {
+    condition     = var.opensearch_compression_level >= 1 && var.opensearch_compression_level <= 9
+    error_message = "Compression level must be between 1 and 9."
+  }
+}
+
+variable "opensearch_adaptive_batching" {
+  description = "Adapt the bulk request size to observed latency and throttling (AIMD between 1 MB and opensearch_max_request_size_mb)"
+  type        = bool
+  default     = true
+}
+
+variable "opensearch_target_latency_ms" {
+  description = "Bulk request latency the adaptive batch size aims to stay under, in milliseconds"
+  type        = number
+  default     = 1000
+
+  validation {
+    condition     = var.opensearch_target_latency_ms >= 100
+    error_message = "Target latency must be at least 100 ms."
+  }
+}
+
+variable "opensearch_breaker_failures" {
+  description = "Consecutive failed bulk batches that open the circuit breaker and spill batches to S3"
+  type        = number
+  default     = 3
+
+  validation {
+    condition     = var.opensearch_breaker_failures >= 1
+    error_message = "opensearch_breaker_failures must be at least 1."
+  }
+}
+
+variable "opensearch_breaker_reset_seconds" {
+  description = "Seconds the circuit breaker stays open before a cluster health probe lets bulk requests resume"
+  type        = number
+  default     = 60
+}
+
+variable "opensearch_prefetch_batches" {
+  description = "Bulk batches prepared ahead of dispatch on a producer thread (0 prepares them inline)"
+  type        = number
+  default     = 0
+
+  validation {
+    condition     = var.opensearch_prefetch_batches >= 0
+    error_message = "opensearch_prefetch_batches must not be negative."
+  }
+}
+
+variable "opensearch_parse_workers" {
+  description = "Experimental: worker processes parsing Kinesis records (auto = one per vCPU, below 2 parses in the handler process). Not benchmarked beyond one vCPU; keep at 1 unless src/test/bench_parse_workers.py shows a gain at the function's memory size"
+  type        = string
+  default     = "1"
+}
+
+variable "opensearch_metric_rollups" {
+  description = "Write per-log-group, per-minute Lambda REPORT metric rollups to the logs-cloudtrail-rollup-* indices (also matched by the logs-cloudtrail-* dashboard pattern and ISM policy)"
+  type        = bool
+  default     = false
+}
+
+variable "opensearch_correlate_invocations" {
+  description = "Merge START/END/REPORT/Event Received/Response Body lines of a Lambda request into one lambda_invocation document"
+  type        = bool
+  default     = false
+}
+
 # Environment-specific batch sizes
 variable "opensearch_batch_sizes_by_env" {
   description = "Environment-specific batch sizes for different workloads"
@@ -82,6 +178,17 @@ variable "lambda_timeout_seconds" {
   }
 }
 
+variable "lambda_trace_granularity" {
+  description = "X-Ray subsegment granularity for the log processor: off, invocation, batch or call (call applies to sampled invocations only)"
+  type        = string
+  default     = "batch"
+
+  validation {
+    condition     = contains(["off", "invocation", "batch", "call"], var.lambda_trace_granularity)
+    error_message = "Trace granularity must be one of off, invocation, batch or call."
+  }
+}
+
 variable "lambda_memory_size" {
   description = "Lambda function memory allocation in MB"
   type        = number
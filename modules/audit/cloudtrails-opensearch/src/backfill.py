@@ -0,0 +1,388 @@
+# backfill.py
+"""Replay S3 backups and spill objects from the CloudTrail bucket into OpenSearch
+
+Three kinds of objects are read for the hours in [--start, --end):
+
+  errors/<error-output-type>/year=/month=/day=/hour=/      Firehose records the transform Lambda failed on
+  cloudtrail-opensearch/year=/month=/day=/hour=/           Firehose documents OpenSearch rejected
+  spill/<reason>/year=/month=/day=/hour=/                  _bulk NDJSON spilled by the handler
+
+Firehose objects are gzip JSON lines whose `rawData` is either the original CloudWatch Logs
+payload, which goes back through CloudWatchLogProcessor, or an already transformed document;
+lines without `rawData` (an all-documents backup) are the transformed documents themselves.
+Spill objects are the exact _bulk request bodies and are sent as they are. Whatever a replay
+cannot index is spilled under replayed/, which is not one of the sources, so a document that
+OpenSearch keeps refusing is set aside once instead of coming back on every run. Objects are
+streamed and decompressed line by line and indexed by a pool of worker processes, each with
+its own OpenSearchManager. Documents keep their _id, so replaying an object twice overwrites
+rather than duplicates.
+
+Finished objects are recorded in a checkpoint file; rerunning the same command resumes where
+it stopped. While the run is in progress the daily indices of the range before today are
+switched to a bulk-load profile (no refresh, no replicas) and restored afterwards, also after
+a crash when the checkpoint still holds their original settings. Today's index is still being
+written and searched by the live pipeline and keeps its settings. Run from the module directory with
+credentials for the destination account:
+
+    python3 src/backfill.py --bucket <cloudtrail-bucket> --start 2025-01-01T00 --end 2025-01-15T00
+"""
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import boto3
+
+from opensearch_handler import (
+    CORRELATE_INVOCATIONS,
+    GZIP_MAGIC,
+    JSON_CODEC,
+    BulkBatch,
+    CloudWatchLogProcessor,
+    OpenSearchManager,
+    RetryBudget,
+    __standard_index__,
+    correlate_invocations,
+    decode_record_data,
+    get_opensearch_manager,
+    inflate_gzip,
+)
+
+SOURCES = {
+    'errors': 'errors/',
+    'opensearch-backup': 'cloudtrail-opensearch/',
+    'spill': 'spill/',
+}
+# Sources whose objects sit one level below the prefix (error output type, spill reason)
+NESTED_SOURCES = {'errors', 'spill'}
+
+# Spill prefix of documents a replay could not index; kept out of SOURCES on purpose
+REPLAYED_PREFIX = 'replayed/'
+
+BULK_LOAD_SETTINGS = {'refresh_interval': '-1', 'number_of_replicas': 0}
+
+
+def hours(start: datetime, end: datetime) -> Iterator[datetime]:
+    hour = start
+    while hour < end:
+        yield hour
+        hour += timedelta(hours=1)
+
+
+def partition(hour: datetime) -> str:
+    return f"year={hour:%Y}/month={hour:%m}/day={hour:%d}/hour={hour:%H}/"
+
+
+def list_objects(s3, bucket: str, sources: List[str], start: datetime, end: datetime
+                 ) -> List[Tuple[str, str, str]]:
+    """(source, key, etag) of every object in the hourly partitions of the range"""
+    paginator = s3.get_paginator('list_objects_v2')
+    objects = []
+    for source in sources:
+        prefixes = [SOURCES[source]]
+        if source in NESTED_SOURCES:
+            prefixes = [common['Prefix']
+                        for page in paginator.paginate(Bucket=bucket, Prefix=SOURCES[source], Delimiter='/')
+                        for common in page.get('CommonPrefixes', [])]
+        for prefix in prefixes:
+            for hour in hours(start, end):
+                for page in paginator.paginate(Bucket=bucket, Prefix=prefix + partition(hour)):
+                    objects.extend((source, entry['Key'], entry['ETag'].strip('"'))
+                                   for entry in page.get('Contents', []))
+    return objects
+
+
+def stream_lines(s3, bucket: str, key: str) -> Iterator[bytes]:
+    """Lines of a gzip object, decompressed as the body streams in"""
+    body = s3.get_object(Bucket=bucket, Key=key)['Body']
+    with gzip.GzipFile(fileobj=body, mode='rb') as lines:
+        for line in lines:
+            if line.strip():
+                yield line
+
+
+def json_objects(line: bytes) -> List:
+    """JSON values of a line, also when Firehose wrote several without a separator"""
+    try:
+        return [JSON_CODEC.loads(line)]
+    except ValueError:
+        pass
+    text = line.decode('utf-8')
+    decoder = json.JSONDecoder()
+    values, position = [], 0
+    while position < len(text):
+        value, position = decoder.raw_decode(text, position)
+        values.append(value)
+        while position < len(text) and text[position].isspace():
+            position += 1
+    return values
+
+
+def firehose_documents(line: bytes, processor: CloudWatchLogProcessor) -> List[Dict]:
+    """Documents of one line of a Firehose error or backup object"""
+    documents = []
+    for record in json_objects(line):
+        if not isinstance(record, dict):
+            raise ValueError(f"expected a JSON object, got {type(record).__name__}")
+        if 'rawData' not in record:
+            # All-documents backup: the line holds the transformed documents themselves
+            documents.append(record)
+            continue
+        raw = decode_record_data(record['rawData'])
+        if raw[:2] != GZIP_MAGIC:
+            # Output of the transform that OpenSearch refused; index it again as it is
+            documents.append(JSON_CODEC.loads(raw))
+            continue
+        payload = JSON_CODEC.loads(inflate_gzip(raw))
+        if payload.get('messageType') != 'DATA_MESSAGE':
+            continue
+        transformed = processor.process_payload(payload)
+        if CORRELATE_INVOCATIONS:
+            transformed, _ = correlate_invocations(transformed)
+        documents.extend(transformed)
+    return documents
+
+
+class Replayer:
+    """Index the objects handed to one worker process"""
+
+    def __init__(self, bucket: str, chunk_documents: int):
+        self.bucket = bucket
+        self.chunk_documents = chunk_documents
+        self.s3 = boto3.client('s3')
+        self.opensearch = get_opensearch_manager()
+        self.opensearch.spill_sink.prefix = REPLAYED_PREFIX
+
+    def replay(self, source: str, key: str) -> Dict:
+        stats = {'documents': 0, 'indexed': 0, 'spilled': 0, 'failed': 0, 'skipped_lines': 0}
+        started = time.perf_counter()
+        if source == 'spill':
+            self._replay_bulk_body(key, stats)
+        else:
+            self._replay_firehose(key, stats)
+        stats['seconds'] = round(time.perf_counter() - started, 2)
+        return stats
+
+    def _replay_firehose(self, key: str, stats: Dict) -> None:
+        processor = CloudWatchLogProcessor()
+        documents: List[Dict] = []
+        for line in stream_lines(self.s3, self.bucket, key):
+            try:
+                documents.extend(firehose_documents(line, processor))
+            except Exception as e:
+                print(f"{key}: skipping unreadable record: {str(e)}")
+                stats['skipped_lines'] += 1
+            if len(documents) >= self.chunk_documents:
+                self._index(documents, stats)
+                documents = []
+        self._index(documents, stats)
+
+    def _index(self, documents: List[Dict], stats: Dict) -> None:
+        if not documents:
+            return
+        stats['documents'] += len(documents)
+        result = self.opensearch.bulk_index(documents)
+        summary = result.get('batch_summary', {})
+        stats['indexed'] += summary.get('indexed_documents', 0)
+        stats['spilled'] += summary.get('spilled_documents', 0)
+        stats['failed'] += len(documents) - summary.get('indexed_documents', 0) - summary.get('spilled_documents', 0)
+
+    def _replay_bulk_body(self, key: str, stats: Dict) -> None:
+        """Send spilled action+source pairs back to _bulk in batches of the usual size"""
+        budget = RetryBudget(self.opensearch.retry_budget)
+        batch, batch_num = None, 0
+        lines = stream_lines(self.s3, self.bucket, key)
+        for action in lines:
+            item = action + next(lines)
+            if batch is None:
+                batch = BulkBatch(json.loads(action)['index']['_index'])
+            batch.append(item)
+            if (len(batch) >= self.opensearch.max_batch_size or
+                    batch.size >= self.opensearch.batch_controller.setpoint):
+                batch_num += 1
+                self._send(batch, batch_num, budget, stats)
+                batch = None
+        if batch is not None:
+            self._send(batch, batch_num + 1, budget, stats)
+
+    def _send(self, batch: BulkBatch, batch_num: int, budget: RetryBudget, stats: Dict) -> None:
+        stats['documents'] += len(batch)
+        result = self.opensearch._bulk_index_single_batch(batch, batch_num, budget)
+        failed = sum(1 for item in result.get('items', [])
+                     if item.get('index', {}).get('status', 200) >= 400)
+        stats['spilled'] += result.get('spilled_items', 0)
+        stats['failed'] += failed - result.get('spilled_items', 0)
+        stats['indexed'] += len(batch) - failed
+
+
+_replayer: Optional[Replayer] = None
+
+
+def _init_worker(bucket: str, chunk_documents: int) -> None:
+    global _replayer
+    _replayer = Replayer(bucket, chunk_documents)
+
+
+def _replay(source: str, key: str) -> Dict:
+    return _replayer.replay(source, key)
+
+
+class Checkpoint:
+    """Objects already replayed and the index settings to restore, kept in a local JSON file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.state = {'completed': {}, 'index_settings': {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state.update(json.load(f))
+
+    def done(self, key: str, etag: str) -> bool:
+        return self.state['completed'].get(key) == etag
+
+    def complete(self, key: str, etag: str) -> None:
+        self.state['completed'][key] = etag
+        self.save()
+
+    def save(self) -> None:
+        # Written aside and renamed so that an interrupted run never leaves half a file
+        temporary = f"{self.path}.tmp"
+        with open(temporary, 'w') as f:
+            json.dump(self.state, f, indent=1, sort_keys=True)
+        os.replace(temporary, self.path)
+
+
+def bulk_load_indices(start: datetime, end: datetime, now: datetime) -> List[str]:
+    """Daily indices the range writes to that are strictly older than the current day
+
+    The day before --start is included because events are routed by their own timestamp.
+    """
+    today = now.strftime('%Y.%m.%d')
+    days = {(start + timedelta(days=offset)).strftime('%Y.%m.%d')
+            for offset in range(-1, (end - start).days + 1)}
+    return [f"{__standard_index__}-{day}" for day in sorted(days) if day < today]
+
+
+class BulkLoadProfile:
+    """Switch daily indices to BULK_LOAD_SETTINGS for the duration of a run
+
+    Missing indices are created first so the index template applies, then their settings are
+    read, saved to the checkpoint and only then overridden. Settings already in the checkpoint
+    belong to a run that did not get to restore them and take precedence over the live ones.
+    Call restore() in a finally; it also undoes an apply() that stopped half way.
+    """
+
+    def __init__(self, opensearch: OpenSearchManager, indices: List[str], checkpoint: Checkpoint):
+        self.opensearch = opensearch
+        self.indices = indices
+        self.checkpoint = checkpoint
+
+    def apply(self) -> None:
+        saved = self.checkpoint.state['index_settings']
+        for index in self.indices:
+            if index not in saved:
+                if self.opensearch._make_request('HEAD', index, allow_not_found=True).status_code == 404:
+                    self.opensearch._make_request('PUT', index, '{}')
+                response = self.opensearch._make_request('GET', f"{index}/_settings")
+                settings = response.json().get(index, {}).get('settings', {}).get('index', {})
+                saved[index] = {name: settings.get(name) for name in BULK_LOAD_SETTINGS}
+                self.checkpoint.save()
+            self.opensearch._make_request('PUT', f"{index}/_settings",
+                                          json.dumps({'index': BULK_LOAD_SETTINGS}))
+        print(f"Bulk-load profile applied to {len(self.indices)} indices: {BULK_LOAD_SETTINGS}")
+
+    def restore(self) -> None:
+        saved = self.checkpoint.state['index_settings']
+        for index, settings in list(saved.items()):
+            try:
+                self.opensearch._make_request('PUT', f"{index}/_settings", json.dumps({'index': settings}))
+                del saved[index]
+            except Exception as e:
+                print(f"Could not restore settings of {index}, rerun to retry: {str(e)}")
+        self.checkpoint.save()
+        print(f"Index settings restored, {len(saved)} left to restore")
+
+
+def parse_hour(value: str) -> datetime:
+    return datetime.strptime(value, '%Y-%m-%dT%H').replace(tzinfo=timezone.utc)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay CloudTrail bucket backups and spills into OpenSearch')
+    parser.add_argument('--bucket', required=True, help='CloudTrail bucket holding the Firehose and spill objects')
+    parser.add_argument('--start', required=True, type=parse_hour, help='First hour to replay, UTC (YYYY-MM-DDTHH)')
+    parser.add_argument('--end', required=True, type=parse_hour, help='Hour to stop before, UTC (YYYY-MM-DDTHH)')
+    parser.add_argument('--source', nargs='+', choices=sorted(SOURCES), default=sorted(SOURCES),
+                        help='Object kinds to replay')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Objects replayed in parallel')
+    parser.add_argument('--threads', action='store_true',
+                        help='Use threads instead of processes (fewer connections, less transform throughput)')
+    parser.add_argument('--chunk-documents', type=int, default=20000,
+                        help='Documents decoded before they are handed to bulk_index')
+    parser.add_argument('--checkpoint', default='backfill-checkpoint.json', help='Progress file used to resume')
+    parser.add_argument('--no-bulk-profile', action='store_true', help='Leave index settings untouched')
+    parser.add_argument('--dry-run', action='store_true', help='List the objects that would be replayed')
+    args = parser.parse_args()
+
+    # The replay runs outside Lambda; spill breaker batches back to the same bucket
+    os.environ.setdefault('SPILL_BUCKET', args.bucket)
+
+    checkpoint = Checkpoint(args.checkpoint)
+    objects = list_objects(boto3.client('s3'), args.bucket, args.source, args.start, args.end)
+    pending = [(source, key, etag) for source, key, etag in objects if not checkpoint.done(key, etag)]
+    print(f"{len(objects)} objects in range, {len(objects) - len(pending)} already replayed, {len(pending)} to go")
+    if args.dry_run:
+        for source, key, _ in pending:
+            print(f"  {source:17s} {key}")
+        return
+    if not pending and not checkpoint.state['index_settings']:
+        return
+
+    indices = [] if args.no_bulk_profile else bulk_load_indices(args.start, args.end, datetime.now(timezone.utc))
+
+    if args.threads:
+        _init_worker(args.bucket, args.chunk_documents)
+        pool = ThreadPoolExecutor(max_workers=args.workers)
+    else:
+        # Spawned rather than forked: the parent already holds a session and executor threads
+        pool = ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_worker, initargs=(args.bucket, args.chunk_documents))
+
+    totals = {'objects': 0, 'documents': 0, 'indexed': 0, 'spilled': 0, 'failed': 0, 'skipped_lines': 0}
+    started = time.perf_counter()
+    profile = BulkLoadProfile(get_opensearch_manager(), indices, checkpoint)
+    try:
+        profile.apply()
+        with pool:
+            futures = {pool.submit(_replay, source, key): (key, etag) for source, key, etag in pending}
+            for future in as_completed(futures):
+                key, etag = futures[future]
+                try:
+                    stats = future.result()
+                except Exception as e:
+                    print(f"{key}: failed, will be retried on the next run: {str(e)}")
+                    continue
+                for name in totals:
+                    totals[name] += stats.get(name, 0)
+                totals['objects'] += 1
+                if stats['failed'] == 0:
+                    checkpoint.complete(key, etag)
+                elapsed = time.perf_counter() - started
+                print(f"[{totals['objects']}/{len(pending)}] {key}: {stats} "
+                      f"({totals['documents'] / elapsed:,.0f} docs/sec overall)")
+    finally:
+        profile.restore()
+
+    print(f"Replay finished in {time.perf_counter() - started:.0f}s: {totals}")
+    if totals['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
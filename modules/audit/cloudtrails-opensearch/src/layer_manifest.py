@@ -0,0 +1,131 @@
+# layer_manifest.py
+"""Generate the Lambda layer requirements from the import graph of opensearch_handler.py
+
+Every import in the handler is collected, including the ones inside functions (the lazily
+loaded SDKs) and optional ones (orjson). Typing-only imports under `if TYPE_CHECKING:`,
+standard library modules and the SDKs the Lambda runtime ships (RUNTIME_PROVIDED) are
+skipped. The remaining top-level modules are mapped to the distributions that provide them in
+the current environment, and those distributions make up requirements.txt, which
+build_lambda_cloudtrail.sh and the build_layer resource install into the layer. pip resolves
+their own dependencies, so only packages the handler imports are listed. Version specifiers
+and comments already in requirements.txt are kept; a newly imported distribution is added at
+the installed version. Run from the module directory in an
+environment with the layer dependencies installed:
+
+    python3 src/layer_manifest.py            # print the manifest
+    python3 src/layer_manifest.py --write    # rewrite requirements.txt
+    python3 src/layer_manifest.py --check    # exit 1 when requirements.txt is out of date
+"""
+import argparse
+import ast
+import os
+import re
+import sys
+from importlib import metadata
+from typing import Dict, List, Set
+
+MODULE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HANDLER = os.path.join(MODULE_DIR, 'src', 'opensearch_handler.py')
+REQUIREMENTS = os.path.join(MODULE_DIR, 'requirements.txt')
+
+HEADER = [
+    "# Lambda layer dependencies: the distributions opensearch_handler.py imports.",
+    "# Generated by src/layer_manifest.py; rerun it with --write after changing imports.",
+]
+# Shipped with the python3.12 Lambda runtime. A layer copy would shadow the runtime's SDK, so
+# they are not listed, and the layer builds delete the botocore pip installs for aws-xray-sdk
+RUNTIME_PROVIDED = {'boto3', 'botocore'}
+_REQUIREMENT_NAME_RE = re.compile(r'^\s*([A-Za-z0-9][A-Za-z0-9._-]*)')
+
+
+def canonical_name(name: str) -> str:
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def _is_type_checking_block(node: ast.AST) -> bool:
+    test = getattr(node, 'test', None)
+    return isinstance(node, ast.If) and (
+        (isinstance(test, ast.Name) and test.id == 'TYPE_CHECKING')
+        or (isinstance(test, ast.Attribute) and test.attr == 'TYPE_CHECKING'))
+
+
+def imported_modules(path: str) -> Set[str]:
+    """Top-level names of every module imported at runtime, at any depth of the file"""
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+
+    modules = set()
+    pending = [tree]
+    while pending:
+        node = pending.pop()
+        if _is_type_checking_block(node):
+            pending.extend(node.orelse)
+            continue
+        if isinstance(node, ast.Import):
+            modules.update(alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            modules.add(node.module.split('.')[0])
+        pending.extend(ast.iter_child_nodes(node))
+    return modules
+
+
+def third_party_distributions(modules: Set[str]) -> Dict[str, str]:
+    """Installed distribution name and version for each non-stdlib module"""
+    providers = metadata.packages_distributions()
+    distributions, missing = {}, []
+    for module in sorted(modules - set(sys.stdlib_module_names) - {'__future__'} - RUNTIME_PROVIDED):
+        names = providers.get(module)
+        if not names:
+            missing.append(module)
+            continue
+        for name in names:
+            distributions[canonical_name(name)] = metadata.version(name)
+    if missing:
+        raise SystemExit(f"Not installed, cannot map to a distribution: {', '.join(missing)}")
+    return distributions
+
+
+def existing_requirements(path: str) -> Dict[str, str]:
+    """Requirement lines of requirements.txt by canonical distribution name"""
+    lines = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                match = _REQUIREMENT_NAME_RE.match(line)
+                if match and not line.lstrip().startswith('#'):
+                    lines[canonical_name(match.group(1))] = line.rstrip()
+    return lines
+
+
+def build_manifest(handler: str = HANDLER, requirements: str = REQUIREMENTS) -> List[str]:
+    distributions = third_party_distributions(imported_modules(handler))
+    current = existing_requirements(requirements)
+    kept = [line for name, line in current.items() if name in distributions]
+    added = [f"{name}>={version}" for name, version in sorted(distributions.items()) if name not in current]
+    return HEADER + kept + added
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate the layer requirements from the handler imports')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--write', action='store_true', help='Rewrite requirements.txt')
+    mode.add_argument('--check', action='store_true', help='Fail when requirements.txt is out of date')
+    args = parser.parse_args()
+
+    manifest = '\n'.join(build_manifest()) + '\n'
+    if args.check:
+        with open(REQUIREMENTS) as f:
+            if f.read() != manifest:
+                print("requirements.txt does not match the handler imports; run src/layer_manifest.py --write")
+                sys.exit(1)
+        return
+    if args.write:
+        with open(REQUIREMENTS, 'w') as f:
+            f.write(manifest)
+        print(f"Wrote {REQUIREMENTS}")
+        return
+    print(manifest, end='')
+
+
+if __name__ == '__main__':
+    main()
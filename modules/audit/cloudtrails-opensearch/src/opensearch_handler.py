@@ -1,24 +1,590 @@
 import os
 import json
 import base64
+import binascii
+import contextlib
+import functools
 import gzip
-from datetime import datetime
-import boto3
+import hashlib
+import math
+import random
+import re
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+import botocore.session
 import requests
 from requests_aws4auth import AWS4Auth
-from typing import List, Dict, Optional, Any, Iterator
-from io import BytesIO
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+from typing import List, Dict, Optional, Any, Iterable, Iterator, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor, Future, wait, as_completed, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception
 from aws_xray_sdk.core import xray_recorder
-from aws_xray_sdk.core import patch_all
+
+# boto3 (with s3transfer) and multiprocessing are imported where first used: only spilling to
+# S3, Firehose re-ingest and parse workers need them, and every invocation loads the modules
+# above anyway. queue and uuid are imported where used too, although botocore and requests
+# load them regardless. src/test/test_import_time.py enforces this.
 
 __version__ = "1.4.35"
 __standard_index__ = "logs-cloudtrail"
+__index_template__ = "cw_template"
+__rollup_index__ = "logs-cloudtrail-rollup"
+__rollup_index_template__ = "cw_rollup_template"
+
+# Refresh temporary credentials this many seconds before they expire
+CREDENTIAL_REFRESH_MARGIN_SECONDS = int(os.environ.get('OPENSEARCH_CREDENTIAL_REFRESH_MARGIN_SECONDS', '300'))
+
+# Bulk item statuses caused by cluster pressure; worth re-submitting
+RETRIABLE_ITEM_STATUSES = {429, 502, 503, 504}
+
+# Firehose rejects transformation responses over 6 MB; keep headroom for the envelope
+FIREHOSE_RESPONSE_LIMIT_BYTES = int(os.environ.get('FIREHOSE_RESPONSE_LIMIT_BYTES', str(6 * 1000 * 1000 - 256 * 1024)))
+FIREHOSE_REINGEST_BATCH_RECORDS = 500
+FIREHOSE_REINGEST_BATCH_BYTES = 4 * 1024 * 1024
+FIREHOSE_REINGEST_ATTEMPTS = 3
+# Re-ingest pacing and cap: the source stream takes 1000 records/s per shard for all writers
+FIREHOSE_REINGEST_RECORDS_PER_SECOND = float(os.environ.get('FIREHOSE_REINGEST_RECORDS_PER_SECOND', '500'))
+FIREHOSE_REINGEST_MAX_DOCUMENTS = int(os.environ.get('FIREHOSE_REINGEST_MAX_DOCUMENTS', '10000'))
+
+# Mapping-explosion guard: subtrees over budget are moved under a flat_object field
+FLATTENED_FIELD = 'flattened'
+MAX_MERGED_JSON_KEYS = int(os.environ.get('MAX_MERGED_JSON_KEYS', '100'))
+FIELD_BUDGET_SUBTREE_PATHS = int(os.environ.get('FIELD_BUDGET_SUBTREE_PATHS', '250'))
+FIELD_BUDGET_INDEX_PATHS = int(os.environ.get('FIELD_BUDGET_INDEX_PATHS', '900'))
+FIELD_BUDGET_TRACKED_INDICES = 8
+
+# Per-log-group, per-minute REPORT metric rollups written to the rollup index. Off by default:
+# logs-cloudtrail-rollup-* also falls under the logs-cloudtrail-* dashboard pattern and ISM policy
+METRIC_ROLLUPS = os.environ.get('METRIC_ROLLUPS', 'false').lower() == 'true'
+ROLLUP_SKETCH_ACCURACY = 0.01
+_ROLLUP_METRICS = ('duration_ms', 'billed_duration_ms', 'memory_used_mb', 'init_duration_ms')
+_ROLLUP_EVENT_TYPES = ('lambda_report', 'lambda_invocation')
+
+# Opt-in: merge the lifecycle lines of each Lambda request into one lambda_invocation document
+CORRELATE_INVOCATIONS = os.environ.get('CORRELATE_INVOCATIONS', 'false').lower() == 'true'
+_CORRELATED_EVENT_TYPES = ('lambda_start', 'event_received', 'response_body', 'lambda_end', 'lambda_report')
+
+# Kinesis records parsed on worker processes: `auto` runs one per vCPU, below 2 (the default)
+# parses in-process
+PARSE_WORKERS = os.environ.get('PARSE_WORKERS', '1').lower()
+PARSE_CHUNKS_PER_WORKER = 4
+
+# Request id in the prefix Lambda runtimes put on application lines:
+# "[INFO]\t<time>\t<request id>\t..." (Python) or "<time>\t<request id>\tINFO\t..." (Node.js)
+_LOG_LINE_REQUEST_ID_RE = re.compile(
+    r'(?:\[[A-Z]+\]\t)?[^\t]*\t([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})\t')
+
+# Lambda platform lines start with their marker; dispatched on the first character, then
+# confirmed with startswith, so application lines cost one dict lookup before the body markers
+_PLATFORM_LINES = {
+    'S': ('START RequestId:', 'lambda_start'),
+    'E': ('END RequestId:', 'lambda_end'),
+    'R': ('REPORT RequestId:', 'lambda_report')
+}
+
+# Standard REPORT line layout, matched in one pass; anything else falls back to per-field scanning
+_REPORT_RE = re.compile(
+    r'REPORT RequestId: (\S+)\tDuration: ([0-9.]+) ms\tBilled Duration: ([0-9.]+) ms\t'
+    r'Memory Size: ([0-9.]+) MB\tMax Memory Used: ([0-9.]+) MB(?:\tInit Duration: ([0-9.]+) ms)?')
+_REPORT_METRIC_RE = re.compile(
+    r'\t(Duration|Billed Duration|Memory Size|Max Memory Used|Init Duration): ([0-9.]+) (?:ms|MB)')
+_REPORT_METRIC_FIELDS = {
+    'Duration': 'duration_ms',
+    'Billed Duration': 'billed_duration_ms',
+    'Memory Size': 'memory_size_mb',
+    'Max Memory Used': 'memory_used_mb',
+    'Init Duration': 'init_duration_ms'
+}
+
+class JsonCodec:
+    """JSON decode/encode for the hot paths: orjson when the layer ships it, stdlib otherwise
+
+    Both backends emit compact UTF-8 documents that OpenSearch indexes identically. Values
+    orjson refuses to encode (integers wider than 64 bits, lone surrogates) go through the
+    stdlib encoder instead. Input orjson refuses to decode (NaN and Infinity, lone
+    surrogates) is decoded by the stdlib. One difference remains on decode: orjson reads
+    integers outside the 64-bit range as floats where the stdlib keeps them exact; set
+    JSON_CODEC=json where such values must be indexed exactly.
+    """
+
+    def __init__(self, backend: str = 'auto'):
+        orjson = None
+        if backend in ('auto', 'orjson'):
+            try:
+                import orjson
+            except ImportError:
+                if backend == 'orjson':
+                    print("JSON_CODEC=orjson but orjson is not installed; using stdlib json")
+        self._orjson = orjson
+        self.name = 'orjson' if orjson is not None else 'json'
+        self.loads = self._orjson_loads if orjson is not None else json.loads
+
+    def _orjson_loads(self, data: Union[str, bytes]) -> Any:
+        """orjson.loads, retried with the stdlib for the input orjson rejects"""
+        try:
+            return self._orjson.loads(data)
+        except self._orjson.JSONDecodeError:
+            # Also a json.JSONDecodeError; raised again by the stdlib when the input is not JSON
+            return json.loads(data)
+
+    def dumps(self, obj: Any) -> bytes:
+        """Encode obj as compact JSON bytes"""
+        if self._orjson is not None:
+            try:
+                return self._orjson.dumps(obj, option=self._orjson.OPT_NON_STR_KEYS)
+            except TypeError:
+                pass
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+JSON_CODEC = JsonCodec(os.environ.get('JSON_CODEC', 'auto').lower())
+_JSON_DECODER = json.JSONDecoder()
+
+# X-Ray granularity: each level also includes the ones before it
+_TRACE_LEVELS = {'off': 0, 'invocation': 1, 'batch': 2, 'call': 3}
+
+class _NullSubsegment:
+    """Stands in for a subsegment when the current trace level does not record one"""
+
+    def put_annotation(self, key: str, value: Any) -> None:
+        pass
+
+    def put_metadata(self, key: str, value: Any, namespace: str = 'default') -> None:
+        pass
+
+_NULL_SUBSEGMENT = _NullSubsegment()
+
+class Tracer:
+    """X-Ray subsegments at a configurable granularity, plus cheap per-function timings
+
+    TRACE_GRANULARITY picks what becomes a subsegment: `off`, `invocation` (the handler
+    and one-off setup), `batch` (also each bulk request and Firehose transform) or `call`
+    (also every per-message function). `call` only applies to the sampled fraction
+    TRACE_CALL_SAMPLE_RATE of invocations; the rest trace at `batch`. Whatever the level,
+    every captured function adds to call count and total time counters that are attached
+    once to the invocation subsegment as metadata.
+    """
+
+    def __init__(self, granularity: str = 'batch', call_sample_rate: float = 0.01):
+        self.granularity = _TRACE_LEVELS.get(granularity, _TRACE_LEVELS['batch'])
+        self.call_sample_rate = call_sample_rate
+        self.level = self.granularity
+        self._timings: Dict[str, List] = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float) -> None:
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                self._timings[name] = [1, seconds]
+            else:
+                timing[0] += 1
+                timing[1] += seconds
+
+    def timings(self) -> Dict[str, Dict]:
+        """Call count and total milliseconds per captured function this invocation"""
+        with self._lock:
+            return {name: {'calls': calls, 'total_ms': round(seconds * 1000, 3)}
+                    for name, (calls, seconds) in self._timings.items()}
+
+    def capture(self, name: str, level: str = 'call'):
+        """Decorator timing every call, and recording a subsegment when level is traced"""
+        rank = _TRACE_LEVELS[level]
+
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    if self.level >= rank:
+                        with xray_recorder.in_subsegment(name):
+                            return fn(*args, **kwargs)
+                    return fn(*args, **kwargs)
+                finally:
+                    self.record(name, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    @contextlib.contextmanager
+    def subsegment(self, name: str, level: str = 'batch') -> Iterator[Any]:
+        """Subsegment for annotating a block, or a no-op stand-in when level is not traced"""
+        subsegment = xray_recorder.begin_subsegment(name) if self.level >= _TRACE_LEVELS[level] else None
+        try:
+            yield subsegment if subsegment is not None else _NULL_SUBSEGMENT
+        finally:
+            if subsegment is not None:
+                xray_recorder.end_subsegment()
+
+    @contextlib.contextmanager
+    def invocation(self, name: str) -> Iterator[Any]:
+        """Trace one handler invocation, attaching the function timings to it on exit"""
+        level = self.granularity
+        if level == _TRACE_LEVELS['call'] and random.random() >= self.call_sample_rate:
+            level = _TRACE_LEVELS['batch']
+        self.level = level
+        with self._lock:
+            self._timings = {}
+
+        start = time.perf_counter()
+        with self.subsegment(name, 'invocation') as subsegment:
+            try:
+                yield subsegment
+            finally:
+                self.record(name, time.perf_counter() - start)
+                subsegment.put_metadata('function_timings', self.timings(), 'cloudtrail_opensearch')
+
+TRACER = Tracer(os.environ.get('TRACE_GRANULARITY', 'batch').lower(),
+                float(os.environ.get('TRACE_CALL_SAMPLE_RATE', '0.01')))
+
+# Per-document progress lines are only printed at LOG_LEVEL=DEBUG
+DEBUG_LOGGING = os.environ.get('LOG_LEVEL', 'INFO').upper() == 'DEBUG'
+
+# CloudWatch Embedded Metric Format keeps at most 100 values per metric in one record
+EMF_MAX_VALUES = 100
+
+class InvocationMetrics:
+    """Throughput telemetry collected during an invocation and emitted once as an EMF record
+
+    Counters (`add`) are summed, observations (`observe`) keep up to EMF_MAX_VALUES values
+    so CloudWatch can build percentiles, and gauges (`set`) keep their last value. `emit`
+    prints a single Embedded Metric Format line under METRICS_NAMESPACE, dimensioned by
+    function name and event source, which CloudWatch turns into metrics without any API call.
+    """
+
+    def __init__(self, namespace: str):
+        self.namespace = namespace
+        self.function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'cloudtrail-opensearch')
+        self._lock = threading.Lock()
+        self.start('unknown')
+
+    def start(self, source: str) -> None:
+        with self._lock:
+            self.source = source
+            self._values: Dict[str, Any] = {}
+            self._units: Dict[str, str] = {}
+
+    def add(self, name: str, value: float = 1, unit: str = 'Count') -> None:
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + value
+            self._units[name] = unit
+
+    def observe(self, name: str, value: float, unit: str = 'Milliseconds') -> None:
+        with self._lock:
+            values = self._values.setdefault(name, [])
+            if len(values) < EMF_MAX_VALUES:
+                values.append(value)
+            self._units[name] = unit
+
+    def set(self, name: str, value: float, unit: str = 'None') -> None:
+        with self._lock:
+            self._values[name] = value
+            self._units[name] = unit
+
+    def snapshot(self) -> Tuple[Dict[str, Any], Dict[str, str]]:
+        """Values and units collected so far, for merging into another process's metrics"""
+        with self._lock:
+            return dict(self._values), dict(self._units)
+
+    def merge(self, snapshot: Tuple[Dict[str, Any], Dict[str, str]]) -> None:
+        """Fold a snapshot in: counters add up, observations append, gauges are overwritten"""
+        values, units = snapshot
+        for name, value in values.items():
+            if isinstance(value, list):
+                for observation in value:
+                    self.observe(name, observation, units[name])
+            elif units[name] == 'None':
+                self.set(name, value, units[name])
+            else:
+                self.add(name, value, units[name])
+
+    def emit(self) -> Optional[str]:
+        """Print the invocation's EMF record and return it"""
+        with self._lock:
+            if not self._values:
+                return None
+            record = {
+                '_aws': {
+                    'Timestamp': int(time.time() * 1000),
+                    'CloudWatchMetrics': [{
+                        'Namespace': self.namespace,
+                        'Dimensions': [['FunctionName', 'Source']],
+                        'Metrics': [{'Name': name, 'Unit': self._units[name]} for name in self._values]
+                    }]
+                },
+                'FunctionName': self.function_name,
+                'Source': self.source,
+                'LambdaVersion': __version__
+            }
+            record.update(self._values)
+        line = json.dumps(record, separators=(',', ':'))
+        print(line)
+        return line
+
+METRICS = InvocationMetrics(os.environ.get('METRICS_NAMESPACE', 'CloudTrailOpenSearch'))
+
+def _event_date(timestamp: Any, default: str) -> str:
+    """UTC YYYY.MM.DD of an ISO-8601 @timestamp; naive timestamps are taken as UTC"""
+    if not isinstance(timestamp, str) or len(timestamp) < 10:
+        return default
+
+    offset = timestamp[19:]
+    if ('+' in offset or '-' in offset) and not offset.endswith('+00:00'):
+        # Non-UTC offset: the UTC date may differ from the local one
+        try:
+            return datetime.fromisoformat(timestamp).astimezone(timezone.utc).strftime('%Y.%m.%d')
+        except ValueError:
+            return default
+
+    date = timestamp[:10]
+    if date[4] != '-' or date[7] != '-' or not (date[:4] + date[5:7] + date[8:]).isdigit():
+        return default
+    return f"{date[:4]}.{date[5:7]}.{date[8:]}"
+
+def _firehose_budget_key(now: datetime) -> str:
+    """Field budget key for the delivery stream's weekly index at `now`
+
+    Firehose names and rotates the index itself (index_rotation_period OneWeek, on arrival
+    time), so this is not its index name: it is a key that changes when a new weekly index
+    starts. Weeks are ISO 8601 weeks; around New Year the change may come a week off from
+    the delivery stream's rotation.
+    """
+    year, week, _ = now.astimezone(timezone.utc).isocalendar()
+    return f"{__standard_index__}-{year}-w{week:02d}"
 
 class BatchSizeError(Exception):
     """Custom exception for batch size issues"""
     pass
 
+def _is_transient_request_error(exc: BaseException) -> bool:
+    """Whole-request failures worth retrying: network errors, throttling and 5xx"""
+    if isinstance(exc, requests.exceptions.HTTPError):
+        response = exc.response
+        return response is not None and (response.status_code == 429 or response.status_code >= 500)
+    return isinstance(exc, requests.exceptions.RequestException)
+
+def _is_request_too_large(exc: BaseException) -> bool:
+    """Whether a request failed only because its body was too big"""
+    if isinstance(exc, BatchSizeError):
+        return True
+    return (isinstance(exc, requests.exceptions.HTTPError) and exc.response is not None
+            and exc.response.status_code == 413)
+
+class RetryBudget:
+    """Item re-submissions allowed per invocation, shared by every batch in flight"""
+
+    def __init__(self, limit: int):
+        self.remaining = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def take(self, count: int) -> int:
+        """Reserve up to count retries, returning how many were granted"""
+        with self._lock:
+            granted = min(count, self.remaining)
+            self.remaining -= granted
+            self.used += granted
+            return granted
+
+class AdaptiveBatchSize:
+    """AIMD controller for the _bulk request size, kept on the warm OpenSearchManager
+
+    Every finished batch is feedback. While the request latency and the cluster's `took`
+    stay under the target, the byte setpoint grows by one step. A 429, a failed or split
+    request, or latency over the target cuts it by `decrease_factor`. The setpoint stays
+    between `min_bytes` and `max_bytes`, so throughput follows cluster capacity across
+    invocations without retuning OPENSEARCH_MAX_REQUEST_SIZE_MB.
+    """
+
+    def __init__(self, initial_bytes: int, min_bytes: int, max_bytes: int, step_bytes: int,
+                 target_latency_ms: float, decrease_factor: float = 0.5, enabled: bool = True):
+        self.min_bytes = min(min_bytes, max_bytes)
+        self.max_bytes = max_bytes
+        self.step_bytes = step_bytes
+        self.target_latency_ms = target_latency_ms
+        self.decrease_factor = decrease_factor
+        self.enabled = enabled
+        self.setpoint = max(self.min_bytes, min(initial_bytes, max_bytes)) if enabled else max_bytes
+        self.increases = 0
+        self.decreases = 0
+        self._lock = threading.Lock()
+
+    def observe(self, latency_ms: float, took_ms: float = 0, throttled: bool = False,
+                failed: bool = False) -> int:
+        """Adjust the setpoint from one batch outcome and return it"""
+        if not self.enabled:
+            return self.setpoint
+        with self._lock:
+            if throttled or failed or latency_ms > self.target_latency_ms:
+                self.setpoint = max(self.min_bytes, int(self.setpoint * self.decrease_factor))
+                self.decreases += 1
+            elif took_ms <= self.target_latency_ms:
+                self.setpoint = min(self.max_bytes, self.setpoint + self.step_bytes)
+                self.increases += 1
+            return self.setpoint
+
+class CircuitBreaker:
+    """Stop sending to OpenSearch while the domain is failing, kept on the warm OpenSearchManager
+
+    Closed: batches go to _bulk. `failure_threshold` consecutive failed batches, or a red
+    or unreachable cluster seen when a batch fails, open the breaker. Open: batches are
+    spilled to S3 for `reset_seconds`. After that, one cluster health probe decides whether
+    traffic resumes (half-open) or the breaker stays open. Half-open admits a single trial
+    batch and the dispatcher holds the others (see `trial_pending`) until it resolves: a
+    success closes the breaker, a failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float, health_check=None):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.health_check = health_check
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def _open(self, reason: str) -> None:
+        self.state = 'open'
+        self._trial = False
+        self.opened_at = time.monotonic()
+        print(f"Circuit breaker open: {reason}; spilling batches to S3 for {self.reset_seconds:.0f}s")
+
+    def allow_request(self) -> bool:
+        """Whether the next batch may be sent to OpenSearch
+
+        The health probe runs outside the lock, so other threads recording batch outcomes
+        never wait on it; batches asking while it runs are spilled as if the breaker were open.
+        """
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'half_open':
+                if self._trial:
+                    return False
+                self._trial = True
+                return True
+            if self._probing or time.monotonic() - self.opened_at < self.reset_seconds:
+                return False
+            self._probing = True
+
+        try:
+            health = self.health_check() if self.health_check else 'unknown'
+        except Exception:
+            health = None
+
+        with self._lock:
+            self._probing = False
+            if self.state != 'open':
+                return False
+            if health in (None, 'red'):
+                self._open(f"cluster health {health or 'unreachable'}")
+                return False
+            self.state = 'half_open'
+            self._trial = True
+            print(f"Circuit breaker half-open: cluster health {health}, sending a trial batch")
+            return True
+
+    def trial_pending(self) -> bool:
+        """Whether a half-open trial batch is still unresolved, so the next batch should wait"""
+        with self._lock:
+            return self.state == 'half_open' and self._trial
+
+    def release_trial(self) -> None:
+        """Forget a trial batch that will never be resolved, such as one from an aborted invocation"""
+        with self._lock:
+            self._trial = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.consecutive_failures = 0
+            if self.state == 'half_open':
+                self.state = 'closed'
+                self._trial = False
+                print("Circuit breaker closed")
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == 'open':
+                return
+            if self.state == 'half_open':
+                self._open("probe batch failed")
+                return
+            if self.consecutive_failures >= self.failure_threshold:
+                self._open(f"{self.consecutive_failures} consecutive failed batches")
+                return
+            if self.consecutive_failures != 1 or not self.health_check:
+                return
+
+        # First failure of a run: probe outside the lock, then open unless the state moved on
+        health = self.health_check()
+        if health in (None, 'red'):
+            with self._lock:
+                if self.state == 'closed' and self.consecutive_failures:
+                    self._open(f"cluster health {health or 'unreachable'}")
+
+class SpillSink:
+    """Write bulk NDJSON items that OpenSearch will not accept to S3 for later replay
+
+    Objects hold the exact action+source lines that were rejected, gzip compressed, under
+    <prefix><reason>/year=YYYY/month=MM/day=DD/hour=HH/ so they can be POSTed back to _bulk.
+    Metadata records the document count, the SHA-256 and size of the uncompressed NDJSON,
+    and how many items carry no _id (the only ones a replay could duplicate).
+    """
+
+    def __init__(self):
+        self.bucket = os.environ.get('SPILL_BUCKET', '')
+        self.prefix = os.environ.get('SPILL_PREFIX', 'spill/')
+        self._client = None
+
+    def _s3(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('s3')
+        return self._client
+
+    def write(self, items: List[bytes], reason: str, metadata: Optional[Dict[str, str]] = None) -> Optional[str]:
+        """Spill items under the given reason, returning the object key"""
+        if not items:
+            return None
+
+        if not self.bucket:
+            print(f"SPILL_BUCKET not configured, dropping {len(items)} {reason} documents. "
+                  f"Sample: {items[0][:500]!r}")
+            return None
+
+        import uuid
+        body = b''.join(items)
+        now = datetime.now(timezone.utc)
+        key = (f"{self.prefix}{reason}/year={now:%Y}/month={now:%m}/day={now:%d}/hour={now:%H}/"
+               f"{now:%Y%m%dT%H%M%S}-{uuid.uuid4()}.ndjson.gz")
+        object_metadata = {
+            'document-count': str(len(items)),
+            'documents-without-id': str(sum(1 for item in items if b'"_id":' not in item[:item.find(b'\n')])),
+            'byte-count': str(len(body)),
+            'sha256': hashlib.sha256(body).hexdigest(),
+            'reason': reason,
+            'lambda-version': __version__
+        }
+        object_metadata.update(metadata or {})
+
+        try:
+            self._s3().put_object(
+                Bucket=self.bucket,
+                Key=key,
+                Body=gzip.compress(body),
+                ContentType='application/x-ndjson',
+                ContentEncoding='gzip',
+                Metadata=object_metadata
+            )
+            print(f"Spilled {len(items)} {reason} documents to s3://{self.bucket}/{key}")
+            return key
+        except Exception as e:
+            print(f"Failed to spill {len(items)} {reason} documents: {str(e)}")
+            return None
+
 class CloudWatchLogProcessor:
     def __init__(self):
         # Initialize tracking variables
@@ -30,22 +596,40 @@ class CloudWatchLogProcessor:
             'http_method': '',
             'path': ''
         }
+        # Parsed JSON of each message seen in the current payload, None if it has none
+        self._parsed_messages: Dict[str, Optional[Dict]] = {}
 
     @staticmethod
-    @xray_recorder.capture('cloudwatch_processor_extract_json')
-    def extract_json(message: str) -> Optional[Dict]:
-        """Extract JSON from message if present"""
+    @TRACER.capture('cloudwatch_processor_extract_json', 'call')
+    def extract_json(message: str, start: int = 0) -> Optional[Dict]:
+        """Decode the JSON object starting at the first '{' at or after start
+
+        Text after the object is ignored. Messages ending in '}' are usually the object
+        alone and go straight to the codec; the rest are decoded in place with raw_decode.
+        """
+        json_start = message.find('{', start)
+        if json_start < 0:
+            return None
         try:
-            json_start = message.find('{')
-            if json_start >= 0:
-                json_str = message[json_start:]
-                return json.loads(json_str)
-        except (json.JSONDecodeError, ValueError):
-            pass
-        return None
+            if message.endswith('}'):
+                try:
+                    return JSON_CODEC.loads(message[json_start:] if json_start else message)
+                except ValueError:
+                    pass
+            return _JSON_DECODER.raw_decode(message, json_start)[0]
+        except ValueError:
+            return None
+
+    def parse_message(self, message: str) -> Optional[Dict]:
+        """extract_json memoized for the current payload, so each message is parsed once"""
+        try:
+            return self._parsed_messages[message]
+        except KeyError:
+            json_data = self._parsed_messages[message] = self.extract_json(message)
+            return json_data
 
     @staticmethod
-    @xray_recorder.capture('cloudwatch_processor_check_numeric')
+    @TRACER.capture('cloudwatch_processor_check_numeric', 'call')
     def is_numeric(value: str) -> bool:
         """Check if value is numeric"""
         try:
@@ -54,7 +638,53 @@ class CloudWatchLogProcessor:
         except (TypeError, ValueError):
             return False
 
-    @xray_recorder.capture('cloudwatch_extract_request_context')
+    @staticmethod
+    def parse_report(message: str, offset: int = 0) -> Dict:
+        """Parse request id, durations and memory from a REPORT line"""
+        match = _REPORT_RE.match(message, offset - 17) if offset >= 17 else None
+        if match is not None:
+            request_id, duration, billed, memory_size, memory_used, init_duration = match.groups()
+            report = {
+                'request_id': request_id,
+                'duration_ms': float(duration),
+                'billed_duration_ms': float(billed),
+                'memory_size_mb': float(memory_size),
+                'memory_used_mb': float(memory_used)
+            }
+            if init_duration is not None:
+                report['init_duration_ms'] = float(init_duration)
+            return report
+
+        report = {}
+        request_id = message[offset:].split(None, 1)
+        if request_id:
+            report['request_id'] = request_id[0]
+        for name, value in _REPORT_METRIC_RE.findall(message, offset):
+            try:
+                report[_REPORT_METRIC_FIELDS[name]] = float(value)
+            except ValueError:
+                pass
+        return report
+
+    @staticmethod
+    def merge_json(source: Dict, json_data: Dict) -> None:
+        """Merge application JSON into the document, capping how many top-level keys it adds
+
+        Keys past MAX_MERGED_JSON_KEYS go under the flat_object field instead of each
+        becoming a mapped field of its own.
+        """
+        if len(json_data) <= MAX_MERGED_JSON_KEYS:
+            source.update(json_data)
+            return
+
+        overflow = source.setdefault(FLATTENED_FIELD, {})
+        for position, (key, value) in enumerate(json_data.items()):
+            if position < MAX_MERGED_JSON_KEYS:
+                source[key] = value
+            else:
+                overflow[key] = value
+
+    @TRACER.capture('cloudwatch_extract_request_context', 'call')
     def extract_request_context(self, event_data: Dict) -> None:
         """Extract request context information from event data"""
         if isinstance(event_data, dict):
@@ -75,7 +705,7 @@ class CloudWatchLogProcessor:
                 self.request_context['http_method'] = request_context.get('httpMethod', '')
                 self.request_context['path'] = request_context.get('path', '')
 
-    @xray_recorder.capture('cloudwatch_build_metadata_fields')
+    @TRACER.capture('cloudwatch_build_metadata_fields', 'call')
     def _build_metadata_fields(self) -> Dict:
         """Build metadata fields with proper null handling"""
         metadata = {
@@ -92,7 +722,7 @@ class CloudWatchLogProcessor:
 
         return metadata
 
-    @xray_recorder.capture('cloudwatch_processor_build_source')
+    @TRACER.capture('cloudwatch_processor_build_source', 'call')
     def build_source(self, message: str, extracted_fields: Optional[Dict] = None) -> Dict:
         source = {}
 
@@ -103,28 +733,34 @@ class CloudWatchLogProcessor:
                         source[key] = float(value)
                         continue
 
-                    json_data = self.extract_json(value)
+                    json_data = self.parse_message(value)
                     if json_data is not None:
                         source[f'${key}'] = json_data
 
                     source[key] = value
 
         # Try to parse entire message as JSON
-        json_data = self.extract_json(message)
+        json_data = self.parse_message(message)
         if json_data is not None:
-            source.update(json_data)
+            self.merge_json(source, json_data)
 
         return source
 
-    @xray_recorder.capture('cloudwatch_processor_process_payload')
+    @TRACER.capture('cloudwatch_processor_process_payload', 'call')
     def process_payload(self, payload: Dict) -> List[Dict]:
         """Process CloudWatch Logs payload"""
         if payload.get('messageType') == 'CONTROL_MESSAGE':
             return []
 
+        log_events = payload.get('logEvents', [])
+        if log_events:
+            METRICS.add('DocumentsIn', len(log_events))
+            METRICS.observe('IngestLag', round(time.time() * 1000 - min(event['timestamp'] for event in log_events)))
+
         processed_logs = []
-        for log_event in payload.get('logEvents', []):
-            timestamp = datetime.fromtimestamp(log_event['timestamp'] / 1000.0)
+        self._parsed_messages = {}
+        for log_event in log_events:
+            timestamp = datetime.fromtimestamp(log_event['timestamp'] / 1000.0, tz=timezone.utc)
             message = log_event['message']
 
             # Start with base metadata
@@ -138,51 +774,37 @@ class CloudWatchLogProcessor:
             }
 
             # Try JSON parsing first
-            json_data = self.extract_json(message)
+            json_data = self.parse_message(message)
             if json_data is not None:
-                source.update(json_data)
+                self.merge_json(source, json_data)
                 source['event_type'] = 'json'
                 self.extract_request_context(json_data)
             else:
                 # Not JSON - check for specific message patterns
-                if "START RequestId:" in message:
-                    source['event_type'] = 'lambda_start'
-                    request_id = message.split("START RequestId:", 1)[1].strip().split()[0]
-                    source['request_id'] = request_id
-                elif "END RequestId:" in message:
-                    source['event_type'] = 'lambda_end'
-                    request_id = message.split("END RequestId:", 1)[1].strip().split()[0]
-                    source['request_id'] = request_id
-                elif "REPORT RequestId:" in message:
-                    source['event_type'] = 'lambda_report'
-                    parts = message.split('\t')
-                    for part in parts:
-                        if "Duration:" in part:
-                            try:
-                                source['duration_ms'] = float(part.split(':')[1].strip().replace(" ms", ""))
-                            except (ValueError, IndexError):
-                                pass
-                        elif "Memory Used:" in part:
-                            try:
-                                source['memory_used_mb'] = float(part.split(':')[1].strip().replace(" MB", ""))
-                            except (ValueError, IndexError):
-                                pass
+                platform = _PLATFORM_LINES.get(message[:1])
+                if platform is not None and message.startswith(platform[0]):
+                    marker, event_type = platform
+                    source['event_type'] = event_type
+                    if event_type == 'lambda_report':
+                        source.update(self.parse_report(message, len(marker)))
+                    else:
+                        request_id = message[len(marker):].split(None, 1)
+                        if not request_id:
+                            continue
+                        source['request_id'] = request_id[0]
                 elif "Event Received:" in message:
                     source['event_type'] = 'event_received'
-                    try:
-                        json_start = message.find('{')
-                        if json_start >= 0:
-                            json_content = message[json_start:]
-                            event_data = json.loads(json_content)
-                            source['event_data'] = event_data
-                            self.extract_request_context(event_data)
-                    except (json.JSONDecodeError, ValueError):
+                    # The first '{' did not start valid JSON; look for the event after the marker
+                    event_data = self.extract_json(message, message.find("Event Received:") + 15)
+                    if event_data is None:
                         continue
+                    source['event_data'] = event_data
+                    self.extract_request_context(event_data)
                 elif "Response Body:" in message:
                     source['event_type'] = 'response_body'
                     try:
                         response_content = message.split("Response Body:", 1)[1].strip()
-                        response_data = json.loads(response_content)
+                        response_data = JSON_CODEC.loads(response_content)
                         source['response_data'] = response_data
 
                         if isinstance(response_data, dict):
@@ -208,10 +830,437 @@ class CloudWatchLogProcessor:
             source.update(self._build_metadata_fields())
             source['lambda_version'] = __version__
             processed_logs.append(source)
-            print(f"Processed log entry: {source.get('@id')} - Type: {source.get('event_type')}")
+            if DEBUG_LOGGING:
+                print(f"Processed log entry: {source.get('@id')} - Type: {source.get('event_type')}")
 
         return processed_logs
 
+class QuantileSketch:
+    """Mergeable log-bucketed quantile sketch with bounded relative error
+
+    Positive values land in bucket ceil(log_gamma(v)); any quantile estimate is within
+    `accuracy` of the true value relative to it. Sketches built with the same accuracy
+    merge exactly by adding bucket counts, so per-minute rows combine into any window.
+    """
+
+    def __init__(self, accuracy: float = ROLLUP_SKETCH_ACCURACY):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        if value <= 0:
+            self.zero_count += 1
+            return
+        key = math.ceil(math.log(value) / self._log_gamma)
+        self.bins[key] = self.bins.get(key, 0) + 1
+
+    def merge(self, other: 'QuantileSketch') -> None:
+        self.count += other.count
+        self.zero_count += other.zero_count
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if rank < seen:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    def to_dict(self) -> Dict:
+        keys = sorted(self.bins)
+        return {
+            'accuracy': self.accuracy,
+            'zero_count': self.zero_count,
+            'keys': keys,
+            'counts': [self.bins[key] for key in keys]
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'QuantileSketch':
+        sketch = cls(data['accuracy'])
+        sketch.zero_count = data.get('zero_count', 0)
+        sketch.bins = dict(zip(data['keys'], data['counts']))
+        sketch.count = sketch.zero_count + sum(sketch.bins.values())
+        return sketch
+
+class MetricRollup:
+    """Per-log-group, per-minute count/sum/min/max/sketch of REPORT metrics
+
+    Each invocation writes its own partial rows; rows for the same log group and minute
+    from different invocations combine by summing counts and merging sketches. p50/p90/p99
+    are quantiles of one invocation's partial row only and cannot be averaged or otherwise
+    merged across rows; the minute's true quantiles come from merging the `sketch` fields.
+    """
+
+    def __init__(self):
+        # (log group, minute) -> metric -> [count, sum, min, max, sketch]
+        self._rows: Dict[Tuple[str, str], Dict[str, List]] = {}
+        # First document id contributing to each row, which makes row ids stable on replay
+        self._first_ids: Dict[Tuple[str, str], str] = {}
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def add(self, doc: Dict) -> None:
+        """Fold the REPORT metrics of one document into its minute"""
+        if doc.get('event_type') not in _ROLLUP_EVENT_TYPES:
+            return
+        timestamp = doc.get('end_timestamp') or doc.get('@timestamp')
+        if not timestamp:
+            return
+
+        key = (doc.get('@log_group') or '', timestamp[:16])
+        row = self._rows.get(key)
+        if row is None:
+            row = self._rows[key] = {}
+            self._first_ids[key] = str(doc.get('@id', ''))
+
+        for metric in _ROLLUP_METRICS:
+            value = doc.get(metric)
+            if value is None:
+                continue
+            stats = row.get(metric)
+            if stats is None:
+                row[metric] = [1, value, value, value, QuantileSketch()]
+                row[metric][4].add(value)
+                continue
+            stats[0] += 1
+            stats[1] += value
+            if value < stats[2]:
+                stats[2] = value
+            if value > stats[3]:
+                stats[3] = value
+            stats[4].add(value)
+
+    def documents(self) -> List[Dict]:
+        """One rollup document per log group and minute"""
+        documents = []
+        for key, row in self._rows.items():
+            log_group, minute = key
+            row_id = hashlib.sha1(f"{log_group}|{minute}|{self._first_ids[key]}".encode('utf-8')).hexdigest()
+            rollup = {}
+            for metric, (count, total, low, high, sketch) in row.items():
+                rollup[metric] = {
+                    'count': count,
+                    'sum': total,
+                    'min': low,
+                    'max': high,
+                    'p50': sketch.quantile(0.5),
+                    'p90': sketch.quantile(0.9),
+                    'p99': sketch.quantile(0.99),
+                    'sketch': sketch.to_dict()
+                }
+            documents.append({
+                '@timestamp': f"{minute}:00+00:00",
+                '@id': row_id,
+                '@log_group': log_group,
+                'event_type': 'lambda_rollup',
+                'interval': '1m',
+                'invocations': rollup['duration_ms']['count'] if 'duration_ms' in rollup else 0,
+                'cold_starts': rollup['init_duration_ms']['count'] if 'init_duration_ms' in rollup else 0,
+                'rollup': rollup,
+                'lambda_version': __version__
+            })
+        return documents
+
+def _coerce_leaves(tree: Dict) -> None:
+    """Turn every leaf under tree into a string in place: booleans lower-case, null empty"""
+    for key, value in tree.items():
+        kind = type(value)
+        if kind is str:
+            continue
+        if kind is dict:
+            _coerce_leaves(value)
+        elif kind is list:
+            for position, item in enumerate(value):
+                item_kind = type(item)
+                if item_kind is str:
+                    continue
+                if item_kind is dict:
+                    _coerce_leaves(item)
+                elif item_kind is bool:
+                    value[position] = 'true' if item else 'false'
+                else:
+                    value[position] = '' if item is None else str(item)
+        elif kind is bool:
+            tree[key] = 'true' if value else 'false'
+        else:
+            tree[key] = '' if value is None else str(value)
+
+class DocumentNormalizer:
+    """Coerce free-form CloudTrail subtrees to strings before indexing, compiled from the template
+
+    Subtrees the index template maps as dynamic objects, or sends to keyword through a
+    `<root>.*` dynamic template, hold arbitrary service payloads whose leaf types vary
+    between events. Their leaves are stringified in place so a field never flips between
+    long, boolean and keyword across documents. Nothing else in the document is touched.
+    """
+
+    def __init__(self, template: Dict):
+        self.roots = self.coerced_roots(template)
+
+    @staticmethod
+    def coerced_roots(template: Dict) -> List[Tuple[str, ...]]:
+        """Paths of the subtrees whose leaves must be strings"""
+        mappings = template.get('template', {}).get('mappings', {})
+        roots = []
+        for entry in mappings.get('dynamic_templates', []):
+            for rule in entry.values():
+                path = rule.get('path_match', '')
+                if (path.endswith('.*') and '*' not in path[:-2]
+                        and rule.get('mapping', {}).get('type') == 'keyword'):
+                    roots.append(tuple(path[:-2].split('.')))
+        for name, mapping in mappings.get('properties', {}).items():
+            if mapping.get('type') == 'object' and mapping.get('dynamic') is True:
+                roots.append((name,))
+        return list(dict.fromkeys(roots))
+
+    def __call__(self, doc: Dict) -> Dict:
+        """Normalize doc in place and return it"""
+        for path in self.roots:
+            parent = doc
+            for key in path[:-1]:
+                parent = parent.get(key)
+                if type(parent) is not dict:
+                    break
+            else:
+                leaf_key = path[-1]
+                if leaf_key not in parent:
+                    continue
+                subtree = parent[leaf_key]
+                if type(subtree) is dict:
+                    _coerce_leaves(subtree)
+                elif subtree is None:
+                    parent[leaf_key] = {}
+        return doc
+
+def _field_paths(value: Any, path: str, paths: set) -> None:
+    """Collect the dotted paths OpenSearch would map for value at path"""
+    kind = type(value)
+    if kind is dict:
+        if not value:
+            paths.add(path)
+        for key, child in value.items():
+            _field_paths(child, f"{path}.{key}", paths)
+    elif kind is list:
+        for item in value:
+            if type(item) is dict or type(item) is list:
+                _field_paths(item, path, paths)
+            else:
+                paths.add(path)
+        if not value:
+            paths.add(path)
+    else:
+        paths.add(path)
+
+class FieldBudget:
+    """Track field paths mapped per index and divert subtrees that would blow the mapping budget
+
+    A top-level subtree that has introduced more than `subtree_limit` distinct paths into
+    an index, or any subtree adding paths once the index holds `index_limit`, is moved
+    under the flat_object FLATTENED_FIELD for the rest of that index's life, where its
+    keys stay searchable without becoming mapped fields. State lives in the warm
+    container, so it approximates the cluster mapping from what this container indexed.
+    """
+
+    def __init__(self, subtree_limit: int = FIELD_BUDGET_SUBTREE_PATHS,
+                 index_limit: int = FIELD_BUDGET_INDEX_PATHS):
+        self.subtree_limit = subtree_limit
+        self.index_limit = index_limit
+        self._paths: Dict[str, set] = {}
+        self._subtree_paths: Dict[Tuple[str, str], int] = {}
+        self._flattened: Dict[str, set] = {}
+        self._paths_by_log_group: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _forget_oldest_index(self) -> None:
+        # Index names mix daily, weekly and other layouts; first tracked is the oldest
+        oldest = next(iter(self._paths))
+        del self._paths[oldest]
+        del self._flattened[oldest]
+        for subtree in [subtree for subtree in self._subtree_paths if subtree[0] == oldest]:
+            del self._subtree_paths[subtree]
+
+    def _track(self, index_name: str) -> Tuple[set, set]:
+        """Known paths and flattened subtrees of index_name, tracking it if new; under the lock"""
+        known = self._paths.get(index_name)
+        if known is None:
+            if len(self._paths) >= FIELD_BUDGET_TRACKED_INDICES:
+                self._forget_oldest_index()
+            known = self._paths[index_name] = set()
+            self._flattened[index_name] = set()
+        return known, self._flattened[index_name]
+
+    def _allow(self, index_name: str, key: str, paths: set, log_group: str) -> bool:
+        """Map paths new to index_name under subtree key, or flatten key; under the lock"""
+        known = self._paths[index_name]
+        subtree = (index_name, key)
+        subtree_paths = self._subtree_paths.get(subtree, 0) + len(paths)
+        if subtree_paths <= self.subtree_limit and len(known) + len(paths) <= self.index_limit:
+            known.update(paths)
+            self._subtree_paths[subtree] = subtree_paths
+            self._paths_by_log_group[log_group] = self._paths_by_log_group.get(log_group, 0) + len(paths)
+            return True
+
+        self._flattened[index_name].add(key)
+        print(f"Field budget: flattening {key} in {index_name} "
+              f"({subtree_paths} paths, index at {len(known)})")
+        return False
+
+    def apply(self, index_name: str, doc: Dict) -> Dict:
+        """Move over-budget subtrees of doc under FLATTENED_FIELD in place and return it"""
+        with self._lock:
+            known, flattened = self._track(index_name)
+
+            for key in list(doc):
+                if key == FLATTENED_FIELD:
+                    continue
+                if key not in flattened:
+                    value = doc[key]
+                    if type(value) is dict or type(value) is list:
+                        paths = set()
+                        _field_paths(value, key, paths)
+                        paths -= known
+                    elif key in known:
+                        continue
+                    else:
+                        paths = {key}
+                    if not paths or self._allow(index_name, key, paths, doc.get('@log_group') or 'unknown'):
+                        continue
+                doc.setdefault(FLATTENED_FIELD, {})[key] = doc.pop(key)
+        return doc
+
+    def admit(self, index_name: str, key: str, paths: Iterable[str], log_group: str) -> bool:
+        """Decide for a parse worker whether paths under subtree key may be mapped in index_name"""
+        with self._lock:
+            known, flattened = self._track(index_name)
+            if key in flattened:
+                return False
+            paths = set(paths) - known
+            return not paths or self._allow(index_name, key, paths, log_group)
+
+    def report(self, top: int = 5) -> Dict:
+        """Mapped path counts per index, flattened subtrees and the top field-producing log groups"""
+        with self._lock:
+            top_groups = sorted(self._paths_by_log_group.items(), key=lambda item: item[1], reverse=True)[:top]
+            return {
+                'paths_by_index': {index: len(paths) for index, paths in self._paths.items()},
+                'flattened_by_index': {index: sorted(keys) for index, keys in self._flattened.items() if keys},
+                'top_log_groups': [{'log_group': group, 'paths': count} for group, count in top_groups]
+            }
+
+class WorkerFieldBudget(FieldBudget):
+    """Field budget of a parse worker, deciding through the parent's budget over the worker pipe
+
+    Paths the worker has already seen are checked locally; a path new to the worker is
+    sent to the parent, whose FieldBudget is shared by every worker and the handler process,
+    so the index limit holds across workers and the parent's report covers their fields.
+    """
+
+    def __init__(self, conn):
+        super().__init__()
+        self._conn = conn
+
+    def _allow(self, index_name: str, key: str, paths: set, log_group: str) -> bool:
+        self._conn.send(('budget', index_name, key, paths, log_group))
+        if self._conn.recv():
+            self._paths[index_name].update(paths)
+            return True
+        self._flattened[index_name].add(key)
+        return False
+
+class BulkBatch:
+    """Encoded _bulk request: one action+document NDJSON item per document
+
+    `origins` runs parallel to `items` and names the source record of each document
+    (a Kinesis sequence number), so indexing failures can be traced back to it.
+    """
+    __slots__ = ('index_name', 'items', 'origins', 'size')
+
+    def __init__(self, index_name: str):
+        self.index_name = index_name
+        self.items: List[bytes] = []
+        self.origins: List[Optional[str]] = []
+        self.size = 0
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def append(self, item: bytes, origin: Optional[str] = None) -> None:
+        self.items.append(item)
+        self.origins.append(origin)
+        self.size += len(item)
+
+    def body(self) -> bytes:
+        """Request body, joined once from the already-encoded items"""
+        return b''.join(self.items)
+
+class BulkBodyBuilder:
+    """Serialize each document once into NDJSON bytes and cut batches on exact byte size"""
+
+    def __init__(self, index_name: str, max_docs: int, max_bytes: int, normalize=None,
+                 field_budget: Optional[FieldBudget] = None):
+        self.index_name = index_name
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.normalize = normalize
+        self.field_budget = field_budget
+        # Everything in the action line except the _id is fixed for the index
+        self._action_prefix = ('{"index":{"_index":%s,"_id":' % json.dumps(index_name)).encode('utf-8')
+        self._action_no_id = ('{"index":{"_index":%s}}\n' % json.dumps(index_name)).encode('utf-8')
+        self._batch = BulkBatch(index_name)
+
+    def encode(self, doc: Dict) -> bytes:
+        """Normalize and encode one document as its action line plus source line"""
+        if self.normalize is not None:
+            doc = self.normalize(doc)
+        if self.field_budget is not None:
+            doc = self.field_budget.apply(self.index_name, doc)
+
+        doc_id = doc.get('@id')
+        if doc_id:
+            action = self._action_prefix + JSON_CODEC.dumps(doc_id) + b'}}\n'
+        else:
+            action = self._action_no_id
+
+        return action + JSON_CODEC.dumps(doc) + b'\n'
+
+    def add(self, doc: Dict, origin: Optional[str] = None) -> Optional[BulkBatch]:
+        """Add a document, returning the previous batch if this one did not fit"""
+        return self.append(self.encode(doc), origin)
+
+    def append(self, item: bytes, origin: Optional[str] = None) -> Optional[BulkBatch]:
+        """Add an already encoded item, returning the previous batch if this one did not fit"""
+        full = None
+
+        if self._batch.items and (len(self._batch) >= self.max_docs or
+                                  self._batch.size + len(item) > self.max_bytes):
+            full = self._batch
+            self._batch = BulkBatch(self.index_name)
+
+        self._batch.append(item, origin)
+        return full
+
+    def flush(self) -> Optional[BulkBatch]:
+        """Return the partially filled batch, if any"""
+        if not self._batch.items:
+            return None
+        full = self._batch
+        self._batch = BulkBatch(self.index_name)
+        return full
+
 class OpenSearchManager:
     def __init__(self):
         self.domain = os.environ['OPENSEARCH_DOMAIN_ENDPOINT']
@@ -223,17 +1272,63 @@ class OpenSearchManager:
         self.max_request_size_mb = int(os.environ.get('OPENSEARCH_MAX_REQUEST_SIZE_MB', '30'))
         self.max_payload_size = self.max_request_size_mb * 1024 * 1024  # Convert to bytes
 
+        # Adaptive request size between the floor and max_payload_size, fed by bulk latency
+        self.batch_controller = AdaptiveBatchSize(
+            initial_bytes=int(float(os.environ.get('OPENSEARCH_INITIAL_REQUEST_SIZE_MB', '5')) * 1024 * 1024),
+            min_bytes=int(float(os.environ.get('OPENSEARCH_MIN_REQUEST_SIZE_MB', '1')) * 1024 * 1024),
+            max_bytes=self.max_payload_size,
+            step_bytes=int(float(os.environ.get('OPENSEARCH_REQUEST_SIZE_STEP_MB', '1')) * 1024 * 1024),
+            target_latency_ms=float(os.environ.get('OPENSEARCH_TARGET_LATENCY_MS', '1000')),
+            enabled=os.environ.get('OPENSEARCH_ADAPTIVE_BATCHING', 'true').lower() == 'true')
+
+        # Opt-in gzip request bodies for _bulk, trading Lambda CPU for network bandwidth
+        self.compression = os.environ.get('OPENSEARCH_COMPRESSION', 'none').lower()
+        self.compression_level = int(os.environ.get('OPENSEARCH_COMPRESSION_LEVEL', '3'))
+
+        # Item-level retries for documents rejected under cluster pressure
+        self.item_retry_attempts = int(os.environ.get('OPENSEARCH_ITEM_RETRY_ATTEMPTS', '4'))
+        self.retry_budget = int(os.environ.get('OPENSEARCH_RETRY_BUDGET', '5000'))
+        self.retry_base_ms = int(os.environ.get('OPENSEARCH_RETRY_BASE_MS', '200'))
+        self.retry_max_ms = int(os.environ.get('OPENSEARCH_RETRY_MAX_MS', '5000'))
+        self.spill_sink = SpillSink()
+
+        # Spill whole batches to S3 instead of retrying against a failing domain
+        self.breaker = CircuitBreaker(
+            max(1, int(os.environ.get('OPENSEARCH_BREAKER_FAILURES', '3'))),
+            float(os.environ.get('OPENSEARCH_BREAKER_COOLDOWN', '60')),
+            self._cluster_health
+        )
+
+        # Concurrent bulk dispatch over a pooled keep-alive session
+        self.max_in_flight = max(1, int(os.environ.get('OPENSEARCH_MAX_IN_FLIGHT', '4')))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_in_flight + 1)
+        self.session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight,
+                                            thread_name_prefix='opensearch-bulk')
+        # Batches cut ahead of dispatch on a producer thread; 0 cuts them inline, which already
+        # overlaps cutting the next batch with the ones in flight
+        self.prefetch_batches = max(0, int(os.environ.get('OPENSEARCH_PREFETCH_BATCHES', '0')))
+
+        self._credentials = None
         self.auth = self._get_aws_auth()
+        self.normalize = DocumentNormalizer(self._index_template())
+        self.field_budget = FieldBudget()
         self._ensure_index_template()
+        if METRIC_ROLLUPS:
+            self._ensure_index_template(__rollup_index_template__, self._rollup_index_template())
 
-        print(f"OpenSearch Manager initialized - Batch size: {self.max_batch_size}, Max payload: {self.max_request_size_mb}MB")
+        print(f"OpenSearch Manager initialized - Batch size: {self.max_batch_size}, Max payload: {self.max_request_size_mb}MB, "
+              f"Max in flight: {self.max_in_flight}, Compression: {self.compression}, JSON codec: {JSON_CODEC.name}")
 
-    @xray_recorder.capture('get_aws_auth')
+    @TRACER.capture('get_aws_auth', 'invocation')
     def _get_aws_auth(self) -> AWS4Auth:
         """Get AWS authentication credentials with proper error handling"""
         try:
-            session = boto3.Session()
-            credentials = session.get_credentials()
+            if self._credentials is None:
+                # The botocore credential chain boto3.Session() uses, without loading boto3
+                self._credentials = botocore.session.get_session().get_credentials()
+            credentials = self._credentials
             if not credentials:
                 raise Exception("No AWS credentials found")
 
@@ -249,59 +1344,122 @@ class OpenSearchManager:
             print(f"Error getting AWS credentials: {str(e)}")
             raise
 
-    @xray_recorder.capture('opensearch_request')
+    def _refresh_auth_if_needed(self) -> None:
+        """Re-sign with fresh credentials only when the current ones near expiry"""
+        refresh_needed = getattr(self._credentials, 'refresh_needed', None)
+        if refresh_needed is not None and refresh_needed(CREDENTIAL_REFRESH_MARGIN_SECONDS):
+            print("AWS credentials near expiry, refreshing request signer")
+            self.auth = self._get_aws_auth()
+
+    def _reset_credentials(self) -> None:
+        """Drop cached credentials so the next signer is built from a new session"""
+        self._credentials = None
+        self.auth = self._get_aws_auth()
+
+    @TRACER.capture('opensearch_request', 'batch')
     @retry(
         stop=stop_after_attempt(3),
         wait=wait_exponential(multiplier=1, min=4, max=10),
-        retry=retry_if_exception_type((requests.exceptions.RequestException, requests.exceptions.Timeout))
+        retry=retry_if_exception(_is_transient_request_error),
+        reraise=True
     )
-    def _make_request(self, method: str, endpoint: str, data: str = None) -> requests.Response:
-        """Make HTTP request to OpenSearch with X-Ray tracing"""
+    def _make_request(self, method: str, endpoint: str, data: Optional[Union[str, bytes]] = None,
+                      allow_not_found: bool = False, compress: bool = False) -> requests.Response:
+        """Make HTTP request to OpenSearch with X-Ray tracing
+
+        With compress=True and compression enabled the body is sent gzip-encoded and the
+        returned response carries a `compression` dict with raw/wire bytes, ratio and CPU time.
+        """
         url = f"https://{self.domain}/{endpoint}"
         headers = {"Content-Type": "application/json"}
-
-        subsegment = xray_recorder.begin_subsegment('opensearch_api_call')
-        try:
-            subsegment.put_annotation('endpoint', endpoint)
-            subsegment.put_annotation('method', method)
-
-            # Check payload size before making request
-            if data and len(data.encode('utf-8')) > self.max_payload_size:
-                raise BatchSizeError(f"Request payload too large: {len(data.encode('utf-8'))/1024/1024:.2f}MB > {self.max_request_size_mb}MB")
-
-            response = requests.request(
-                method=method,
-                url=url,
-                auth=self.auth,
-                headers=headers,
-                data=data,
-                verify=True,
-                timeout=60  # Increased timeout
-            )
-
-            subsegment.put_annotation('status_code', response.status_code)
-
-            if response.status_code >= 400:
-                error_body = response.text[:1000]
-                subsegment.put_annotation('error', error_body)
-                print(f"OpenSearch error: Status {response.status_code}, Body: {error_body}")
+        compression = None
+
+        with TRACER.subsegment('opensearch_api_call') as subsegment:
+            try:
+                subsegment.put_annotation('endpoint', endpoint)
+                subsegment.put_annotation('method', method)
+
+                # Bulk bodies arrive already encoded; only encode plain strings, and only once
+                if isinstance(data, str):
+                    data = data.encode('utf-8')
+
+                if data and compress and self.compression == 'gzip':
+                    data, compression = self._gzip_body(data)
+                    headers["Content-Encoding"] = "gzip"
+                    subsegment.put_annotation('compression_ratio', compression['ratio'])
+
+                # Check payload size before making request, on the bytes actually sent
+                if data and len(data) > self.max_payload_size:
+                    raise BatchSizeError(f"Request payload too large: {len(data)/1024/1024:.2f}MB > {self.max_request_size_mb}MB")
+
+                self._refresh_auth_if_needed()
+                response = self.session.request(
+                    method=method,
+                    url=url,
+                    auth=self.auth,
+                    headers=headers,
+                    data=data,
+                    verify=True,
+                    timeout=60  # Increased timeout
+                )
+
+                subsegment.put_annotation('status_code', response.status_code)
+                response.compression = compression
+
+                if allow_not_found and response.status_code == 404:
+                    return response
+
+                if response.status_code >= 400:
+                    error_body = response.text[:1000]
+                    subsegment.put_annotation('error', error_body)
+                    print(f"OpenSearch error: Status {response.status_code}, Body: {error_body}")
+                    print(f"Request URL: {url}")
+
+                    if response.status_code == 403 and 'expired' in error_body.lower():
+                        # Signed with stale credentials, rebuild the signer and let tenacity retry
+                        self._reset_credentials()
+                        raise requests.exceptions.RequestException(f"Expired credentials: {error_body}")
+
+                    if compression and self._rejects_compression(response.status_code, error_body):
+                        # Domain does not accept gzip bodies, fall back to plain requests for this container
+                        print("OpenSearch rejected gzip request body, disabling request compression")
+                        self.compression = 'none'
+                        raise requests.exceptions.RequestException(f"Compression rejected: {error_body}")
+
+                response.raise_for_status()
+                return response
+
+            except Exception as e:
+                subsegment.put_annotation('error', str(e))
+                print(f"Request failed: {str(e)}")
                 print(f"Request URL: {url}")
+                raise
+
+    def _gzip_body(self, data: bytes) -> Tuple[bytes, Dict]:
+        """Gzip a request body, measuring ratio and the CPU spent compressing"""
+        cpu_start = time.process_time()
+        compressed = gzip.compress(data, compresslevel=self.compression_level)
+        cpu_ms = (time.process_time() - cpu_start) * 1000
+
+        return compressed, {
+            'raw_bytes': len(data),
+            'wire_bytes': len(compressed),
+            'ratio': round(len(data) / max(len(compressed), 1), 2),
+            'cpu_ms': round(cpu_ms, 2)
+        }
 
-            response.raise_for_status()
-            return response
-
-        except Exception as e:
-            subsegment.put_annotation('error', str(e))
-            print(f"Request failed: {str(e)}")
-            print(f"Request URL: {url}")
-            raise
-        finally:
-            xray_recorder.end_subsegment()
+    @staticmethod
+    def _rejects_compression(status_code: int, error_body: str) -> bool:
+        """Whether an error response means the domain cannot read gzip request bodies"""
+        if status_code == 415:
+            return True
+        body = error_body.lower()
+        return status_code == 400 and ('content-encoding' in body or 'compress' in body)
 
-    @xray_recorder.capture('opensearch_index_template')
-    def _ensure_index_template(self):
-        """Create or update index template with proper mappings"""
-        template = {
+    @staticmethod
+    def _index_template() -> Dict:
+        """Index template body for the standard CloudTrail indices"""
+        return {
             "index_patterns": [f"{__standard_index__}-*"],
             "template": {
                 "settings": {
@@ -386,237 +1544,687 @@ class OpenSearchManager:
                         "cw_user_name": {"type": "keyword"},
                         "cw_http_method": {"type": "keyword"},
                         "cw_path": {"type": "keyword"},
-                        "lambda_version": {"type": "keyword"}
+                        "lambda_version": {"type": "keyword"},
+                        FLATTENED_FIELD: {"type": "flat_object"}
                     }
                 }
             }
         }
 
-        try:
-            response = self._make_request('PUT', '_index_template/cw_template',
-                                        data=json.dumps(template))
-            print(f"Successfully created/updated index template: {response.status_code}")
-        except Exception as e:
-            print(f"Failed to create/update index template: {str(e)}")
-            raise
-
-    @xray_recorder.capture('opensearch_normalize_document')
-    def _normalize_document(self, doc: Dict) -> Dict:
-        """Normalize document fields before indexing"""
-        def normalize_value(value):
-            if isinstance(value, bool):
-                return str(value).lower()
-            if value is None:
-                return ""
-            return str(value)
-
-        def process_dict(d):
-            if d is None:
-                return {}
-
-            processed = {}
-            for key, value in d.items():
-                if isinstance(value, dict):
-                    processed[key] = process_dict(value)
-                elif isinstance(value, list):
-                    processed[key] = [process_dict(item) if isinstance(item, dict)
-                                    else normalize_value(item) for item in value]
-                elif key == "Value" and any(tag_key in str(key) for tag_key in ["Tag", "TagSet"]):
-                    processed[key] = normalize_value(value)
-                else:
-                    processed[key] = normalize_value(value)
-            return processed
+    @staticmethod
+    def _rollup_index_template() -> Dict:
+        """Index template body for the per-minute metric rollup indices"""
+        metric_mapping = {
+            "properties": {
+                "count": {"type": "long"},
+                "sum": {"type": "double"},
+                "min": {"type": "double"},
+                "max": {"type": "double"},
+                # Per-invocation partial quantiles; not mergeable across rows
+                "p50": {"type": "double"},
+                "p90": {"type": "double"},
+                "p99": {"type": "double"},
+                # Stored for merging outside OpenSearch, not searchable
+                "sketch": {"type": "object", "enabled": False}
+            }
+        }
+        return {
+            "index_patterns": [f"{__rollup_index__}-*"],
+            # Also matched by the standard template's pattern; the higher priority wins
+            "priority": 1,
+            "template": {
+                "settings": {
+                    "number_of_shards": 1,
+                    "number_of_replicas": 1,
+                    "refresh_interval": "30s"
+                },
+                "mappings": {
+                    "dynamic": False,
+                    "properties": {
+                        "@timestamp": {"type": "date"},
+                        "@id": {"type": "keyword"},
+                        "@log_group": {"type": "keyword"},
+                        "event_type": {"type": "keyword"},
+                        "interval": {"type": "keyword"},
+                        "invocations": {"type": "long"},
+                        "cold_starts": {"type": "long"},
+                        "lambda_version": {"type": "keyword"},
+                        "rollup": {
+                            "properties": {metric: metric_mapping for metric in _ROLLUP_METRICS}
+                        }
+                    }
+                }
+            }
+        }
 
-        try:
-            normalized = doc.copy()
-            if 'requestParameters' in normalized:
-                normalized['requestParameters'] = process_dict(normalized.get('requestParameters'))
+    @staticmethod
+    def _template_fingerprint(template: Dict) -> str:
+        """Stable hash of a template body, independent of key order"""
+        canonical = json.dumps(template, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def _get_template_fingerprint(self, name: str) -> Optional[str]:
+        """Fingerprint recorded in the cluster's copy of the template, if any"""
+        response = self._make_request('GET', f'_index_template/{name}', allow_not_found=True)
+        if response.status_code == 404:
+            return None
+
+        for entry in response.json().get('index_templates', []):
+            if entry.get('name') == name:
+                return entry.get('index_template', {}).get('_meta', {}).get('fingerprint')
+        return None
 
-            # Also normalize any Tag values in responseElements
-            if 'responseElements' in normalized:
-                normalized['responseElements'] = process_dict(normalized.get('responseElements'))
+    @TRACER.capture('opensearch_index_template', 'invocation')
+    def _ensure_index_template(self, name: str = __index_template__, template: Optional[Dict] = None):
+        """Create or update index template, skipping the PUT when the cluster is current"""
+        if template is None:
+            template = self._index_template()
+        fingerprint = self._template_fingerprint(template)
+        template['_meta'] = {
+            'fingerprint': fingerprint,
+            'lambda_version': __version__
+        }
 
-            return normalized
+        try:
+            if self._get_template_fingerprint(name) == fingerprint:
+                print(f"Index template {name} up to date ({fingerprint[:12]})")
+                return
 
+            response = self._make_request('PUT', f'_index_template/{name}',
+                                        data=json.dumps(template))
+            print(f"Successfully created/updated index template {name}: {response.status_code} ({fingerprint[:12]})")
         except Exception as e:
-            print(f"Error normalizing document: {str(e)}")
-            print(f"Problem document: {json.dumps(doc)[:1000]}...")
-            # Return original document if normalization fails
-            return doc
-
-    @xray_recorder.capture('opensearch_create_batches')
-    def _create_batches(self, documents: List[Dict]) -> Iterator[List[Dict]]:
-        """Split documents into smaller batches based on size and count"""
-        if not documents:
-            return
-
-        current_batch = []
-        current_batch_size = 0
-
-        # Estimate average document size from first few documents
-        sample_size = min(10, len(documents))
-        sample_docs = documents[:sample_size]
-        avg_doc_size = sum(len(json.dumps(doc).encode('utf-8')) for doc in sample_docs) // sample_size
-
-        # Calculate safe batch size with 50% safety margin
-        safe_max_size = int(self.max_payload_size * 0.5)
-        estimated_max_docs = safe_max_size // (avg_doc_size * 2)  # Account for bulk metadata
-        dynamic_batch_size = min(self.max_batch_size, estimated_max_docs, 2000)
-
-        print(f"Batch strategy: avg_doc_size={avg_doc_size}B, dynamic_batch_size={dynamic_batch_size}")
-
-        for doc in documents:
-            doc_json = json.dumps(doc)
-            doc_size = len(doc_json.encode('utf-8'))
-
-            # Check if adding this document would exceed limits
-            if (len(current_batch) >= dynamic_batch_size or
-                current_batch_size + doc_size > safe_max_size):
-
-                if current_batch:
-                    yield current_batch
-                    current_batch = []
-                    current_batch_size = 0
-
-            current_batch.append(doc)
-            current_batch_size += doc_size
-
-        # Yield remaining batch
-        if current_batch:
-            yield current_batch
+            print(f"Failed to create/update index template: {str(e)}")
+            raise
 
-    @xray_recorder.capture('opensearch_bulk_index_batch')
-    def _bulk_index_single_batch(self, documents: List[Dict], batch_num: int = 0) -> Dict:
-        """Index a single batch of documents"""
-        if not documents:
+    def _create_batches(self, entries: Iterable[Tuple[Dict, Optional[str]]],
+                        index_prefix: str = __standard_index__) -> Iterator[BulkBatch]:
+        """Encode (document, origin) pairs once and split them into batches on exact byte size and count
+
+        Documents are routed to the daily index of their own @timestamp (UTC), so late and
+        replayed data lands with the rest of its day. Each index gets its own builder, and
+        with it its own precomputed action line bytes and batches. Entries are consumed one at
+        a time and a batch is yielded as soon as it fills, so only open batches are held.
+        """
+        today = datetime.now(timezone.utc).strftime('%Y.%m.%d')
+        builders: Dict[str, BulkBodyBuilder] = {}
+        # Rollup indices have a fixed, non-dynamic mapping; only log documents use up the budget
+        field_budget = None if index_prefix == __rollup_index__ else self.field_budget
+
+        for doc, origin in entries:
+            index_name = f"{index_prefix}-{_event_date(doc.get('@timestamp'), today)}"
+            builder = builders.get(index_name)
+            if builder is None:
+                builder = builders[index_name] = BulkBodyBuilder(
+                    index_name, self.max_batch_size, self.max_payload_size,
+                    normalize=self.normalize, field_budget=field_budget)
+
+            # Batches already in flight keep adjusting the setpoint while later ones are cut
+            builder.max_bytes = self.batch_controller.setpoint
+            full = builder.add(doc, origin)
+            if full is not None:
+                yield full
+
+        # Yield remaining batches
+        for builder in builders.values():
+            remaining = builder.flush()
+            if remaining is not None:
+                yield remaining
+
+    def _cut_batches(self, items: Iterable[Tuple[str, bytes, Optional[str]]]) -> Iterator[BulkBatch]:
+        """Split (index name, encoded item, origin) triples, encoded elsewhere, into batches"""
+        builders: Dict[str, BulkBodyBuilder] = {}
+
+        for index_name, item, origin in items:
+            builder = builders.get(index_name)
+            if builder is None:
+                builder = builders[index_name] = BulkBodyBuilder(
+                    index_name, self.max_batch_size, self.max_payload_size)
+
+            builder.max_bytes = self.batch_controller.setpoint
+            full = builder.append(item, origin)
+            if full is not None:
+                yield full
+
+        # Yield remaining batches
+        for builder in builders.values():
+            remaining = builder.flush()
+            if remaining is not None:
+                yield remaining
+
+    def _retry_delay(self, attempt: int) -> float:
+        """Full-jitter exponential backoff in seconds"""
+        ceiling = min(self.retry_max_ms, self.retry_base_ms * (2 ** attempt))
+        return random.uniform(0, ceiling) / 1000
+
+    @TRACER.capture('opensearch_bulk_index_batch', 'batch')
+    def _bulk_index_single_batch(self, batch: BulkBatch, batch_num: int = 0,
+                                 budget: Optional[RetryBudget] = None) -> Dict:
+        """Index a single pre-encoded batch, retrying only the items that need it
+
+        Items rejected with 429/5xx are re-submitted with jittered exponential backoff while
+        the invocation's retry budget lasts. A 413 splits the request in half. Items that can
+        never succeed (mapping errors, single documents over the size limit) go to the spill sink;
+        when it cannot take them they are logged and dropped, since replaying their source
+        record would only be rejected again. Neither counts towards `failed_origins`.
+        The returned `items` line up with the batch's items, one final result per document.
+        """
+        if not batch.items:
             return {"took": 0, "errors": False, "items": []}
 
-        try:
-            bulk_body = []
-            current_date = datetime.now().strftime('%Y.%m.%d')
-            index_name = f"{__standard_index__}-{current_date}"
-
-            for doc in documents:
-                # Normalize document before indexing
-                normalized_doc = self._normalize_document(doc)
-
-                index_action = {
-                    "index": {
-                        "_index": index_name,
-                        "_id": normalized_doc.get('@id')
-                    }
-                }
-
-                if not index_action["index"]["_id"]:
-                    del index_action["index"]["_id"]
+        if budget is None:
+            budget = RetryBudget(self.retry_budget)
 
-                bulk_body.extend([
-                    json.dumps(index_action),
-                    json.dumps(normalized_doc)
-                ])
+        batch_start = time.perf_counter()
+        results: List[Optional[Dict]] = [None] * len(batch)
+        rejected: List[int] = []
+        rejections: Dict[int, int] = {}
+        stats = {"took": 0, "retried": 0, "splits": 0, "raw_bytes": 0, "wire_bytes": 0, "cpu_ms": 0.0}
+        pending = [(list(range(len(batch))), 0)]
 
-            bulk_request = "\n".join(bulk_body) + "\n"
-            payload_size_mb = len(bulk_request.encode('utf-8')) / 1024 / 1024
+        try:
+            while pending:
+                positions, attempt = pending.pop()
+                body = batch.body() if len(positions) == len(batch) else b''.join(batch.items[p] for p in positions)
 
-            print(f"Batch {batch_num}: {len(documents)} docs, {payload_size_mb:.2f}MB -> {index_name}")
+                try:
+                    response = self._make_request('POST', '_bulk', data=body, compress=True)
+                except Exception as e:
+                    if _is_request_too_large(e):
+                        if len(positions) == 1:
+                            results[positions[0]] = {"index": {"status": 413, "error": {"type": "request_too_large", "reason": str(e)}}}
+                            rejected.append(positions[0])
+                        else:
+                            middle = len(positions) // 2
+                            pending.append((positions[middle:], attempt))
+                            pending.append((positions[:middle], attempt))
+                            stats["splits"] += 1
+                        continue
 
-            response = self._make_request('POST', '_bulk', data=bulk_request)
-            result = response.json()
+                    if all(result is None for result in results) and len(positions) == len(batch):
+                        raise
 
-            if result.get('errors', False):
-                failed_items = [item for item in result.get('items', [])
-                              if item.get('index', {}).get('status', 200) >= 400]
-                if failed_items:
-                    error_summary = f"Batch {batch_num} errors: {len(failed_items)}/{len(documents)} failures"
-                    print(f"{error_summary}. Sample failures: {json.dumps(failed_items[:2], indent=2)}")
+                    # A retry round failed outright; keep what earlier rounds achieved
+                    print(f"Batch {batch_num} retry round failed for {len(positions)} docs: {str(e)}")
+                    for position in positions:
+                        results[position] = {"index": {"status": 503, "error": {"type": "request_failed", "reason": str(e)}}}
+                    rejections[503] = rejections.get(503, 0) + len(positions)
+                    continue
 
-            return result
+                result = response.json()
+                stats["took"] += result.get('took', 0)
+                compression = getattr(response, 'compression', None)
+                if compression:
+                    stats["raw_bytes"] += compression['raw_bytes']
+                    stats["wire_bytes"] += compression['wire_bytes']
+                    stats["cpu_ms"] += compression['cpu_ms']
+
+                retry_positions = []
+                for position, item in zip(positions, result.get('items', [])):
+                    results[position] = item
+                    status = next(iter(item.values()), {}).get('status', 200)
+                    if status >= 400:
+                        rejections[status] = rejections.get(status, 0) + 1
+                    if status in RETRIABLE_ITEM_STATUSES:
+                        retry_positions.append(position)
+                    elif status >= 400:
+                        rejected.append(position)
+
+                if retry_positions and attempt + 1 < self.item_retry_attempts:
+                    granted = budget.take(len(retry_positions))
+                    if granted:
+                        delay = self._retry_delay(attempt)
+                        print(f"Batch {batch_num}: retrying {granted}/{len(retry_positions)} rejected docs "
+                              f"in {delay * 1000:.0f}ms (attempt {attempt + 2}/{self.item_retry_attempts})")
+                        time.sleep(delay)
+                        pending.append((retry_positions[:granted], attempt + 1))
+                        stats["retried"] += granted
 
         except Exception as e:
             print(f"Error in batch {batch_num}: {str(e)}")
             raise
 
-    @xray_recorder.capture('opensearch_bulk_index')
-    def bulk_index(self, documents: List[Dict]) -> Dict:
-        """Index documents with intelligent batching"""
-        if not documents:
-            return {"took": 0, "errors": False, "items": []}
-
-        total_docs = len(documents)
-        print(f"Starting bulk index of {total_docs} documents with batching")
+        spilled = 0
+        dropped = 0
+        if rejected:
+            rejected.sort()
+            reasons = {}
+            for position in rejected:
+                error = next(iter(results[position].values()), {}).get('error', {})
+                error_type = error.get('type', 'unknown') if isinstance(error, dict) else str(error)
+                reasons[error_type] = reasons.get(error_type, 0) + 1
+            print(f"Batch {batch_num}: {len(rejected)} docs rejected permanently: {reasons}. "
+                  f"Sample: {json.dumps(results[rejected[0]])[:1000]}")
+            if self.spill_sink.write([batch.items[p] for p in rejected], 'rejected',
+                                     {'error-types': ','.join(sorted(reasons))[:512]}):
+                spilled = len(rejected)
+            else:
+                dropped = len(rejected)
+                print(f"Batch {batch_num}: dropped {dropped} permanently rejected docs that could not be spilled")
+
+        failed = [result for result in results
+                  if result is None or next(iter(result.values()), {}).get('status', 200) >= 400]
+
+        payload_size_mb = batch.size / 1024 / 1024
+        detail = f"{len(failed)} failed, {stats['retried']} retried, {spilled} spilled, {dropped} dropped"
+        if stats["wire_bytes"]:
+            ratio = round(stats["raw_bytes"] / stats["wire_bytes"], 2)
+            print(f"Batch {batch_num}: {len(batch)} docs, {payload_size_mb:.2f}MB "
+                  f"-> {stats['wire_bytes']/1024/1024:.2f}MB gzip "
+                  f"(ratio {ratio}x, {stats['cpu_ms']:.1f}ms CPU) -> {batch.index_name}, {detail}")
+        else:
+            print(f"Batch {batch_num}: {len(batch)} docs, {payload_size_mb:.2f}MB -> {batch.index_name}, {detail}")
+
+        permanent = set(rejected)
+        failed_origins = {batch.origins[position] for position, result in enumerate(results)
+                          if position not in permanent and
+                          (result is None or next(iter(result.values()), {}).get('status', 200) >= 400)}
+        failed_origins.discard(None)
+
+        summary = {
+            "took": stats["took"],
+            "errors": bool(failed),
+            "failed_origins": failed_origins,
+            "items": [result if result is not None else {"index": {"status": 500}} for result in results],
+            "retried_items": stats["retried"],
+            "spilled_items": spilled,
+            "dropped_items": dropped,
+            "splits": stats["splits"],
+            "rejections": rejections,
+            "latency_ms": round((time.perf_counter() - batch_start) * 1000, 2)
+        }
+        if stats["wire_bytes"]:
+            summary["compression"] = {
+                "raw_bytes": stats["raw_bytes"],
+                "wire_bytes": stats["wire_bytes"],
+                "ratio": round(stats["raw_bytes"] / stats["wire_bytes"], 2),
+                "cpu_ms": round(stats["cpu_ms"], 2)
+            }
+        return summary
 
-        # Tracking variables
-        successful_batches = 0
-        failed_batches = 0
-        total_indexed = 0
-        total_errors = 0
+    def _cluster_health(self) -> Optional[str]:
+        """Cluster health status, or None when the domain cannot be reached
 
+        Deliberately a single short request outside the tenacity retries so that probing a
+        failing domain stays cheap.
+        """
         try:
-            # Process in batches
-            for batch_num, batch in enumerate(self._create_batches(documents), 1):
-                try:
-                    result = self._bulk_index_single_batch(batch, batch_num)
+            self._refresh_auth_if_needed()
+            response = self.session.get(f"https://{self.domain}/_cluster/health",
+                                        auth=self.auth, timeout=5)
+            response.raise_for_status()
+            return response.json().get('status')
+        except Exception as e:
+            print(f"Cluster health check failed: {str(e)}")
+            return None
+
+    def _spill_batch(self, batch: BulkBatch, batch_num: int = 0) -> Dict:
+        """Write a batch to S3 while the breaker is open, in place of sending it to _bulk
+
+        The spilled NDJSON is the exact request body, so POSTing it to _bulk replays the batch.
+        When the write fails the batch is reported failed and its records are retried.
+        """
+        batch_start = time.perf_counter()
+        origins = [origin for origin in batch.origins if origin is not None]
+        metadata = {'index': batch.index_name, 'breaker-state': self.breaker.state}
+        if origins:
+            metadata['origin-first'] = min(origins)
+            metadata['origin-last'] = max(origins)
+        key = self.spill_sink.write(batch.items, 'breaker', metadata)
+        if key:
+            print(f"Batch {batch_num}: {len(batch)} docs spilled to s3://{self.spill_sink.bucket}/{key} "
+                  f"(circuit breaker open)")
+        else:
+            print(f"Batch {batch_num}: circuit breaker open and spill failed, {len(batch)} docs will be retried")
+        return {
+            "took": 0,
+            "errors": not key,
+            "failed_origins": set() if key else set(origins),
+            "items": [] if key else [{"index": {"status": 503}}] * len(batch),
+            "spilled_items": len(batch) if key else 0,
+            "breaker_spilled": True,
+            "latency_ms": round((time.perf_counter() - batch_start) * 1000, 2)
+        }
 
-                    if result.get('errors', False):
-                        error_count = sum(1 for item in result.get('items', [])
-                                        if item.get('index', {}).get('status', 200) >= 400)
-                        total_errors += error_count
+    def _submit_traced(self, fn, *args) -> Future:
+        """Run fn on the bulk executor under the caller's X-Ray trace entity"""
+        if TRACER.level < _TRACE_LEVELS['batch']:
+            return self._executor.submit(fn, *args)
+        entity = xray_recorder.get_trace_entity()
+
+        def run():
+            xray_recorder.set_trace_entity(entity)
+            try:
+                return fn(*args)
+            finally:
+                xray_recorder.clear_trace_entities()
+
+        return self._executor.submit(run)
+
+    def bulk_index(self, documents: Iterable[Dict], origins: Optional[Iterable[str]] = None,
+                   index_prefix: str = __standard_index__) -> Dict:
+        """Index documents with intelligent batching, keeping up to max_in_flight batches on the wire
+
+        When `origins` (one source record id per document) is given, the result carries
+        `failed_origins`: the records with at least one document that was not indexed or spilled.
+        """
+        if origins is None:
+            return self.index_stream(((doc, None) for doc in documents), index_prefix)
+        return self.index_stream(zip(documents, origins), index_prefix)
+
+    def _prefetch(self, batches: Iterator[BulkBatch], timing: Dict) -> Iterator[BulkBatch]:
+        """Cut batches on a producer thread, up to prefetch_batches ahead of the dispatcher
+
+        Parsing, normalizing and encoding then carry on while the dispatcher waits for _bulk
+        responses. The producer records its CPU time and how long it was held up by a full
+        queue; an exception in it is raised here, in the dispatcher.
+        """
+        import queue
+        prepared = queue.Queue(maxsize=self.prefetch_batches)
+        finished = object()
+        stop = threading.Event()
+        entity = xray_recorder.get_trace_entity() if TRACER.level >= _TRACE_LEVELS['batch'] else None
+
+        def produce():
+            if entity is not None:
+                xray_recorder.set_trace_entity(entity)
+            cpu_start = time.thread_time()
+            try:
+                for batch in batches:
+                    blocked_start = time.perf_counter()
+                    while not stop.is_set():
+                        try:
+                            prepared.put(batch, timeout=0.1)
+                            break
+                        except queue.Full:
+                            continue
+                    timing["producer_blocked_ms"] += (time.perf_counter() - blocked_start) * 1000
+                    if stop.is_set():
+                        return
+                prepared.put(finished)
+            except BaseException as e:
+                prepared.put(e)
+            finally:
+                timing["prepare_cpu_ms"] += (time.thread_time() - cpu_start) * 1000
+                if entity is not None:
+                    xray_recorder.clear_trace_entities()
+
+        producer = threading.Thread(target=produce, name='opensearch-prepare', daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = prepared.get()
+                if item is finished:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            while producer.is_alive():
+                # Unblock a producer stuck handing over its last item
+                with contextlib.suppress(queue.Empty):
+                    prepared.get(timeout=0.1)
+            producer.join()
+
+    @TRACER.capture('opensearch_bulk_index', 'invocation')
+    def index_stream(self, entries: Iterable[Tuple[Any, ...]], index_prefix: str = __standard_index__,
+                     encoded: bool = False) -> Dict:
+        """Index (document, origin) pairs as they are produced
+
+        With encoded=True entries are (index name, NDJSON item, origin) triples that were
+        normalized and encoded already, such as the output of ParseWorkers.
+
+        Entries are pulled only when the next batch is cut, so a generator that decodes and
+        parses records lazily runs interleaved with the batches already on the wire, and
+        memory is bounded by the open, prefetched and in-flight batches instead of the whole
+        input. The summary's `timing` splits the wall time into preparation CPU and waits.
+        """
+        total_docs = 0
+        started = time.perf_counter()
+        timing = {"prepare_cpu_ms": 0.0, "batch_wait_ms": 0.0, "response_wait_ms": 0.0, "producer_blocked_ms": 0.0}
+        print(f"Starting bulk index with batching (max {self.max_in_flight} in flight, "
+              f"{self.prefetch_batches} prefetched)")
 
-                        # If more than 50% of batch failed, consider it a failed batch
-                        if error_count > len(batch) * 0.5:
-                            failed_batches += 1
-                        else:
-                            successful_batches += 1
+        # Tracking variables
+        summary = {
+            "took": 0,
+            "successful_batches": 0,
+            "failed_batches": 0,
+            "total_indexed": 0,
+            "total_errors": 0,
+            "retried_documents": 0,
+            "spilled_documents": 0,
+            "dropped_documents": 0,
+            "raw_bytes": 0,
+            "wire_bytes": 0,
+            "compression_cpu_ms": 0.0,
+            "breaker_spilled_batches": 0
+        }
+        budget = RetryBudget(self.retry_budget)
+        failed_origins = set()
+
+        def account(batch_num: int, batch: BulkBatch, future: Future) -> None:
+            try:
+                result = future.result()
+
+                if result.get('breaker_spilled'):
+                    METRICS.add('BreakerSpilledItems', result['spilled_items'])
+                    summary["spilled_documents"] += result['spilled_items']
+                    failed_origins.update(result['failed_origins'])
+                    if result['errors']:
+                        summary["failed_batches"] += 1
+                    else:
+                        summary["breaker_spilled_batches"] += 1
+                    return
+
+                METRICS.observe('BulkLatency', result.get('latency_ms', 0))
+                METRICS.add('BytesOut', batch.size, 'Bytes')
+                METRICS.add('RetriedItems', result.get('retried_items', 0))
+                METRICS.add('SpilledItems', result.get('spilled_items', 0))
+                METRICS.add('DroppedItems', result.get('dropped_items', 0))
+                for status, count in result.get('rejections', {}).items():
+                    METRICS.add(f'RejectedItems{status}', count)
+                self.batch_controller.observe(result.get('latency_ms', 0), result.get('took', 0),
+                                              throttled=any(status in RETRIABLE_ITEM_STATUSES
+                                                            for status in result.get('rejections', {})),
+                                              failed=result.get('splits', 0) > 0)
+
+                summary["took"] += result.get('took', 0)
+                compression = result.get('compression')
+                if compression:
+                    summary["raw_bytes"] += compression['raw_bytes']
+                    summary["wire_bytes"] += compression['wire_bytes']
+                    summary["compression_cpu_ms"] += compression['cpu_ms']
+                summary["retried_documents"] += result.get('retried_items', 0)
+                summary["spilled_documents"] += result.get('spilled_items', 0)
+                summary["dropped_documents"] += result.get('dropped_items', 0)
+                failed_origins.update(result.get('failed_origins', ()))
+
+                error_count = 0
+                if result.get('errors', False):
+                    error_count = sum(1 for item in result.get('items', [])
+                                    if item.get('index', {}).get('status', 200) >= 400)
+                    summary["total_errors"] += error_count
+
+                    # If more than 50% of batch failed, consider it a failed batch
+                    if error_count > len(batch) * 0.5:
+                        summary["failed_batches"] += 1
+                        self.breaker.record_failure()
                     else:
-                        successful_batches += 1
+                        summary["successful_batches"] += 1
+                        self.breaker.record_success()
+                else:
+                    summary["successful_batches"] += 1
+                    self.breaker.record_success()
+
+                summary["total_indexed"] += len(batch) - error_count
+
+            except Exception as e:
+                print(f"Batch {batch_num} completely failed: {str(e)}")
+                METRICS.add('FailedBatches')
+                self.batch_controller.observe(0, failed=True)
+                self.breaker.record_failure()
+                summary["failed_batches"] += 1
+                failed_origins.update(origin for origin in batch.origins if origin is not None)
+                # Continue with next batch instead of failing entirely
+
+        in_flight = {}
+        batches = self._cut_batches(entries) if encoded else self._create_batches(entries, index_prefix)
+        if self.prefetch_batches:
+            batches = self._prefetch(batches, timing)
+        try:
+            # Dispatch batches as they are cut, bounded by the in-flight limit
+            batch_num = 0
+            while True:
+                wait_start, cpu_start = time.perf_counter(), time.thread_time()
+                batch = next(batches, None)
+                timing["batch_wait_ms"] += (time.perf_counter() - wait_start) * 1000
+                if not self.prefetch_batches:
+                    timing["prepare_cpu_ms"] += (time.thread_time() - cpu_start) * 1000
+                if batch is None:
+                    break
+                batch_num += 1
+                total_docs += len(batch)
+
+                if len(in_flight) >= self.max_in_flight:
+                    wait_start = time.perf_counter()
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    timing["response_wait_ms"] += (time.perf_counter() - wait_start) * 1000
+                    for future in done:
+                        account(*in_flight.pop(future), future)
+
+                # Half-open: hold this batch until the trial batch in flight succeeds or fails
+                while in_flight and self.breaker.trial_pending():
+                    wait_start = time.perf_counter()
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    timing["response_wait_ms"] += (time.perf_counter() - wait_start) * 1000
+                    for future in done:
+                        account(*in_flight.pop(future), future)
+                if not in_flight and self.breaker.trial_pending():
+                    self.breaker.release_trial()
+
+                if self.breaker.allow_request():
+                    future = self._submit_traced(self._bulk_index_single_batch, batch, batch_num, budget)
+                else:
+                    future = self._submit_traced(self._spill_batch, batch, batch_num)
+                in_flight[future] = (batch_num, batch)
 
-                    total_indexed += len(batch)
+            wait_start = time.perf_counter()
+            for future in as_completed(list(in_flight)):
+                account(*in_flight.pop(future), future)
+            timing["response_wait_ms"] += (time.perf_counter() - wait_start) * 1000
 
-                except Exception as e:
-                    print(f"Batch {batch_num} completely failed: {str(e)}")
-                    failed_batches += 1
-                    # Continue with next batch instead of failing entirely
+            if not total_docs:
+                return {"took": 0, "errors": False, "items": []}
 
             # Summary
-            print(f"Bulk index complete: {total_indexed}/{total_docs} docs, "
-                  f"{successful_batches} successful batches, {failed_batches} failed batches, "
-                  f"{total_errors} document errors")
+            print(f"Bulk index complete: {summary['total_indexed']}/{total_docs} docs, "
+                  f"{summary['successful_batches']} successful batches, {summary['failed_batches']} failed batches, "
+                  f"{summary['total_errors']} document errors, {summary['retried_documents']} retried, "
+                  f"{summary['spilled_documents']} spilled, {summary['dropped_documents']} dropped")
+
+            batch_summary = {
+                "total_documents": total_docs,
+                "indexed_documents": summary["total_indexed"],
+                "successful_batches": summary["successful_batches"],
+                "failed_batches": summary["failed_batches"],
+                "document_errors": summary["total_errors"],
+                "retried_documents": summary["retried_documents"],
+                "spilled_documents": summary["spilled_documents"],
+                "dropped_documents": summary["dropped_documents"],
+                "retry_budget_remaining": budget.remaining,
+                "breaker_state": self.breaker.state,
+                "breaker_spilled_batches": summary["breaker_spilled_batches"],
+                "batch_bytes_setpoint": self.batch_controller.setpoint
+            }
+            METRICS.set('BatchBytesSetpoint', self.batch_controller.setpoint, 'Bytes')
+            METRICS.set('BreakerOpen', int(self.breaker.state == 'open'))
+            batch_summary["timing"] = {name: round(value, 2) for name, value in timing.items()}
+            batch_summary["timing"]["wall_ms"] = round((time.perf_counter() - started) * 1000, 2)
+            METRICS.add('PrepareCpuTime', timing["prepare_cpu_ms"], 'Milliseconds')
+            METRICS.add('ResponseWaitTime', timing["response_wait_ms"], 'Milliseconds')
+            if summary["wire_bytes"]:
+                batch_summary["compression"] = {
+                    "raw_bytes": summary["raw_bytes"],
+                    "wire_bytes": summary["wire_bytes"],
+                    "ratio": round(summary["raw_bytes"] / summary["wire_bytes"], 2),
+                    "cpu_ms": round(summary["compression_cpu_ms"], 2)
+                }
 
             # Return summary result
             return {
-                "took": 0,
-                "errors": total_errors > 0,
+                "took": summary["took"],
+                "errors": summary["total_errors"] > 0,
                 "items": [],
-                "batch_summary": {
-                    "total_documents": total_docs,
-                    "indexed_documents": total_indexed,
-                    "successful_batches": successful_batches,
-                    "failed_batches": failed_batches,
-                    "document_errors": total_errors
-                }
+                "batch_summary": batch_summary,
+                "failed_origins": failed_origins
             }
 
         except Exception as e:
             print(f"Error in bulk_index: {str(e)}")
             raise
-
-@xray_recorder.capture('kinisis_record_processing')
+        finally:
+            # Never leave a producer or batches running into the next invocation
+            if self.prefetch_batches:
+                batches.close()
+            if in_flight:
+                wait(in_flight)
+
+# Reused across warm invocations of the same execution environment
+_opensearch_manager: Optional[OpenSearchManager] = None
+
+def get_opensearch_manager() -> OpenSearchManager:
+    """Return the container-scoped OpenSearchManager, creating it on cold start"""
+    global _opensearch_manager
+    if _opensearch_manager is None:
+        _opensearch_manager = OpenSearchManager()
+    return _opensearch_manager
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+def decode_record_data(data: Union[str, bytes]) -> bytes:
+    """Base64 record data to bytes; a2b_base64 reads the ASCII str without an encoded copy"""
+    return binascii.a2b_base64(data)
+
+def inflate_gzip(raw: bytes) -> bytes:
+    """Gunzip a whole record in one call on a decompressobj, without file object wrappers
+
+    Concatenated gzip members are inflated one after another and zero padding between them is
+    skipped, as gzip.decompress does; data after a member that is not another member, and a
+    truncated record, raise the same BadGzipFile and EOFError it would.
+    """
+    inflater = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    payload = inflater.decompress(raw)
+    while inflater.eof and inflater.unused_data:
+        remaining = inflater.unused_data.lstrip(b'\x00')
+        if not remaining:
+            break
+        if remaining[:2] != GZIP_MAGIC:
+            raise gzip.BadGzipFile(f"Not a gzipped file ({remaining[:2]!r})")
+        inflater = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        payload += inflater.decompress(remaining)
+    if not inflater.eof:
+        raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+    return payload
+
+@TRACER.capture('kinisis_record_processing', 'call')
 def process_kinesis_record(record: Dict) -> List[Dict]:
     """Process a record from Kinesis Stream"""
+    parse_start = time.perf_counter()
     try:
         # Decode kinesis data
-        payload = base64.b64decode(record['kinesis']['data'])
-        print(f"Decoded payload size: {len(payload)} bytes")
-
-        # Handle CloudWatch Logs compressed format
-        if 'kinesisSchemaVersion' in record['kinesis']:
-            compressed_payload = BytesIO(payload)
-            with gzip.GzipFile(fileobj=compressed_payload, mode='r') as gz:
-                payload = gz.read()
-                # print(f"Decompressed data size: {len(payload)} bytes")
-
-        # Parse the JSON payload
-        log_event = json.loads(payload.decode('utf-8'))
+        payload = decode_record_data(record['kinesis']['data'])
+        if DEBUG_LOGGING:
+            print(f"Decoded payload size: {len(payload)} bytes")
+
+        # Handle CloudWatch Logs compressed format; re-ingested documents arrive as plain JSON
+        if 'kinesisSchemaVersion' in record['kinesis'] and payload[:2] == GZIP_MAGIC:
+            payload = inflate_gzip(payload)
+        METRICS.add('BytesIn', len(payload), 'Bytes')
+
+        # Parse the JSON payload straight from the bytes; orjson never builds a str of it
+        log_event = JSON_CODEC.loads(payload)
         processor = CloudWatchLogProcessor()
 
         if 'logEvents' in log_event:
@@ -624,82 +2232,642 @@ def process_kinesis_record(record: Dict) -> List[Dict]:
         else:
             # Handle direct JSON records
             return [{
-                '@timestamp': datetime.utcnow().isoformat(),
+                '@timestamp': datetime.now(timezone.utc).isoformat(),
                 **log_event
             }]
     except Exception as e:
         print(f"Error processing Kinesis record: {str(e)}")
+        METRICS.add('RecordErrors')
         return []
+    finally:
+        METRICS.add('ParseTime', (time.perf_counter() - parse_start) * 1000, 'Milliseconds')
+
+def stream_kinesis_documents(records: List[Dict], rollup: Optional[MetricRollup] = None,
+                             counts: Optional[Dict] = None) -> Iterator[Tuple[Dict, str]]:
+    """Decode and parse Kinesis records one at a time, yielding (document, sequence number)
+
+    Nothing runs until the consumer asks for the next document, so records are decoded as
+    batches are cut rather than all up front. Correlation needs every lifecycle line of the
+    event at once; with CORRELATE_INVOCATIONS the documents are collected first. Documents
+    are folded into `rollup` as they pass, and `counts` tallies them.
+    """
+    entries = ((doc, record['kinesis']['sequenceNumber'])
+               for record in records for doc in process_kinesis_record(record))
+    if CORRELATE_INVOCATIONS:
+        pairs = list(entries)
+        documents, origins = correlate_invocations([doc for doc, _ in pairs], [origin for _, origin in pairs])
+        entries = zip(documents, origins)
+
+    for doc, sequence in entries:
+        if counts is not None:
+            counts['documents'] += 1
+        if rollup is not None:
+            rollup.add(doc)
+        yield doc, sequence
+
+def _parse_worker(conn, index_prefix: str) -> None:
+    """Parse worker process: Kinesis records in, encoded bulk items out, until None arrives
+
+    Each worker keeps its own normalizer for its lifetime, and asks the parent's field budget
+    about paths it has not seen. Documents that feed metric rollups travel back as dicts so
+    that the parent can fold them in.
+    """
+    # Forked from a process whose threads may have held these locks
+    METRICS._lock = threading.Lock()
+    TRACER._lock = threading.Lock()
+    TRACER.granularity = TRACER.level = _TRACE_LEVELS['off']
+
+    normalize = DocumentNormalizer(OpenSearchManager._index_template())
+    field_budget = WorkerFieldBudget(conn)
+    builders: Dict[str, BulkBodyBuilder] = {}
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        if message is None:
+            return
+
+        chunk_id, records = message
+        METRICS.start('worker')
+        today = datetime.now(timezone.utc).strftime('%Y.%m.%d')
+        if len(builders) > FIELD_BUDGET_TRACKED_INDICES:
+            builders.clear()
+        items, reports = [], []
+        for record in records:
+            sequence = record['kinesis']['sequenceNumber']
+            for doc in process_kinesis_record(record):
+                if METRIC_ROLLUPS and doc.get('event_type') in _ROLLUP_EVENT_TYPES:
+                    reports.append(dict(doc))
+                index_name = f"{index_prefix}-{_event_date(doc.get('@timestamp'), today)}"
+                builder = builders.get(index_name)
+                if builder is None:
+                    builder = builders[index_name] = BulkBodyBuilder(
+                        index_name, 0, 0, normalize=normalize, field_budget=field_budget)
+                items.append((index_name, builder.encode(doc), sequence))
+        conn.send(('chunk', chunk_id, items, reports, METRICS.snapshot()))
+
+class ParseWorkers:
+    """Decode, parse, normalize and encode Kinesis records on worker processes
+
+    Lambda has no /dev/shm, so there is no multiprocessing.Pool or Queue: each worker is a
+    forked Process with its own Pipe. Records are cut into chunks, a few per worker, and a
+    worker gets its next chunk as soon as it returns the previous one, which keeps the
+    slower workers from holding up the rest and never leaves both ends of a pipe writing.
+    Encoded items are yielded as chunks come back, ready for index_stream(encoded=True).
+    Workers ask for field budget decisions on the same pipe, and stream() answers them from
+    the one budget it is given while it waits for chunks; a worker that asks while the caller
+    is busy with the items already yielded stalls until the generator is resumed.
+
+    Experimental: scaling has only been measured on a single vCPU, where two workers parse
+    slower than the handler process does, so PARSE_WORKERS stays at 1 by default.
+    """
+
+    def __init__(self, count: int, index_prefix: str = __standard_index__):
+        import multiprocessing
+        context = multiprocessing.get_context('fork')
+        self.count = count
+        self._workers = []
+        for number in range(count):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=_parse_worker, args=(child_conn, index_prefix),
+                                      name=f'parse-worker-{number}', daemon=True)
+            process.start()
+            child_conn.close()
+            self._workers.append((process, parent_conn))
+        print(f"Started {count} parse workers")
+
+    def alive(self) -> bool:
+        return all(process.is_alive() for process, _ in self._workers)
+
+    def close(self) -> None:
+        for process, conn in self._workers:
+            with contextlib.suppress(OSError):
+                conn.send(None)
+            conn.close()
+            process.join(timeout=1)
+
+    def stream(self, records: List[Dict], rollup: Optional[MetricRollup] = None,
+               counts: Optional[Dict] = None,
+               field_budget: Optional[FieldBudget] = None) -> Iterator[Tuple[str, bytes, str]]:
+        """Yield (index name, NDJSON item, sequence number) for every document of the records"""
+        import multiprocessing.connection
+        chunk_size = max(1, math.ceil(len(records) / (self.count * PARSE_CHUNKS_PER_WORKER)))
+        pending = [(start, records[start:start + chunk_size]) for start in range(0, len(records), chunk_size)]
+        pending.reverse()
+        busy = set()
+        if field_budget is None:
+            field_budget = FieldBudget()
+
+        def feed(conn) -> None:
+            if pending:
+                conn.send(pending.pop())
+                busy.add(conn)
+
+        def receive(conn) -> Optional[Tuple]:
+            """The worker's chunk result, or None after answering a field budget request"""
+            try:
+                message = conn.recv()
+            except EOFError:
+                raise RuntimeError("Parse worker exited unexpectedly")
+            if message[0] == 'budget':
+                conn.send(field_budget.admit(*message[1:]))
+                return None
+            return message
+
+        try:
+            for _, conn in self._workers:
+                feed(conn)
+            while busy:
+                for conn in multiprocessing.connection.wait(list(busy)):
+                    message = receive(conn)
+                    if message is None:
+                        continue
+                    _, _, items, reports, metrics = message
+                    busy.discard(conn)
+                    feed(conn)
+
+                    METRICS.merge(metrics)
+                    if rollup is not None:
+                        for doc in reports:
+                            rollup.add(doc)
+                    for entry in items:
+                        if counts is not None:
+                            counts['documents'] += 1
+                        yield entry
+        finally:
+            # Leave every pipe empty for the next invocation
+            for conn in busy:
+                with contextlib.suppress(RuntimeError, OSError):
+                    while receive(conn) is None:
+                        pass
+
+# Started on first use, before the bulk executor has threads to carry into the fork
+_parse_workers: Optional[ParseWorkers] = None
+# Set once forking is refused; the container parses in-process from then on
+_parse_workers_held_back = False
+
+def get_parse_workers() -> Optional[ParseWorkers]:
+    """Return the container-scoped parse workers, or None when parsing stays in-process
+
+    The pool is only forked from a process whose main thread is its only thread. A fork copies
+    just the calling thread, so a lock held at that moment by the bulk executor, a prefetch
+    producer or the X-Ray emitter would stay locked in every worker. Once those threads exist
+    a dead pool is not restarted and parsing moves back into the handler process.
+    """
+    global _parse_workers, _parse_workers_held_back
+    if PARSE_WORKERS == 'auto':
+        count = os.cpu_count() or 1
+    else:
+        count = int(PARSE_WORKERS)
+    if count < 2 or _parse_workers_held_back:
+        return None
+    if _parse_workers is not None and not _parse_workers.alive():
+        print("A parse worker died, closing the pool")
+        _parse_workers.close()
+        _parse_workers = None
+    if _parse_workers is None:
+        threads = [thread.name for thread in threading.enumerate() if thread is not threading.main_thread()]
+        if threads:
+            print(f"Not forking parse workers with other threads running ({', '.join(threads)}); "
+                  f"parsing in the handler process from now on")
+            _parse_workers_held_back = True
+            return None
+        _parse_workers = ParseWorkers(count)
+    return _parse_workers
+
+class RateLimiter:
+    """Pace calls so that at most `rate` units go out per second; 0 disables pacing"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._next = time.monotonic()
+
+    def acquire(self, units: int) -> None:
+        """Wait until units more may be sent"""
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        if self._next > now:
+            time.sleep(self._next - now)
+        self._next = max(now, self._next) + units / self.rate
+
+def _spill_reingest_leftovers(spill_sink: Optional[SpillSink], record_id: str, documents: List[bytes]) -> bool:
+    """Spill the documents of a partly re-ingested record as _bulk items, so each is indexed once"""
+    if spill_sink is None:
+        return False
+    today = datetime.now(timezone.utc).strftime('%Y.%m.%d')
+    items = []
+    for data in documents:
+        doc = JSON_CODEC.loads(data)
+        index_name = f"{__standard_index__}-{_event_date(doc.get('@timestamp'), today)}"
+        items.append(BulkBodyBuilder(index_name, 0, 0).encode(doc))
+    return spill_sink.write(items, 'reingest', {'firehose-record-id': record_id[:512]}) is not None
+
+def _reingest_documents(event: Dict, documents: Dict[str, List[bytes]],
+                        spill_sink: Optional[SpillSink] = None) -> set:
+    """Put transformed documents back on the delivery stream's source, one record per document
+
+    Firehose can only return one output record per input record, and the OpenSearch destination
+    indexes one document per record. Payloads that expand into several documents, or that would
+    push the response past 6 MB, are re-ingested here and come back through the transform as
+    already-transformed records. `documents` maps each source recordId to its documents.
+
+    This amplifies writes: a payload of N log lines puts N-1 records on the stream, which
+    Firehose reads and transforms a second time. Calls are paced to
+    FIREHOSE_REINGEST_RECORDS_PER_SECOND to leave room under the 1000 records/s per-shard
+    limit, and at most FIREHOSE_REINGEST_MAX_DOCUMENTS go out per invocation.
+
+    Re-ingest is all-or-nothing per source record. All of a record's documents go in one
+    call, and a record that does not fit in one call or under the cap is not re-ingested at
+    all. Entries the stream rejects are retried; when some of a record's documents are on
+    the stream and the rest still fail, the rest are spilled to S3 instead. Returns the
+    recordIds to mark ProcessingFailed: those with nothing re-ingested, whose whole source
+    record then goes to the error prefix without duplicating any document.
+    """
+    if not documents:
+        return set()
+
+    # The delivery stream reads from Kinesis (kinesis_source_configuration); the Lambda role may
+    # only kinesis:PutRecords, so there is no direct-PUT path to write back to
+    stream_arn = event.get('sourceKinesisStreamArn')
+    if not stream_arn:
+        print(f"No source Kinesis stream to re-ingest to, leaving {len(documents)} records to the error output")
+        return set(documents)
+
+    import boto3
+    import uuid
+    client = boto3.client('kinesis')
+
+    def put(entries: List[bytes]) -> List[int]:
+        """Send entries in one call, returning the positions the stream rejected"""
+        response = client.put_records(
+            StreamARN=stream_arn,
+            Records=[{'Data': data, 'PartitionKey': uuid.uuid4().hex} for data in entries]
+        )
+        return [position for position, result in enumerate(response['Records']) if result.get('ErrorCode')]
+
+    # Pack whole records into calls; a record never spans two calls
+    failed_record_ids = set()
+    calls: List[List[str]] = []
+    call, call_records, call_bytes = [], 0, 0
+    remaining = FIREHOSE_REINGEST_MAX_DOCUMENTS
+    for record_id, docs in documents.items():
+        size = sum(len(doc) for doc in docs)
+        if (len(docs) > FIREHOSE_REINGEST_BATCH_RECORDS or size > FIREHOSE_REINGEST_BATCH_BYTES
+                or len(docs) > remaining):
+            failed_record_ids.add(record_id)
+            continue
+        remaining -= len(docs)
+        if call and (call_records + len(docs) > FIREHOSE_REINGEST_BATCH_RECORDS or
+                     call_bytes + size > FIREHOSE_REINGEST_BATCH_BYTES):
+            calls.append(call)
+            call, call_records, call_bytes = [], 0, 0
+        call.append(record_id)
+        call_records += len(docs)
+        call_bytes += size
+    if call:
+        calls.append(call)
+    if failed_record_ids:
+        print(f"{len(failed_record_ids)} records exceed a single re-ingest call or the per-invocation cap "
+              f"of {FIREHOSE_REINGEST_MAX_DOCUMENTS} documents, leaving them to the error output")
+
+    limiter = RateLimiter(FIREHOSE_REINGEST_RECORDS_PER_SECOND)
+    reingested = spilled = 0
+    for record_ids in calls:
+        pending = [(record_id, position) for record_id in record_ids
+                   for position in range(len(documents[record_id]))]
+        sent = dict.fromkeys(record_ids, 0)
+        for attempt in range(FIREHOSE_REINGEST_ATTEMPTS):
+            limiter.acquire(len(pending))
+            try:
+                rejected = put([documents[record_id][position] for record_id, position in pending])
+            except Exception as e:
+                print(f"Re-ingest attempt {attempt + 1} failed: {str(e)}")
+                rejected = range(len(pending))
+            rejected = set(rejected)
+            for entry, (record_id, _) in enumerate(pending):
+                if entry not in rejected:
+                    sent[record_id] += 1
+            pending = [pending[entry] for entry in sorted(rejected)]
+            if not pending:
+                break
+            # Mostly ProvisionedThroughputExceeded; back off before the rejected entries go again
+            time.sleep(0.1 * (2 ** attempt))
+
+        leftovers: Dict[str, List[bytes]] = {}
+        for record_id, position in pending:
+            leftovers.setdefault(record_id, []).append(documents[record_id][position])
+        for record_id, docs in leftovers.items():
+            if not sent[record_id]:
+                failed_record_ids.add(record_id)
+            elif _spill_reingest_leftovers(spill_sink, record_id, docs):
+                spilled += len(docs)
+            else:
+                # Nothing left that avoids a duplicate; keep the documents rather than lose them
+                print(f"Record {record_id}: {sent[record_id]} documents re-ingested and {len(docs)} could "
+                      f"neither be re-ingested nor spilled; a replay of its error output duplicates the former")
+                failed_record_ids.add(record_id)
+        reingested += sum(sent.values())
+
+    METRICS.add('ReingestedDocuments', reingested)
+    print(f"Re-ingested {reingested} documents to {stream_arn}, {spilled} spilled, "
+          f"{len(failed_record_ids)} source records failed")
+    return failed_record_ids
+
+def _lifecycle_role(doc: Dict) -> Optional[str]:
+    """Lifecycle line type of a document, including Event Received/Response Body lines parsed as JSON"""
+    event_type = doc.get('event_type')
+    if event_type in _CORRELATED_EVENT_TYPES:
+        return event_type
+    if event_type == 'json':
+        message = doc.get('@message', '')
+        if 'Event Received:' in message:
+            return 'event_received'
+        if 'Response Body:' in message:
+            return 'response_body'
+    return None
+
+def correlate_invocations(documents: List[Dict], origins: Optional[List[Any]] = None
+                          ) -> Tuple[List[Dict], Optional[List[Any]]]:
+    """Merge the lifecycle lines of each Lambda request into one lambda_invocation document
+
+    START, Event Received, Response Body, END and REPORT documents sharing a log group and
+    RequestId are merged when both START and REPORT are in this batch. Requests split across
+    batches keep their individual documents. The merged document takes the place and id of
+    the START line, and the origin of its earliest line so a replay covers every part.
+    """
+    groups: Dict[Tuple[str, str], List[Tuple[int, str]]] = {}
+    for position, doc in enumerate(documents):
+        role = _lifecycle_role(doc)
+        if role is None:
+            continue
+        request_id = doc.get('request_id')
+        if not request_id:
+            match = _LOG_LINE_REQUEST_ID_RE.match(doc.get('@message', ''))
+            if match is None:
+                continue
+            request_id = match.group(1)
+        groups.setdefault((doc.get('@log_group'), request_id), []).append((position, role))
+
+    merged_at: Dict[int, Dict] = {}
+    absorbed = set()
+    for (_, request_id), lines in groups.items():
+        roles = {role for _, role in lines}
+        if 'lambda_start' not in roles or 'lambda_report' not in roles:
+            continue
+
+        positions = [position for position, _ in lines]
+        first = documents[positions[0]]
+        invocation = {}
+        context_fields = {}
+        for position, role in lines:
+            doc = documents[position]
+            if doc['event_type'] == 'json':
+                # Whole-line JSON was spread into the document; nest it like the marker branches do
+                metadata = {key: value for key, value in doc.items() if key.startswith(('@', 'cw_'))}
+                data = {key: value for key, value in doc.items()
+                        if key not in metadata and key not in ('event_type', 'lambda_version')}
+                invocation.update(metadata)
+                if role == 'event_received':
+                    invocation['event_data'] = data
+                else:
+                    invocation['response_data'] = data
+                    invocation.update({
+                        'status': data.get('status'),
+                        'volumeSize': data.get('volumeSize'),
+                        'instanceType': data.get('instanceType')
+                    })
+            else:
+                invocation.update(doc)
+            if role == 'event_received':
+                # Request context captured alongside the event beats whatever a later line carried
+                context_fields = {key: value for key, value in doc.items() if key.startswith('cw_')}
+            elif role == 'lambda_report':
+                invocation['end_timestamp'] = doc['@timestamp']
+        invocation.update(context_fields)
+        invocation.update({
+            '@timestamp': first['@timestamp'],
+            '@id': first['@id'],
+            '@message': '\n'.join(documents[position]['@message'] for position in positions),
+            'event_type': 'lambda_invocation',
+            'request_id': request_id,
+            'lambda_version': __version__,
+            'correlated_lines': len(positions)
+        })
+
+        merged_at[positions[0]] = invocation
+        absorbed.update(positions[1:])
+
+    if not merged_at:
+        return documents, origins
+
+    correlated = []
+    correlated_origins = [] if origins is not None else None
+    for position, doc in enumerate(documents):
+        if position in absorbed:
+            continue
+        correlated.append(merged_at.get(position, doc))
+        if origins is not None:
+            correlated_origins.append(origins[position])
+
+    print(f"Correlated {len(documents) - len(correlated) + len(merged_at)} lifecycle documents "
+          f"into {len(merged_at)} invocations")
+    return correlated, correlated_origins
+
+def index_metric_rollups(opensearch: OpenSearchManager, rollup: MetricRollup) -> None:
+    """Write this invocation's metric rollups; best effort, never fails the invocation"""
+    if not len(rollup):
+        return
+    try:
+        result = opensearch.bulk_index(rollup.documents(), index_prefix=__rollup_index__)
+        print(f"Rollup index result: {result.get('batch_summary', {})}")
+    except Exception as e:
+        print(f"Failed to index {len(rollup)} metric rollups: {str(e)}")
+
+@TRACER.capture('firehose_transform', 'batch')
+def transform_firehose_records(event: Dict, processor: CloudWatchLogProcessor, normalize,
+                               rollup: Optional[MetricRollup] = None,
+                               spill_sink: Optional[SpillSink] = None) -> Tuple[List[Dict], int]:
+    """Transform Firehose records into OpenSearch documents for Firehose to deliver
+
+    Each record becomes `Ok` with its first normalized document as data, `Dropped` when every
+    log line was filtered out, or `ProcessingFailed` when it cannot be decoded. Any further
+    documents are re-ingested so that Firehose delivers exactly one copy of each (see
+    _reingest_documents, which spills to `spill_sink` what it cannot finish). Returns the
+    output records and the number of documents produced. Documents are also folded into
+    `rollup` when one is given.
+    """
+    output_records = []
+    reingest: Dict[str, List[bytes]] = {}
+    response_bytes = 0
+    document_count = 0
+
+    for record in event.get('records', []):
+        record_id = record['recordId']
+        payload = None
+        try:
+            raw = decode_record_data(record['data'])
+            if raw[:2] != GZIP_MAGIC:
+                if raw.lstrip()[:1] != b'{':
+                    raise ValueError("Record is neither gzip CloudWatch Logs data nor a JSON document")
+                # Already transformed and re-ingested by an earlier invocation
+                output = {'recordId': record_id, 'result': 'Ok', 'data': record['data']}
+                response_bytes += len(record['data']) + len(record_id) + 64
+                output_records.append(output)
+                continue
+
+            parse_start = time.perf_counter()
+            raw = inflate_gzip(raw)
+            METRICS.add('BytesIn', len(raw), 'Bytes')
+            payload = JSON_CODEC.loads(raw)
+
+            # Process logs using instance method
+            documents = processor.process_payload(payload)
+            METRICS.add('ParseTime', (time.perf_counter() - parse_start) * 1000, 'Milliseconds')
+            if CORRELATE_INVOCATIONS:
+                documents, _ = correlate_invocations(documents)
+            if not documents:
+                output_records.append({'recordId': record_id, 'result': 'Dropped', 'data': record['data']})
+                continue
+            if rollup is not None:
+                for doc in documents:
+                    rollup.add(doc)
+
+            encoded = [JSON_CODEC.dumps(normalize(doc)) for doc in documents]
+            document_count += len(encoded)
+            data = base64.b64encode(encoded[0]).decode('ascii')
+            record_bytes = len(data) + len(record_id) + 64
+
+            if response_bytes + record_bytes > FIREHOSE_RESPONSE_LIMIT_BYTES:
+                # No room left in the response; every document of this record goes back round
+                output_records.append({'recordId': record_id, 'result': 'Dropped', 'data': record['data']})
+                reingest[record_id] = encoded
+                continue
+
+            response_bytes += record_bytes
+            output_records.append({'recordId': record_id, 'result': 'Ok', 'data': data})
+            if len(encoded) > 1:
+                reingest[record_id] = encoded[1:]
+
+        except Exception as e:
+            print(f"Error processing Firehose record: {str(e)}")
+            METRICS.add('RecordErrors')
+            print(f"Payload snippet: {str(payload)[:200]}")  # Added for debugging
+            output_records.append({
+                'recordId': record_id,
+                'result': 'ProcessingFailed',
+                'data': record['data']
+            })
+
+    failed_record_ids = _reingest_documents(event, reingest, spill_sink)
+    if failed_record_ids:
+        # Let Firehose route the whole source record to the error prefix instead of losing documents
+        original_data = {record['recordId']: record['data'] for record in event['records']}
+        for output in output_records:
+            if output['recordId'] in failed_record_ids:
+                output['result'] = 'ProcessingFailed'
+                output['data'] = original_data[output['recordId']]
+
+    return output_records, document_count
 
-@xray_recorder.capture('lambda_handler')
 def handler(event: Dict, context: Any) -> Dict:
+    METRICS.start('kinesis' if 'Records' in event else 'firehose')
+    try:
+        with TRACER.invocation('lambda_handler'):
+            return _handle(event, context)
+    finally:
+        METRICS.emit()
+
+def _handle(event: Dict, context: Any) -> Dict:
     start_time = datetime.now()
 
     try:
-        opensearch = OpenSearchManager()
-        processed_logs = []
-        output_records = []
+        opensearch = get_opensearch_manager()
 
         # Determine if this is a Kinesis Stream or Firehose event
         if 'Records' in event:
             # Kinesis Stream
             print(f"Processing {len(event['Records'])} Kinesis records")
-            for record in event['Records']:
-                processed_logs.extend(process_kinesis_record(record))
-
-            if processed_logs:
-                result = opensearch.bulk_index(processed_logs)
-                print(f"Bulk index result: {result.get('batch_summary', {})}")
+            METRICS.add('Records', len(event['Records']))
+
+            # Records are decoded, parsed and indexed batch by batch as the stream is consumed
+            counts = {'documents': 0}
+            rollup = MetricRollup() if METRIC_ROLLUPS else None
+            failed_sequences = set()
+            workers = get_parse_workers() if not CORRELATE_INVOCATIONS and len(event['Records']) > 1 else None
+            try:
+                if workers is not None:
+                    result = opensearch.index_stream(workers.stream(event['Records'], rollup, counts,
+                                                                    opensearch.field_budget),
+                                                      encoded=True)
+                else:
+                    result = opensearch.index_stream(stream_kinesis_documents(event['Records'], rollup, counts))
+                if counts['documents']:
+                    print(f"Bulk index result: {result.get('batch_summary', {})}")
+                    METRICS.add('DocumentsIndexed', result.get('batch_summary', {}).get('indexed_documents', 0))
+                    print(f"Field budget: {opensearch.field_budget.report()}")
+                failed_sequences = result.get('failed_origins', set())
+            except Exception as e:
+                # Records the stream had not reached yet were never indexed either
+                print(f"Bulk index failed, reporting every record: {str(e)}")
+                failed_sequences = {record['kinesis']['sequenceNumber'] for record in event['Records']}
+            METRICS.add('DocumentsOut', counts['documents'])
+
+            if rollup is not None:
+                index_metric_rollups(opensearch, rollup)
+
+            # ReportBatchItemFailures: Lambda resumes the shard from the lowest reported sequence
+            # number, so only the first failed record is reported; it and every later one are replayed
+            batch_item_failures = []
+            for position, record in enumerate(event['Records']):
+                if record['kinesis']['sequenceNumber'] in failed_sequences:
+                    batch_item_failures.append({'itemIdentifier': record['kinesis']['sequenceNumber']})
+                    replayed = len(event['Records']) - position
+                    print(f"Reporting Kinesis record {position + 1}/{len(event['Records'])} as failed, "
+                          f"{replayed} records will be replayed")
+                    METRICS.add('FailedRecords', replayed)
+                    break
+            else:
+                METRICS.add('FailedRecords', 0)
 
             return {
                 'statusCode': 200,
-                'body': json.dumps(f'Successfully processed {len(processed_logs)} logs')
+                'body': json.dumps(f'Successfully processed {counts["documents"]} logs'),
+                'batchItemFailures': batch_item_failures
             }
         else:
-            # Kinesis Firehose
+            # Kinesis Firehose: transform only, the delivery stream indexes the documents
             print(f"Processing {len(event.get('records', []))} Firehose records")
+            METRICS.add('Records', len(event.get('records', [])))
             processor = CloudWatchLogProcessor()  # Create processor instance
 
-            for record in event.get('records', []):
-                try:
-                    # Decode and decompress
-                    payload = json.loads(
-                        gzip.decompress(
-                            base64.b64decode(record['data'])
-                        ).decode('utf-8')
-                    )
-
-                    # Process logs using instance method
-                    batch_logs = processor.process_payload(payload)
-                    processed_logs.extend(batch_logs)
-
-                    # Mark as processed
-                    output_records.append({
-                        'recordId': record['recordId'],
-                        'result': 'Ok',
-                        'data': record['data']
-                    })
-
-                except Exception as e:
-                    print(f"Error processing Firehose record: {str(e)}")
-                    print(f"Payload snippet: {str(payload)[:200]}")  # Added for debugging
-                    output_records.append({
-                        'recordId': record['recordId'],
-                        'result': 'ProcessingFailed',
-                        'data': record['data']
-                    })
-
-            # Index processed logs with batching
-            if processed_logs:
-                result = opensearch.bulk_index(processed_logs)
-                print(f"Bulk index result: {result.get('batch_summary', {})}")
+            rollup = MetricRollup() if METRIC_ROLLUPS else None
+            # Firehose picks the index itself; budget fields against the weekly index it rotates to,
+            # so a warm container starts a fresh budget when the delivery stream starts a fresh index
+            budget_key = _firehose_budget_key(datetime.now(timezone.utc))
+
+            def prepare(doc: Dict) -> Dict:
+                return opensearch.field_budget.apply(budget_key, opensearch.normalize(doc))
+
+            output_records, document_count = transform_firehose_records(event, processor, prepare, rollup,
+                                                                        opensearch.spill_sink)
+            if rollup is not None:
+                index_metric_rollups(opensearch, rollup)
+            results = {}
+            for output in output_records:
+                results[output['result']] = results.get(output['result'], 0) + 1
+            print(f"Firehose transform result: {document_count} documents, {results}")
+            METRICS.add('DocumentsOut', document_count)
+            for result, count in results.items():
+                METRICS.add(f'Records{result}', count)
 
             # Print execution duration and stats
             duration_ms = (datetime.now() - start_time).total_seconds() * 1000
             print(f"Execution Stats:")
             print(f"- Duration: {duration_ms:.2f}ms")
             print(f"- Memory Configured: {context.memory_limit_in_mb}MB")
-            print(f"- Logs Processed: {len(processed_logs)}")
+            print(f"- Logs Processed: {document_count}")
             print(f"- Time Remaining: {context.get_remaining_time_in_millis() / 1000:.2f}s")
 
             return {'records': output_records}
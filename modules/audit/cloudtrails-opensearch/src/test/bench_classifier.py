@@ -0,0 +1,174 @@
+# bench_classifier.py
+"""Microbenchmark for CloudWatchLogProcessor line classification and REPORT parsing
+
+Compares the previous substring-chain classifier and split/replace REPORT parser with the
+first-character dispatch and precompiled REPORT parser process_payload uses, on a log mix
+shaped like sBeacon/sVEP Lambda output. Run from the module directory:
+
+    python3 src/test/bench_classifier.py [--lines 200000]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import time
+import uuid
+
+os.environ.setdefault('AWS_XRAY_SDK_ENABLED', 'false')
+os.environ.setdefault('AWS_XRAY_CONTEXT_MISSING', 'IGNORE_ERROR')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from opensearch_handler import _PLATFORM_LINES, CloudWatchLogProcessor  # noqa: E402
+
+
+def legacy_classify(message):
+    """Classifier and REPORT parser as they were before the dispatch table and compiled parser"""
+    source = {}
+    if "START RequestId:" in message:
+        source['event_type'] = 'lambda_start'
+        source['request_id'] = message.split("START RequestId:", 1)[1].strip().split()[0]
+    elif "END RequestId:" in message:
+        source['event_type'] = 'lambda_end'
+        source['request_id'] = message.split("END RequestId:", 1)[1].strip().split()[0]
+    elif "REPORT RequestId:" in message:
+        source['event_type'] = 'lambda_report'
+        for part in message.split('\t'):
+            if "Duration:" in part:
+                try:
+                    source['duration_ms'] = float(part.split(':')[1].strip().replace(" ms", ""))
+                except (ValueError, IndexError):
+                    pass
+            elif "Memory Used:" in part:
+                try:
+                    source['memory_used_mb'] = float(part.split(':')[1].strip().replace(" MB", ""))
+                except (ValueError, IndexError):
+                    pass
+    elif "Event Received:" in message:
+        source['event_type'] = 'event_received'
+    elif "Response Body:" in message:
+        source['event_type'] = 'response_body'
+    return source
+
+
+def compiled_classify(message):
+    """Classifier and REPORT parser used by process_payload"""
+    source = {}
+    platform = _PLATFORM_LINES.get(message[:1])
+    if platform is not None and message.startswith(platform[0]):
+        marker, event_type = platform
+        source['event_type'] = event_type
+        if event_type == 'lambda_report':
+            source.update(CloudWatchLogProcessor.parse_report(message, len(marker)))
+        else:
+            request_id = message[len(marker):].split(None, 1)
+            source['request_id'] = request_id[0] if request_id else None
+    elif "Event Received:" in message:
+        source['event_type'] = 'event_received'
+    elif "Response Body:" in message:
+        source['event_type'] = 'response_body'
+    return source
+
+
+def invocation_lines(rng):
+    """Log lines of one sBeacon/sVEP style invocation"""
+    request_id = str(uuid.UUID(int=rng.getrandbits(128)))
+    prefix = f"[INFO]\t2025-01-29T03:04:05.{rng.randint(0, 999):03d}Z\t{request_id}\t"
+    event = {
+        "resource": "/g_variants", "path": "/g_variants", "httpMethod": "POST",
+        "requestContext": {
+            "accountId": "123456789012", "httpMethod": "POST", "path": "/prod/g_variants",
+            "identity": {"sourceIp": f"10.0.{rng.randint(0, 255)}.{rng.randint(0, 255)}"},
+            "authorizer": {"claims": {"sub": request_id, "cognito:username": "researcher"}}
+        },
+        "body": json.dumps({"query": {"requestParameters": {"assemblyId": "GRCh38", "start": [rng.randint(1, 10 ** 8)]}}})
+    }
+    lines = [
+        f"START RequestId: {request_id} Version: $LATEST",
+        f"{prefix}Event Received: {json.dumps(event)}",
+    ]
+    for _ in range(rng.randint(2, 8)):
+        lines.append(f"{prefix}Running query on dataset {uuid.UUID(int=rng.getrandbits(128))} "
+                     f"chromosome {rng.randint(1, 22)} with {rng.randint(1, 500)} samples")
+    lines.append(f"{prefix}Response Body: {json.dumps({'status': 'ok', 'volumeSize': rng.randint(1, 100)})}")
+    lines.append(f"END RequestId: {request_id}")
+    report = (f"REPORT RequestId: {request_id}\tDuration: {rng.uniform(5, 9000):.2f} ms\t"
+              f"Billed Duration: {rng.randint(5, 9000)} ms\tMemory Size: 2048 MB\t"
+              f"Max Memory Used: {rng.randint(80, 1900)} MB\t")
+    if rng.random() < 0.1:
+        report += f"Init Duration: {rng.uniform(100, 900):.2f} ms\t"
+    lines.append(report)
+    return lines
+
+
+def build_lines(count, seed=7):
+    rng = random.Random(seed)
+    lines = []
+    while len(lines) < count:
+        lines.extend(invocation_lines(rng))
+    return lines[:count]
+
+
+def measure(fn, lines, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for line in lines:
+            fn(line)
+        best = min(best, time.perf_counter() - start)
+    return len(lines) / best
+
+
+def measure_payload(lines, repeat=3):
+    payload = {
+        'messageType': 'DATA_MESSAGE', 'owner': '123456789012',
+        'logGroup': '/aws/lambda/sbeacon-backend-performQuery', 'logStream': '2025/01/29/[$LATEST]abc',
+        'logEvents': [{'id': str(i), 'timestamp': 1738119845000 + i, 'message': line}
+                      for i, line in enumerate(lines)]
+    }
+    best = float('inf')
+    for _ in range(repeat):
+        processor = CloudWatchLogProcessor()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            processor.process_payload(payload)
+        best = min(best, time.perf_counter() - start)
+    return len(lines) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark CloudWatch log line classification')
+    parser.add_argument('--lines', type=int, default=200000, help='Number of log lines to classify')
+    args = parser.parse_args()
+
+    lines = build_lines(args.lines)
+    non_json = [line for line in lines if '{' not in line]
+
+    legacy = measure(legacy_classify, non_json)
+    compiled = measure(compiled_classify, non_json)
+    print(f"Classify + REPORT parse ({len(non_json)} non-JSON lines)")
+    print(f"  substring chain : {legacy:12,.0f} lines/sec")
+    print(f"  prefix dispatch : {compiled:12,.0f} lines/sec ({compiled / legacy:.2f}x)")
+
+    plain = [line for line in non_json if not line.startswith(('START', 'END', 'REPORT'))]
+    legacy = measure(legacy_classify, plain)
+    compiled = measure(compiled_classify, plain)
+    print(f"Application lines only ({len(plain)} lines)")
+    print(f"  substring chain : {legacy:12,.0f} lines/sec")
+    print(f"  prefix dispatch : {compiled:12,.0f} lines/sec ({compiled / legacy:.2f}x)")
+
+    reports = [line for line in lines if line.startswith('REPORT')]
+    legacy = measure(legacy_classify, reports)
+    compiled = measure(compiled_classify, reports)
+    print(f"REPORT lines only ({len(reports)} lines)")
+    print(f"  substring chain : {legacy:12,.0f} lines/sec")
+    print(f"  prefix dispatch : {compiled:12,.0f} lines/sec ({compiled / legacy:.2f}x)")
+
+    sample = lines[:min(len(lines), 50000)]
+    print(f"process_payload end to end ({len(sample)} lines): {measure_payload(sample):,.0f} lines/sec")
+
+
+if __name__ == '__main__':
+    main()
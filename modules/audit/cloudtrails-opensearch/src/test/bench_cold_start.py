@@ -0,0 +1,47 @@
+# bench_cold_start.py
+"""Cold start of opensearch_handler: import plus a first Kinesis invocation in fresh interpreters
+
+Each run is the FIRST_INVOCATION child of test_import_time.py; the best of --runs is reported,
+followed by the imports with the largest cumulative time from one `-X importtime` run. Import
+and first invocation took ~300 ms here, with boto3 another ~100 ms. --budget-ms makes the
+bench exit 1 when the best run is over it, for a quiet host rather than the unit suite. Run
+from the module directory:
+
+    python3 src/test/bench_cold_start.py [--runs 5] [--top 15] [--budget-ms 400]
+"""
+import argparse
+import json
+import sys
+
+from test_import_time import first_invocation
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='Fresh interpreters to time')
+    parser.add_argument('--top', type=int, default=15, help='Slowest imports to list')
+    parser.add_argument('--budget-ms', type=float, help='Exit 1 when import plus invocation exceeds this')
+    args = parser.parse_args()
+
+    runs = [json.loads(first_invocation()[-1]) for _ in range(args.runs)]
+    best = min(runs, key=lambda run: run['import_ms'] + run['invocation_ms'])
+    total = best['import_ms'] + best['invocation_ms']
+    print(f"cold start, best of {args.runs}: {total:.1f} ms "
+          f"(import {best['import_ms']:.1f} ms, first invocation {best['invocation_ms']:.1f} ms)")
+
+    imports = []
+    for line in first_invocation('-X', 'importtime'):
+        if line.startswith('import time:') and not line.endswith('imported package'):
+            _, cumulative, module = line[len('import time:'):].split('|')
+            imports.append((int(cumulative), module.strip()))
+    print("slowest imports (cumulative, -X importtime adds its own overhead):")
+    for cumulative, module in sorted(imports, reverse=True)[:args.top]:
+        print(f"  {cumulative / 1000:8.1f} ms  {module}")
+
+    if args.budget_ms is not None and total > args.budget_ms:
+        print(f"over the {args.budget_ms:.0f} ms budget")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
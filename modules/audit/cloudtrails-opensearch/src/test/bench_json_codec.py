@@ -0,0 +1,100 @@
+# bench_json_codec.py
+"""Per-invocation CPU time of the JSON codec backends
+
+Runs the Kinesis decode path (base64 + gunzip + payload decode + per-message extract_json)
+and bulk body encoding for a batch of CloudWatch Logs records with each JsonCodec backend,
+and checks that both produce the same documents once parsed back. Run from the module
+directory:
+
+    python3 src/test/bench_json_codec.py [--records 100] [--lines 200] [--invocations 20]
+"""
+import argparse
+import base64
+import contextlib
+import gzip
+import io
+import json
+import os
+import sys
+import time
+
+os.environ.setdefault('AWS_XRAY_SDK_ENABLED', 'false')
+os.environ.setdefault('AWS_XRAY_CONTEXT_MISSING', 'IGNORE_ERROR')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import opensearch_handler  # noqa: E402
+from bench_classifier import build_lines  # noqa: E402
+
+
+def build_records(record_count, lines_per_record):
+    lines = build_lines(record_count * lines_per_record)
+    records = []
+    for r in range(record_count):
+        chunk = lines[r * lines_per_record:(r + 1) * lines_per_record]
+        payload = {
+            'messageType': 'DATA_MESSAGE', 'owner': '123456789012',
+            'logGroup': '/aws/lambda/svep-backend-pluginConsequence',
+            'logStream': '2025/01/29/[$LATEST]0123456789abcdef',
+            'subscriptionFilters': ['cloudtrail-opensearch'],
+            'logEvents': [{'id': f'{r:04d}{i:08d}', 'timestamp': 1738119845000 + i, 'message': line}
+                          for i, line in enumerate(chunk)]
+        }
+        data = base64.b64encode(gzip.compress(json.dumps(payload).encode('utf-8'))).decode('ascii')
+        records.append({'kinesis': {'kinesisSchemaVersion': '1.0', 'data': data}})
+    return records
+
+
+def run_invocation(records):
+    """Decode every record and encode the resulting documents into bulk bodies"""
+    builder = opensearch_handler.BulkBodyBuilder('logs-cloudtrail-2025.01.29', 10 ** 9, 10 ** 12)
+    decode_start = time.process_time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        documents = [doc for record in records for doc in opensearch_handler.process_kinesis_record(record)]
+    encode_start = time.process_time()
+    body = b''.join(builder.encode(doc) for doc in documents)
+    end = time.process_time()
+    return body, encode_start - decode_start, end - encode_start
+
+
+def bench(backend, records, invocations):
+    opensearch_handler.JSON_CODEC = opensearch_handler.JsonCodec(backend)
+    body, decode, encode = run_invocation(records)
+    for _ in range(invocations - 1):
+        _, d, e = run_invocation(records)
+        decode, encode = min(decode, d), min(encode, e)
+    return opensearch_handler.JSON_CODEC.name, body, decode, encode
+
+
+def parsed_lines(body):
+    return [json.loads(line) for line in body.splitlines()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark JSON codec backends')
+    parser.add_argument('--records', type=int, default=100, help='Kinesis records per invocation')
+    parser.add_argument('--lines', type=int, default=200, help='Log events per record')
+    parser.add_argument('--invocations', type=int, default=20, help='Invocations to time (best is reported)')
+    args = parser.parse_args()
+
+    records = build_records(args.records, args.lines)
+    print(f"{args.records} records x {args.lines} log events per invocation")
+
+    results = [bench(backend, records, args.invocations) for backend in ('json', 'orjson')]
+    baseline = results[0][2] + results[0][3]
+    for name, body, decode, encode in results:
+        total = decode + encode
+        print(f"  {name:7s} decode {decode * 1000:8.1f} ms  encode {encode * 1000:7.1f} ms  "
+              f"total {total * 1000:8.1f} ms CPU ({baseline / total:.2f}x)  body {len(body):,} bytes")
+
+    if results[1][0] != 'orjson':
+        print("orjson is not installed; only the stdlib backend was measured")
+    elif parsed_lines(results[0][1]) != parsed_lines(results[1][1]):
+        print("MISMATCH: backends produced different documents")
+        sys.exit(1)
+    else:
+        print("Both backends produce identical documents")
+
+
+if __name__ == '__main__':
+    main()
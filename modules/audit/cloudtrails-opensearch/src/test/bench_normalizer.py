@@ -0,0 +1,155 @@
+# bench_normalizer.py
+"""Benchmark the template-compiled DocumentNormalizer against the previous _normalize_document
+
+Documents carry deep CloudTrail requestParameters/responseElements (EC2 RunInstances,
+IAM PutRolePolicy, S3 PutBucketPolicy, ...) with numbers, booleans, nulls and nested
+lists. Both implementations must produce equal documents. Run from the module directory:
+
+    python3 src/test/bench_normalizer.py [--documents 20000]
+"""
+import argparse
+import copy
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault('AWS_XRAY_SDK_ENABLED', 'false')
+os.environ.setdefault('AWS_XRAY_CONTEXT_MISSING', 'IGNORE_ERROR')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from opensearch_handler import DocumentNormalizer, OpenSearchManager  # noqa: E402
+
+
+def legacy_normalize(doc):
+    """_normalize_document as it was before the compiled normalizer"""
+    def normalize_value(value):
+        if isinstance(value, bool):
+            return str(value).lower()
+        if value is None:
+            return ""
+        return str(value)
+
+    def process_dict(d):
+        if d is None:
+            return {}
+
+        processed = {}
+        for key, value in d.items():
+            if isinstance(value, dict):
+                processed[key] = process_dict(value)
+            elif isinstance(value, list):
+                processed[key] = [process_dict(item) if isinstance(item, dict)
+                                  else normalize_value(item) for item in value]
+            elif key == "Value" and any(tag_key in str(key) for tag_key in ["Tag", "TagSet"]):
+                processed[key] = normalize_value(value)
+            else:
+                processed[key] = normalize_value(value)
+        return processed
+
+    try:
+        normalized = doc.copy()
+        if 'requestParameters' in normalized:
+            normalized['requestParameters'] = process_dict(normalized.get('requestParameters'))
+        if 'responseElements' in normalized:
+            normalized['responseElements'] = process_dict(normalized.get('responseElements'))
+        return normalized
+    except Exception:
+        return doc
+
+
+def run_instances(rng):
+    return {
+        'instancesSet': {'items': [{'imageId': 'ami-0abcdef1234567890', 'minCount': 1, 'maxCount': rng.randint(1, 4)}]},
+        'instanceType': 'm6g.large',
+        'blockDeviceMapping': {'items': [{
+            'deviceName': '/dev/xvda',
+            'ebs': {'volumeSize': rng.randint(8, 500), 'deleteOnTermination': True, 'encrypted': rng.random() < 0.5,
+                    'iops': None, 'volumeType': 'gp3'}
+        } for _ in range(rng.randint(1, 3))]},
+        'monitoring': {'enabled': False},
+        'disableApiTermination': False,
+        'tagSpecificationSet': {'items': [{
+            'resourceType': 'instance',
+            'tags': [{'key': 'Name', 'value': f'svep-worker-{rng.randint(1, 999)}'},
+                     {'key': 'CostCentre', 'value': rng.randint(1000, 9999)}]
+        }]},
+        'networkInterfaceSet': {'items': [{'deviceIndex': 0, 'subnetId': 'subnet-0123456789abcdef0',
+                                           'groupSet': {'items': [{'groupId': 'sg-0123456789abcdef0'}]}}]}
+    }
+
+
+def put_role_policy(rng):
+    return {
+        'roleName': 'sbeacon-backend-role',
+        'policyName': f'inline-{rng.randint(1, 100)}',
+        'policyDocument': {
+            'Version': '2012-10-17',
+            'Statement': [{
+                'Effect': 'Allow',
+                'Action': ['s3:GetObject', 's3:PutObject', 'dynamodb:Query'],
+                'Resource': [f'arn:aws:s3:::bucket-{i}/*' for i in range(rng.randint(1, 6))],
+                'Condition': {'NumericLessThan': {'s3:max-keys': rng.randint(1, 1000)},
+                              'Bool': {'aws:SecureTransport': True}}
+            } for _ in range(rng.randint(1, 4))]
+        }
+    }
+
+
+def describe_instances(rng):
+    return {'filterSet': {'items': [{'name': 'tag:Project', 'valueSet': {'items': [{'value': 'gaspi'}]}}]},
+            'maxResults': rng.randint(5, 1000), 'dryRun': False, 'nextToken': None}
+
+
+def build_documents(count, seed=11):
+    rng = random.Random(seed)
+    shapes = (run_instances, put_role_policy, describe_instances)
+    documents = []
+    for i in range(count):
+        request = rng.choice(shapes)(rng)
+        documents.append({
+            '@timestamp': '2025-01-29T03:04:05.000000+00:00', '@id': str(i), 'event_type': 'json',
+            'eventSource': 'ec2.amazonaws.com', 'eventName': 'RunInstances', 'readOnly': False,
+            'requestParameters': request,
+            'responseElements': {'requestId': f'{i:08x}', 'reservationId': f'r-{i:017x}', 'ownerId': 123456789012,
+                                 'instancesSet': {'items': [{'instanceId': f'i-{i:017x}', 'ebsOptimized': True,
+                                                             'currentState': {'code': 0, 'name': 'pending'}}]}}
+                                if rng.random() < 0.5 else None
+        })
+    return documents
+
+
+def measure(normalize, documents, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        fresh = copy.deepcopy(documents)
+        start = time.perf_counter()
+        for doc in fresh:
+            normalize(doc)
+        best = min(best, time.perf_counter() - start)
+    return len(documents) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark document normalization')
+    parser.add_argument('--documents', type=int, default=20000, help='Number of CloudTrail documents')
+    args = parser.parse_args()
+
+    documents = build_documents(args.documents)
+    compiled = DocumentNormalizer(OpenSearchManager._index_template())
+    print(f"Coerced subtrees from template: {['.'.join(path) for path in compiled.roots]}")
+
+    for doc in documents:
+        if legacy_normalize(copy.deepcopy(doc)) != compiled(copy.deepcopy(doc)):
+            print(f"MISMATCH on document {doc['@id']}")
+            sys.exit(1)
+
+    legacy = measure(legacy_normalize, documents)
+    current = measure(compiled, documents)
+    print(f"{args.documents} documents")
+    print(f"  recursive copy  : {legacy:12,.0f} docs/sec")
+    print(f"  compiled inplace: {current:12,.0f} docs/sec ({current / legacy:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# bench_parse_workers.py
+"""Throughput of Kinesis record parsing in-process vs on ParseWorkers processes
+
+Every mode decodes, parses, normalizes and encodes the same records into bulk items; the
+in-process mode is what the handler does with PARSE_WORKERS below 2. Workers can only pay
+off with more than one vCPU (memory above 1,769 MB); on a single vCPU two workers ran at
+0.71x of in-process parsing. Run it at the function's memory size before raising
+PARSE_WORKERS. Run from the module directory:
+
+    python3 src/test/bench_parse_workers.py [--records 200] [--lines 200] [--workers 1 2 4]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+os.environ.setdefault('AWS_XRAY_SDK_ENABLED', 'false')
+os.environ.setdefault('AWS_XRAY_CONTEXT_MISSING', 'IGNORE_ERROR')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import opensearch_handler  # noqa: E402
+from bench_json_codec import build_records  # noqa: E402
+
+
+def in_process(records):
+    normalize = opensearch_handler.DocumentNormalizer(opensearch_handler.OpenSearchManager._index_template())
+    builder = opensearch_handler.BulkBodyBuilder('logs-cloudtrail-2025.01.29', 0, 0, normalize=normalize,
+                                                 field_budget=opensearch_handler.FieldBudget())
+    return [builder.encode(doc) for doc, _ in opensearch_handler.stream_kinesis_documents(records)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark parse workers')
+    parser.add_argument('--records', type=int, default=200, help='Kinesis records per event')
+    parser.add_argument('--lines', type=int, default=200, help='Log events per record')
+    parser.add_argument('--workers', type=int, nargs='+', default=sorted({1, 2, os.cpu_count() or 1}),
+                        help='Worker counts to measure; 1 parses in-process')
+    args = parser.parse_args()
+
+    records = build_records(args.records, args.lines)
+    for number, record in enumerate(records):
+        record['kinesis']['sequenceNumber'] = str(number)
+    print(f"{args.records} records x {args.lines} log events, {os.cpu_count()} vCPUs")
+
+    baseline = None
+    for count in args.workers:
+        with contextlib.redirect_stdout(io.StringIO()):
+            workers = opensearch_handler.ParseWorkers(count) if count > 1 else None
+            start = time.perf_counter()
+            if workers is None:
+                items = in_process(records)
+            else:
+                items = [item for _, item, _ in workers.stream(records)]
+            elapsed = time.perf_counter() - start
+            if workers is not None:
+                workers.close()
+        rate = len(items) / elapsed
+        baseline = baseline or rate
+        label = 'in-process' if count == 1 else f'{count} workers'
+        print(f"  {label:11s} {rate:10,.0f} docs/sec ({rate / baseline:.2f}x)  {len(items)} items")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# bench_record_decode.py
+"""Per-record latency and memory of Kinesis record decoding, previous chain vs decompressobj
+
+`chained` is the decode the handler used to do: b64decode, BytesIO + GzipFile.read, decode
+to str, json.loads. `direct` is decode_record_data + inflate_gzip + JSON_CODEC.loads on the
+bytes. tracemalloc follows the stage up to the parser input: the peak it reaches per record,
+relative to the inflated payload, counts the copies of the payload alive at once, and the
+blocks still allocated afterwards. Latency covers the full decode including the JSON parse
+and is timed with tracing off. Run from the module directory:
+
+    python3 src/test/bench_record_decode.py [--records 200] [--lines 200]
+"""
+import argparse
+import base64
+import gzip
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+
+os.environ.setdefault('AWS_XRAY_SDK_ENABLED', 'false')
+os.environ.setdefault('AWS_XRAY_CONTEXT_MISSING', 'IGNORE_ERROR')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import opensearch_handler  # noqa: E402
+from bench_json_codec import build_records  # noqa: E402
+
+
+def chained_input(data):
+    payload = base64.b64decode(data)
+    with gzip.GzipFile(fileobj=BytesIO(payload), mode='r') as gz:
+        payload = gz.read()
+    return payload.decode('utf-8')
+
+
+def direct_input(data):
+    return opensearch_handler.inflate_gzip(opensearch_handler.decode_record_data(data))
+
+
+def chained(data):
+    return json.loads(chained_input(data))
+
+
+def direct(data):
+    return opensearch_handler.JSON_CODEC.loads(direct_input(data))
+
+
+def latency(decode, records, repeat=5):
+    per_record = []
+    for data in records:
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            decode(data)
+            best = min(best, time.perf_counter() - start)
+        per_record.append(best * 1e6)
+    return statistics.median(per_record)
+
+
+def allocations(decode, records):
+    """Median peak bytes above the baseline and blocks left allocated per record"""
+    peaks, blocks = [], []
+    tracemalloc.start()
+    for data in records:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        snapshot_before = tracemalloc.take_snapshot()
+        result = decode(data)
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot_after = tracemalloc.take_snapshot()
+        peaks.append(peak - before)
+        blocks.append(sum(stat.count_diff for stat in snapshot_after.compare_to(snapshot_before, 'filename')
+                          if stat.count_diff > 0))
+        del result
+    tracemalloc.stop()
+    return statistics.median(peaks), statistics.median(blocks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Kinesis record decoding')
+    parser.add_argument('--records', type=int, default=200, help='Kinesis records to decode')
+    parser.add_argument('--lines', type=int, default=200, help='Log events per record')
+    args = parser.parse_args()
+
+    records = [record['kinesis']['data'] for record in build_records(args.records, args.lines)]
+    inflated = statistics.median(len(gzip.decompress(base64.b64decode(data))) for data in records)
+    for data in records:
+        if chained(data) != direct(data):
+            print("MISMATCH: decoders produced different payloads")
+            sys.exit(1)
+
+    print(f"{args.records} records, median {len(records[0]):,} base64 chars -> {inflated:,.0f} bytes "
+          f"({opensearch_handler.JSON_CODEC.name} codec)")
+    for name, decode, parser_input in (('chained', chained, chained_input), ('direct', direct, direct_input)):
+        peak, blocks = allocations(parser_input, records)
+        print(f"  {name:8s} {latency(decode, records):8.1f} us/record  peak {peak / 1024:7.1f} KiB "
+              f"({peak / inflated:.2f}x payload)  {blocks:,.0f} blocks retained")
+
+
+if __name__ == '__main__':
+    main()
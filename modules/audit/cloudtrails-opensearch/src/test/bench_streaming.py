@@ -0,0 +1,82 @@
+# bench_streaming.py
+"""Peak Python heap of the Kinesis path, collecting every document first vs streaming them
+
+`collected` decodes every record into one document list before cutting batches, as the
+handler used to. `streamed` pulls documents from stream_kinesis_documents straight into
+the bulk body builder and drops each batch once it is cut, as index_stream does with a
+batch on the wire. Peak memory should grow with the event in the first case and stay near
+one batch in the second. Run from the module directory:
+
+    python3 src/test/bench_streaming.py [--records 50 200 800] [--lines 200] [--batch-mb 5]
+"""
+import argparse
+import contextlib
+import gc
+import io
+import os
+import sys
+import tracemalloc
+
+os.environ.setdefault('AWS_XRAY_SDK_ENABLED', 'false')
+os.environ.setdefault('AWS_XRAY_CONTEXT_MISSING', 'IGNORE_ERROR')
+os.environ.setdefault('METRIC_ROLLUPS', 'false')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import opensearch_handler  # noqa: E402
+from bench_json_codec import build_records  # noqa: E402
+
+
+def cut(entries, max_bytes):
+    """Cut batches like _create_batches does and discard them as if sent"""
+    builder = opensearch_handler.BulkBodyBuilder('logs-cloudtrail-2025.01.29', 500, max_bytes)
+    batches = 0
+    for doc, origin in entries:
+        if builder.add(doc, origin) is not None:
+            batches += 1
+    return batches + (builder.flush() is not None)
+
+
+def collected(records, max_bytes):
+    documents, origins = [], []
+    for record in records:
+        found = opensearch_handler.process_kinesis_record(record)
+        documents.extend(found)
+        origins.extend([record['kinesis']['sequenceNumber']] * len(found))
+    return cut(zip(documents, origins), max_bytes)
+
+
+def streamed(records, max_bytes):
+    return cut(opensearch_handler.stream_kinesis_documents(records), max_bytes)
+
+
+def peak(run, records, max_bytes):
+    gc.collect()
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        run(records, max_bytes)
+    _, high = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return high
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark peak memory of collected vs streamed indexing')
+    parser.add_argument('--records', type=int, nargs='+', default=[50, 200, 800], help='Kinesis records per event')
+    parser.add_argument('--lines', type=int, default=200, help='Log events per record')
+    parser.add_argument('--batch-mb', type=float, default=5, help='Bulk request size')
+    args = parser.parse_args()
+
+    max_bytes = int(args.batch_mb * 1024 * 1024)
+    print(f"{args.lines} log events per record, {args.batch_mb} MB batches; peak traced heap excluding the event")
+    for count in args.records:
+        records = build_records(count, args.lines)
+        for record_number, record in enumerate(records):
+            record['kinesis']['sequenceNumber'] = str(record_number)
+        before = peak(collected, records, max_bytes)
+        after = peak(streamed, records, max_bytes)
+        print(f"  {count:5d} records: collected {before / 2 ** 20:8.1f} MB  streamed {after / 2 ** 20:6.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+# conftest.py
+"""Shared fixtures: the handler's environment and an OpenSearch domain behind a stubbed session"""
+import gzip
+import json
+import os
+import sys
+
+os.environ.setdefault('AWS_XRAY_SDK_ENABLED', 'false')
+os.environ.setdefault('AWS_XRAY_CONTEXT_MISSING', 'IGNORE_ERROR')
+os.environ.setdefault('TRACE_GRANULARITY', 'off')
+os.environ.setdefault('METRIC_ROLLUPS', 'false')
+os.environ.setdefault('PARSE_WORKERS', '1')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pytest  # noqa: E402
+import requests  # noqa: E402
+
+import opensearch_handler  # noqa: E402
+
+
+class FakeCluster:
+    """Answers the requests OpenSearchManager sends, with scripted _bulk item statuses
+
+    `status(doc, attempt)` gives the item status of a document on its attempt-th submission
+    (0 first). Bodies over `max_body_bytes` get a 413. Every _bulk call is kept in `bulk_calls`
+    as the list of documents it carried, and in `bulk_requests` as its headers and wire body.
+    `indices` maps the indices that exist to their settings; `settings_updates` keeps every
+    settings PUT as (index, settings).
+    """
+
+    def __init__(self):
+        self.status = lambda doc, attempt: 201
+        self.max_body_bytes = None
+        self.health = 'green'
+        self.took = 5
+        self.bulk_calls = []
+        self.bulk_requests = []
+        self.health_checks = 0
+        self.indices = {}
+        self.settings_updates = []
+        self._attempts = {}
+
+    @staticmethod
+    def response(status_code, body):
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = json.dumps(body).encode('utf-8')
+        response.url = 'https://search.example.com/'
+        return response
+
+    def request(self, method, url, data=None, **kwargs):
+        endpoint = url.split('/', 3)[3]
+        if endpoint.startswith('_index_template'):
+            return self.response(404 if method == 'GET' else 200, {})
+        if endpoint == '_cluster/health':
+            self.health_checks += 1
+            if self.health is None:
+                raise requests.exceptions.ConnectionError('unreachable')
+            return self.response(200, {'status': self.health})
+        if endpoint == '_bulk':
+            headers = kwargs.get('headers') or {}
+            self.bulk_requests.append((headers, data))
+            if headers.get('Content-Encoding') == 'gzip':
+                data = gzip.decompress(data)
+            return self.bulk(data)
+        index, _, action = endpoint.partition('/')
+        if action == '' and method == 'HEAD':
+            return self.response(200 if index in self.indices else 404, {})
+        if action == '' and method == 'PUT':
+            self.indices.setdefault(index, {'number_of_replicas': '1'})
+            return self.response(200, {'acknowledged': True})
+        if action == '_settings' and index in self.indices:
+            if method == 'GET':
+                return self.response(200, {index: {'settings': {'index': dict(self.indices[index])}}})
+            settings = json.loads(data)['index']
+            self.settings_updates.append((index, settings))
+            for name, value in settings.items():
+                # A null setting goes back to its default
+                if value is None:
+                    self.indices[index].pop(name, None)
+                else:
+                    self.indices[index][name] = str(value)
+            return self.response(200, {'acknowledged': True})
+        return self.response(404, {})
+
+    def bulk(self, body):
+        if self.max_body_bytes is not None and len(body) > self.max_body_bytes:
+            return self.response(413, {'error': 'Request Entity Too Large'})
+        lines = body.decode('utf-8').splitlines()
+        docs = [json.loads(line) for line in lines[1::2]]
+        self.bulk_calls.append(docs)
+        items = []
+        for doc in docs:
+            key = doc.get('@id')
+            attempt = self._attempts.get(key, 0)
+            self._attempts[key] = attempt + 1
+            status = self.status(doc, attempt)
+            item = {'_id': key, 'status': status}
+            if status >= 400:
+                item['error'] = {'type': 'es_rejected_execution_exception' if status == 429
+                                 else 'mapper_parsing_exception', 'reason': 'scripted'}
+            items.append({'index': item})
+        return self.response(200, {'took': self.took, 'errors': any(s['index']['status'] >= 400 for s in items),
+                                   'items': items})
+
+
+class FakeSpillSink:
+    def __init__(self, available=True):
+        self.available = available
+        self.bucket = 'spill-bucket'
+        self.writes = []
+
+    def write(self, items, reason, metadata=None):
+        if not self.available:
+            return None
+        self.writes.append((items, reason, metadata))
+        return f"spill/{reason}/object-{len(self.writes)}"
+
+
+@pytest.fixture
+def cluster(monkeypatch):
+    """A FakeCluster every requests.Session of the handler talks to"""
+    fake = FakeCluster()
+    monkeypatch.setenv('OPENSEARCH_DOMAIN_ENDPOINT', 'search.example.com')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'AKIDEXAMPLE')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'secret')
+    monkeypatch.setattr(requests.Session, 'request', lambda session, *args, **kwargs: fake.request(*args, **kwargs))
+    monkeypatch.setattr(opensearch_handler.time, 'sleep', lambda seconds: None)
+    return fake
+
+
+@pytest.fixture
+def manager(cluster, monkeypatch):
+    """A fresh OpenSearchManager on the fake cluster, installed as the container's manager"""
+    opensearch = opensearch_handler.OpenSearchManager()
+    opensearch.spill_sink = FakeSpillSink()
+    monkeypatch.setattr(opensearch_handler, '_opensearch_manager', opensearch)
+    yield opensearch
+    opensearch._executor.shutdown(wait=True)
@@ -0,0 +1,171 @@
+# test_backfill.py
+"""Replay of bucket objects by src/backfill.py against the stubbed OpenSearch session and an
+in-memory bucket: record decoding, where replay failures are spilled and the bulk-load profile
+
+    python3 -m pytest src/test/test_backfill.py
+"""
+import base64
+import gzip
+import io
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import backfill
+from backfill import BulkLoadProfile, Checkpoint, Replayer, firehose_documents, list_objects
+from opensearch_handler import CloudWatchLogProcessor, SpillSink
+
+BUCKET = 'cloudtrail-bucket'
+HOUR = datetime(2025, 1, 29, 3, tzinfo=timezone.utc)
+
+
+class FakeS3:
+    """The list, get and put calls backfill and SpillSink make, on objects kept in a dict"""
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, Bucket, Prefix, Delimiter=None):
+        keys = sorted(key for key in self.objects if key.startswith(Prefix))
+        if Delimiter is None:
+            yield {'Contents': [{'Key': key, 'ETag': f'"{len(self.objects[key])}"'} for key in keys]}
+            return
+        children = sorted({Prefix + key[len(Prefix):].split(Delimiter, 1)[0] + Delimiter
+                           for key in keys if Delimiter in key[len(Prefix):]})
+        yield {'CommonPrefixes': [{'Prefix': child} for child in children]}
+
+
+@pytest.fixture
+def s3(manager, monkeypatch):
+    """A FakeS3 behind boto3 and behind a real SpillSink on the manager"""
+    fake = FakeS3()
+    monkeypatch.setattr(backfill.boto3, 'client', lambda service: fake)
+    sink = SpillSink()
+    sink.bucket = BUCKET
+    sink._client = fake
+    manager.spill_sink = sink
+    return fake
+
+
+def line(record):
+    return json.dumps(record).encode() + b'\n'
+
+
+def cloudwatch_payload(*messages):
+    payload = {'messageType': 'DATA_MESSAGE', 'logGroup': '/aws/lambda/sbeacon-backend',
+               'logStream': 'stream', 'logEvents': [{'id': str(n), 'timestamp': 1738119845000, 'message': message}
+                                                    for n, message in enumerate(messages)]}
+    return base64.b64encode(gzip.compress(json.dumps(payload).encode())).decode()
+
+
+def test_firehose_documents_of_errors_rejections_and_backups():
+    processor = CloudWatchLogProcessor()
+    rejected = {'@id': 'rejected', 'message': 'refused'}
+
+    transform_error = firehose_documents(line({'rawData': cloudwatch_payload('{"a": 1}', '{"b": 2}'),
+                                               'errorCode': 'Lambda.FunctionError'}), processor)
+    refused = firehose_documents(line({'rawData': base64.b64encode(json.dumps(rejected).encode()).decode(),
+                                       'esDocumentId': 'rejected'}), processor)
+    backup = firehose_documents(line({'@id': 'backup', 'message': 'delivered'}), processor)
+
+    assert len(transform_error) == 2
+    assert refused == [rejected]
+    assert backup == [{'@id': 'backup', 'message': 'delivered'}]
+
+
+def test_firehose_documents_written_without_a_separator_are_split():
+    documents = firehose_documents(b'{"@id": "a"}{"@id": "b"} {"@id": "c"}\n', CloudWatchLogProcessor())
+
+    assert [doc['@id'] for doc in documents] == ['a', 'b', 'c']
+
+
+def test_firehose_line_that_is_not_an_object_is_unreadable():
+    with pytest.raises(ValueError):
+        firehose_documents(b'[1, 2]\n', CloudWatchLogProcessor())
+
+
+def test_spill_replay_sends_the_bulk_lines_as_they_are(manager, cluster, s3):
+    items = [line({'index': {'_index': 'logs-cloudtrail-2025.01.29', '_id': doc_id}}) + line({'@id': doc_id})
+             for doc_id in ('a', 'b')]
+    key = f"spill/breaker/{backfill.partition(HOUR)}object.ndjson.gz"
+    s3.objects[key] = gzip.compress(b''.join(items))
+
+    stats = Replayer(BUCKET, 1000).replay('spill', key)
+
+    assert [[doc['@id'] for doc in call] for call in cluster.bulk_calls] == [['a', 'b']]
+    assert (stats['indexed'], stats['spilled'], stats['failed']) == (2, 0, 0)
+
+
+def test_replay_rejections_are_spilled_where_no_replay_reads_them(manager, cluster, s3):
+    cluster.status = lambda doc, attempt: 400
+    key = f"spill/rejected/{backfill.partition(HOUR)}object.ndjson.gz"
+    s3.objects[key] = gzip.compress(line({'index': {'_index': 'logs-cloudtrail-2025.01.29', '_id': 'a'}}) +
+                                    line({'@id': 'a'}))
+
+    stats = Replayer(BUCKET, 1000).replay('spill', key)
+
+    assert stats['spilled'] == 1
+    [spilled] = [spilled for spilled in s3.objects if spilled != key]
+    assert spilled.startswith(backfill.REPLAYED_PREFIX + 'rejected/')
+    until = datetime.now(timezone.utc) + timedelta(hours=1)
+    listed = list_objects(s3, BUCKET, sorted(backfill.SOURCES), HOUR, until)
+    assert {listed_key for _, listed_key, _ in listed} == {key}
+
+
+def test_bulk_load_profile_leaves_the_current_day_alone():
+    now = datetime(2025, 1, 30, 9, tzinfo=timezone.utc)
+
+    indices = backfill.bulk_load_indices(datetime(2025, 1, 29, 0, tzinfo=timezone.utc),
+                                         datetime(2025, 1, 31, 0, tzinfo=timezone.utc), now)
+
+    assert indices == ['logs-cloudtrail-2025.01.28', 'logs-cloudtrail-2025.01.29']
+
+
+def test_bulk_load_profile_restores_the_original_settings(manager, cluster, tmp_path):
+    cluster.indices['logs-cloudtrail-2025.01.28'] = {'number_of_replicas': '2', 'refresh_interval': '30s'}
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'))
+    profile = BulkLoadProfile(manager, ['logs-cloudtrail-2025.01.28', 'logs-cloudtrail-2025.01.29'], checkpoint)
+
+    profile.apply()
+    assert cluster.indices['logs-cloudtrail-2025.01.29']['refresh_interval'] == '-1'
+    assert Checkpoint(checkpoint.path).state['index_settings']['logs-cloudtrail-2025.01.28'] == {
+        'number_of_replicas': '2', 'refresh_interval': '30s'}
+    profile.restore()
+
+    assert cluster.indices == {
+        'logs-cloudtrail-2025.01.28': {'number_of_replicas': '2', 'refresh_interval': '30s'},
+        'logs-cloudtrail-2025.01.29': {'number_of_replicas': '1'},
+    }
+    assert checkpoint.state['index_settings'] == {}
+
+
+def test_bulk_load_profile_that_stops_half_way_is_restored(manager, cluster, tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'))
+    profile = BulkLoadProfile(manager, ['logs-cloudtrail-2025.01.28', 'logs-cloudtrail-2025.01.29'], checkpoint)
+    request = manager._make_request
+
+    def refuse_second_index(method, endpoint, *args, **kwargs):
+        if endpoint.startswith('logs-cloudtrail-2025.01.29'):
+            raise RuntimeError('refused')
+        return request(method, endpoint, *args, **kwargs)
+    manager._make_request = refuse_second_index
+
+    try:
+        profile.apply()
+    except RuntimeError:
+        pass
+    finally:
+        profile.restore()
+
+    assert cluster.indices == {'logs-cloudtrail-2025.01.28': {'number_of_replicas': '1'}}
+    assert checkpoint.state['index_settings'] == {}
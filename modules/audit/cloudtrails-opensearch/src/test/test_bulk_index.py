@@ -0,0 +1,285 @@
+# test_bulk_index.py
+"""Bulk indexing against a stubbed OpenSearch session: daily index routing, item retries,
+413 splits, batch prefetching and the partial batch response of the Kinesis handler
+
+    python3 -m pytest src/test/test_bulk_index.py
+"""
+import base64
+import gzip
+import itertools
+import json
+import threading
+
+import pytest
+
+import opensearch_handler
+from opensearch_handler import BulkBatch, FieldBudget, MetricRollup, _event_date, handler
+
+
+def batch_of(manager, *ids):
+    batch = BulkBatch('logs-cloudtrail-2025.01.29')
+    builder = opensearch_handler.BulkBodyBuilder(batch.index_name, 0, 0)
+    for doc_id in ids:
+        batch.append(builder.encode({'@id': doc_id, 'message': 'x' * 50}), f'seq-{doc_id}')
+    return batch
+
+
+@pytest.mark.parametrize('timestamp, date', [
+    ('2025-01-29T03:04:05+00:00', '2025.01.29'),
+    ('2025-01-29T23:59:59.999', '2025.01.29'),
+    ('2025-01-29T23:30:00-02:00', '2025.01.30'),
+    ('2025-01-30T01:00:00+07:00', '2025.01.29'),
+    ('29/01/2025 03:04:05', 'today'),
+    (None, 'today'),
+])
+def test_event_date_is_the_utc_day_of_the_timestamp(timestamp, date):
+    assert _event_date(timestamp, 'today') == date
+
+
+def test_documents_are_batched_into_the_index_of_their_own_day(manager):
+    docs = [{'@id': 'late', '@timestamp': '2025-01-28T23:59:00+00:00'},
+            {'@id': 'a', '@timestamp': '2025-01-29T00:01:00+00:00'},
+            {'@id': 'shifted', '@timestamp': '2025-01-29T06:00:00+07:00'},
+            {'@id': 'b', '@timestamp': '2025-01-29T12:00:00+00:00'}]
+
+    batches = list(manager._create_batches((doc, doc['@id']) for doc in docs))
+
+    assert {batch.index_name: batch.origins for batch in batches} == {
+        'logs-cloudtrail-2025.01.28': ['late', 'shifted'],
+        'logs-cloudtrail-2025.01.29': ['a', 'b'],
+    }
+
+
+def test_field_budget_forgets_the_first_tracked_index(monkeypatch):
+    monkeypatch.setattr(opensearch_handler, 'FIELD_BUDGET_TRACKED_INDICES', 2)
+    budget = FieldBudget()
+
+    for index_name in ('logs-cloudtrail-2025.01.29', 'logs-cloudtrail-2025-w05', 'logs-cloudtrail-2025.01.30'):
+        budget.apply(index_name, {'a': 1})
+
+    # Lexically 'logs-cloudtrail-2025-w05' sorts first, yet it is the newer of the two kept
+    assert list(budget.report()['paths_by_index']) == ['logs-cloudtrail-2025-w05', 'logs-cloudtrail-2025.01.30']
+
+
+def test_rollups_are_not_charged_to_the_field_budget(manager, cluster):
+    rollup = MetricRollup()
+    rollup.add({'event_type': 'lambda_report', '@id': 'r', '@log_group': '/aws/lambda/a',
+                '@timestamp': '2025-01-29T03:04:05+00:00', 'duration_ms': 5.0})
+
+    manager.bulk_index(rollup.documents(), index_prefix=opensearch_handler.__rollup_index__)
+
+    assert len(cluster.bulk_calls) == 1
+    assert manager.field_budget.report()['paths_by_index'] == {}
+
+
+def test_throttled_item_is_retried_until_indexed(manager, cluster):
+    cluster.status = lambda doc, attempt: 429 if doc['@id'] == 'b' and attempt < 2 else 201
+
+    result = manager._bulk_index_single_batch(batch_of(manager, 'a', 'b', 'c'))
+
+    assert [[doc['@id'] for doc in call] for call in cluster.bulk_calls] == [['a', 'b', 'c'], ['b'], ['b']]
+    assert result['retried_items'] == 2
+    assert result['errors'] is False
+    assert result['failed_origins'] == set()
+
+
+def test_throttled_item_past_its_attempts_fails_its_record(manager, cluster):
+    manager.item_retry_attempts = 2
+    cluster.status = lambda doc, attempt: 429 if doc['@id'] == 'b' else 201
+
+    result = manager._bulk_index_single_batch(batch_of(manager, 'a', 'b'))
+
+    assert len(cluster.bulk_calls) == 2
+    assert result['failed_origins'] == {'seq-b'}
+    assert manager.spill_sink.writes == []
+
+
+def test_mapping_error_is_spilled_once_and_not_retried(manager, cluster):
+    cluster.status = lambda doc, attempt: 400 if doc['@id'] == 'b' else 201
+
+    result = manager._bulk_index_single_batch(batch_of(manager, 'a', 'b', 'c'))
+
+    assert len(cluster.bulk_calls) == 1
+    assert len(manager.spill_sink.writes) == 1
+    items, reason, metadata = manager.spill_sink.writes[0]
+    assert reason == 'rejected'
+    assert [json.loads(item.splitlines()[1])['@id'] for item in items] == ['b']
+    assert metadata['error-types'] == 'mapper_parsing_exception'
+    assert result['spilled_items'] == 1
+    assert result['failed_origins'] == set()
+
+
+def test_mapping_error_is_dropped_when_it_cannot_be_spilled(manager, cluster):
+    manager.spill_sink.available = False
+    cluster.status = lambda doc, attempt: 400 if doc['@id'] == 'b' else 201
+
+    result = manager._bulk_index_single_batch(batch_of(manager, 'a', 'b'))
+
+    assert result['dropped_items'] == 1
+    assert result['failed_origins'] == set()
+
+
+def test_gzip_body_decompresses_to_the_ndjson(manager, cluster):
+    manager.compression = 'gzip'
+    batch = batch_of(manager, 'a', 'b', 'c')
+
+    result = manager._bulk_index_single_batch(batch)
+
+    [(headers, wire)] = cluster.bulk_requests
+    assert headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(wire) == batch.body()
+    assert result['compression']['raw_bytes'] == batch.size
+    assert result['compression']['wire_bytes'] == len(wire)
+    assert result['errors'] is False
+
+
+def test_request_too_large_splits_the_batch(manager, cluster):
+    batch = batch_of(manager, 'a', 'b', 'c', 'd')
+    cluster.max_body_bytes = batch.size // 2
+
+    result = manager._bulk_index_single_batch(batch)
+
+    assert [[doc['@id'] for doc in call] for call in cluster.bulk_calls] == [['a', 'b'], ['c', 'd']]
+    assert result['splits'] == 1
+    assert result['errors'] is False
+
+
+def test_single_document_over_the_limit_is_spilled(manager, cluster):
+    batch = batch_of(manager, 'a', 'b')
+    cluster.max_body_bytes = batch.size // 2 - 1
+
+    result = manager._bulk_index_single_batch(batch)
+
+    assert cluster.bulk_calls == []
+    assert result['spilled_items'] == 2
+    assert manager.spill_sink.writes[0][2]['error-types'] == 'request_too_large'
+
+
+def stream_entries(count, fail_at=None):
+    for n in range(count):
+        if n == fail_at:
+            raise ValueError('source failed')
+        yield {'@id': f'doc-{n}', '@timestamp': '2025-01-29T03:04:05+00:00', 'message': 'x' * 50}, f'seq-{n}'
+
+
+def producers():
+    return [thread for thread in threading.enumerate() if thread.name == 'opensearch-prepare' and thread.is_alive()]
+
+
+def test_prefetched_batches_are_sent_in_the_order_they_are_cut(manager, cluster):
+    manager.max_batch_size = 3
+    manager.max_in_flight = 1
+    sent = {}
+    for prefetch in (0, 2):
+        manager.prefetch_batches = prefetch
+        cluster.bulk_calls = []
+
+        result = manager.index_stream(stream_entries(20))
+
+        sent[prefetch] = [[doc['@id'] for doc in call] for call in cluster.bulk_calls]
+        assert result['batch_summary']['indexed_documents'] == 20
+    assert sent[2] == sent[0]
+    assert len(sent[0]) == 7
+    assert producers() == []
+
+
+def test_exception_in_the_producer_is_raised_in_the_dispatcher(manager, cluster):
+    manager.max_batch_size = 3
+    manager.prefetch_batches = 2
+
+    with pytest.raises(ValueError, match='source failed'):
+        manager.index_stream(stream_entries(20, fail_at=10))
+
+    assert producers() == []
+
+
+def test_producer_stops_when_the_dispatcher_closes_the_stream(manager):
+    manager.prefetch_batches = 2
+    cut = []
+
+    def endless():
+        for n in itertools.count():
+            cut.append(n)
+            yield BulkBatch(f'logs-cloudtrail-{n}')
+    batches = manager._prefetch(endless(), {'producer_blocked_ms': 0, 'prepare_cpu_ms': 0})
+
+    assert next(batches).index_name == 'logs-cloudtrail-0'
+    batches.close()
+
+    assert producers() == []
+    # One handed over, prefetch_batches queued and one held by the blocked producer at most
+    assert len(cut) <= 1 + manager.prefetch_batches + 1
+
+
+def test_producer_stops_when_the_dispatcher_fails(manager, cluster, monkeypatch):
+    manager.max_batch_size = 1
+    manager.prefetch_batches = 2
+
+    def submit(function, *args):
+        raise RuntimeError('executor shut down')
+    monkeypatch.setattr(manager, '_submit_traced', submit)
+
+    with pytest.raises(RuntimeError, match='executor shut down'):
+        manager.index_stream(stream_entries(1000))
+
+    assert producers() == []
+
+
+def test_prefetched_batches_are_spilled_in_order_while_the_breaker_is_open(manager, cluster):
+    manager.max_batch_size = 2
+    manager.max_in_flight = 1
+    manager.breaker._open('test')
+    spilled = {}
+    for prefetch in (0, 2):
+        manager.prefetch_batches = prefetch
+        manager.spill_sink.writes = []
+
+        manager.index_stream(stream_entries(9))
+
+        spilled[prefetch] = [metadata['origin-first'] for _, _, metadata in manager.spill_sink.writes]
+    assert cluster.bulk_calls == []
+    assert spilled[2] == spilled[0] == ['seq-0', 'seq-2', 'seq-4', 'seq-6', 'seq-8']
+    assert producers() == []
+
+
+def kinesis_event(*payload_messages):
+    records = []
+    for number, messages in enumerate(payload_messages):
+        payload = {
+            'messageType': 'DATA_MESSAGE', 'owner': '123456789012',
+            'logGroup': '/aws/lambda/sbeacon-backend', 'logStream': '2025/01/29/[$LATEST]abc',
+            'logEvents': [{'id': f'{number}-{n}', 'timestamp': 1738119845000 + n, 'message': message}
+                          for n, message in enumerate(messages)]
+        }
+        records.append({'kinesis': {
+            'kinesisSchemaVersion': '1.0',
+            'sequenceNumber': f'4959{number:04d}',
+            'data': base64.b64encode(gzip.compress(json.dumps(payload).encode())).decode()
+        }})
+    return {'Records': records}
+
+
+def test_handler_reports_only_the_lowest_failed_sequence_number(manager, cluster):
+    manager.item_retry_attempts = 1
+    cluster.status = lambda doc, attempt: 429 if doc['@id'] in ('1-0', '3-1') else 201
+    event = kinesis_event(['{"a": 1}'], ['{"b": 1}'], ['{"c": 1}'], ['{"d": 1}', '{"e": 1}'])
+
+    response = handler(event, None)
+
+    assert response['batchItemFailures'] == [{'itemIdentifier': '49590001'}]
+
+
+def test_handler_reports_no_failures_when_everything_is_indexed(manager, cluster):
+    response = handler(kinesis_event(['{"a": 1}', '{"b": 2}']), None)
+
+    assert response['batchItemFailures'] == []
+    assert sum(len(call) for call in cluster.bulk_calls) == 2
+
+
+def test_handler_does_not_replay_records_rejected_for_mapping(manager, cluster):
+    cluster.status = lambda doc, attempt: 400 if doc['@id'] == '0-0' else 201
+
+    response = handler(kinesis_event(['{"a": 1}'], ['{"b": 1}']), None)
+
+    assert response['batchItemFailures'] == []
+    assert len(manager.spill_sink.writes) == 1
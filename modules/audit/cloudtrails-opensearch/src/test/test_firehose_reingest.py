@@ -0,0 +1,209 @@
+# test_firehose_reingest.py
+"""Firehose transform and re-ingest of the extra documents of a CloudWatch Logs payload
+
+boto3.client is replaced by a scripted stream client, so no AWS calls are made:
+
+    python3 -m pytest src/test/test_firehose_reingest.py
+"""
+import base64
+import gzip
+import json
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import boto3
+import pytest
+
+import opensearch_handler
+from conftest import FakeSpillSink
+from opensearch_handler import (
+    CloudWatchLogProcessor,
+    RateLimiter,
+    _firehose_budget_key,
+    _reingest_documents,
+    handler,
+    transform_firehose_records,
+)
+
+STREAM_ARN = 'arn:aws:kinesis:ap-southeast-3:123456789012:stream/cloudtrail'
+
+
+class FakeStream:
+    """Kinesis client whose put_records rejects entries chosen by `reject(call, data)`"""
+
+    def __init__(self, reject=lambda call, data: False, raise_calls=()):
+        self.reject = reject
+        self.raise_calls = set(raise_calls)
+        self.calls = []
+
+    def put_records(self, StreamARN, Records):
+        call = len(self.calls)
+        self.calls.append([record['Data'] for record in Records])
+        if call in self.raise_calls:
+            raise RuntimeError('stream unavailable')
+        return {'Records': [{'ErrorCode': 'ProvisionedThroughputExceededException'}
+                            if self.reject(call, record['Data']) else {'SequenceNumber': str(call)}
+                            for record in Records]}
+
+    def delivered(self):
+        rejected = [(call, data) for call, batch in enumerate(self.calls) for data in batch
+                    if call in self.raise_calls or self.reject(call, data)]
+        return [data for call, batch in enumerate(self.calls) for data in batch
+                if (call, data) not in rejected]
+
+
+@pytest.fixture
+def stream(monkeypatch):
+    monkeypatch.setattr(opensearch_handler.time, 'sleep', lambda seconds: None)
+
+    def install(fake):
+        monkeypatch.setattr(boto3, 'client', lambda service: fake)
+        return fake
+    return install
+
+
+def docs(record, count):
+    return [json.dumps({'@id': f'{record}-{n}', '@timestamp': '2025-01-29T03:04:05+00:00'}).encode()
+            for n in range(count)]
+
+
+def test_record_is_never_split_across_calls(stream, monkeypatch):
+    monkeypatch.setattr(opensearch_handler, 'FIREHOSE_REINGEST_BATCH_RECORDS', 5)
+    fake = stream(FakeStream())
+
+    failed = _reingest_documents({'sourceKinesisStreamArn': STREAM_ARN},
+                                 {'a': docs('a', 3), 'b': docs('b', 3), 'c': docs('c', 2)})
+
+    assert failed == set()
+    assert [len(call) for call in fake.calls] == [3, 5]
+    assert {json.loads(data)['@id'][0] for data in fake.calls[0]} == {'a'}
+
+
+def test_record_over_one_call_or_the_cap_is_not_reingested(stream, monkeypatch):
+    monkeypatch.setattr(opensearch_handler, 'FIREHOSE_REINGEST_BATCH_RECORDS', 4)
+    monkeypatch.setattr(opensearch_handler, 'FIREHOSE_REINGEST_MAX_DOCUMENTS', 6)
+    fake = stream(FakeStream())
+
+    failed = _reingest_documents({'sourceKinesisStreamArn': STREAM_ARN},
+                                 {'big': docs('big', 5), 'a': docs('a', 4), 'over-cap': docs('c', 3)})
+
+    assert failed == {'big', 'over-cap'}
+    assert fake.delivered() == docs('a', 4)
+
+
+def test_record_with_nothing_reingested_fails_whole(stream):
+    fake = stream(FakeStream(raise_calls=range(10)))
+
+    failed = _reingest_documents({'sourceKinesisStreamArn': STREAM_ARN}, {'a': docs('a', 3)})
+
+    assert failed == {'a'}
+    assert fake.delivered() == []
+
+
+def test_rejected_entries_are_retried(stream):
+    fake = stream(FakeStream(reject=lambda call, data: call == 0 and b'-1"' in data))
+
+    failed = _reingest_documents({'sourceKinesisStreamArn': STREAM_ARN}, {'a': docs('a', 3)})
+
+    assert failed == set()
+    assert sorted(fake.delivered()) == sorted(docs('a', 3))
+
+
+def test_partly_reingested_record_spills_the_rest_instead_of_failing(stream):
+    stream(FakeStream(reject=lambda call, data: b'-2"' in data))
+    spill = FakeSpillSink()
+
+    failed = _reingest_documents({'sourceKinesisStreamArn': STREAM_ARN}, {'a': docs('a', 3)}, spill)
+
+    assert failed == set()
+    items, reason, _ = spill.writes[0]
+    assert reason == 'reingest'
+    assert len(items) == 1
+    action, source = items[0].splitlines()
+    assert json.loads(action) == {'index': {'_index': 'logs-cloudtrail-2025.01.29', '_id': 'a-2'}}
+    assert json.loads(source)['@id'] == 'a-2'
+
+
+def test_partly_reingested_record_fails_when_spill_is_unavailable(stream):
+    stream(FakeStream(reject=lambda call, data: b'-2"' in data))
+
+    failed = _reingest_documents({'sourceKinesisStreamArn': STREAM_ARN}, {'a': docs('a', 3)},
+                                 FakeSpillSink(available=False))
+
+    assert failed == {'a'}
+
+
+def test_rate_limiter_paces_calls(monkeypatch):
+    clock = [100.0]
+    slept = []
+    monkeypatch.setattr(opensearch_handler.time, 'monotonic', lambda: clock[0])
+
+    def sleep(seconds):
+        slept.append(seconds)
+        clock[0] += seconds
+    monkeypatch.setattr(opensearch_handler.time, 'sleep', sleep)
+
+    limiter = RateLimiter(500)
+    limiter.acquire(500)
+    limiter.acquire(250)
+    limiter.acquire(1)
+
+    assert slept == [pytest.approx(1.0), pytest.approx(0.5)]
+
+
+def firehose_event(*messages):
+    payload = {
+        'messageType': 'DATA_MESSAGE', 'owner': '123456789012',
+        'logGroup': '/aws/lambda/sbeacon-backend', 'logStream': '2025/01/29/[$LATEST]abc',
+        'logEvents': [{'id': str(n), 'timestamp': 1738119845000 + n, 'message': message}
+                      for n, message in enumerate(messages)]
+    }
+    data = base64.b64encode(gzip.compress(json.dumps(payload).encode())).decode()
+    return {'sourceKinesisStreamArn': STREAM_ARN, 'records': [{'recordId': 'r1', 'data': data}]}
+
+
+def test_transform_returns_first_document_and_reingests_the_rest(stream):
+    fake = stream(FakeStream())
+    event = firehose_event('{"a": 1}', '{"b": 2}', '{"c": 3}')
+
+    output, count = transform_firehose_records(event, CloudWatchLogProcessor(), lambda doc: doc)
+
+    assert count == 3
+    assert output[0]['result'] == 'Ok'
+    assert json.loads(base64.b64decode(output[0]['data']))['a'] == 1
+    assert [json.loads(data)['@id'] for data in fake.delivered()] == ['1', '2']
+
+
+def test_transform_fails_record_when_reingest_fails(stream):
+    stream(FakeStream(raise_calls=range(10)))
+    event = firehose_event('{"a": 1}', '{"b": 2}')
+
+    output, _ = transform_firehose_records(event, CloudWatchLogProcessor(), lambda doc: doc)
+
+    assert output == [{'recordId': 'r1', 'result': 'ProcessingFailed', 'data': event['records'][0]['data']}]
+
+
+def test_firehose_budget_key_follows_the_weekly_rotation():
+    assert _firehose_budget_key(datetime(2025, 1, 29, 3, tzinfo=timezone.utc)) == 'logs-cloudtrail-2025-w05'
+    assert _firehose_budget_key(datetime(2025, 2, 2, 23, tzinfo=timezone(timedelta(hours=-2)))) == \
+        'logs-cloudtrail-2025-w06'
+
+
+def test_firehose_field_budget_is_kept_per_rotated_index(manager, stream):
+    stream(FakeStream())
+
+    context = SimpleNamespace(memory_limit_in_mb=512, get_remaining_time_in_millis=lambda: 60000)
+
+    handler(firehose_event('{"a": 1}'), context)
+
+    assert list(manager.field_budget._paths) == [_firehose_budget_key(datetime.now(timezone.utc))]
+
+
+def test_records_without_a_source_stream_fail_instead_of_reingesting(stream):
+    fake = stream(FakeStream())
+
+    failed = _reingest_documents({'deliveryStreamArn': 'arn:aws:firehose:ap-southeast-3:1:deliverystream/x'},
+                                 {'a': docs('a', 2)})
+
+    assert failed == {'a'}
+    assert fake.calls == []
@@ -0,0 +1,197 @@
+# test_flow_control.py
+"""Flow control of the bulk path: the AIMD request size controller and the circuit breaker
+that spills batches to S3 while the domain is failing
+
+    python3 -m pytest src/test/test_flow_control.py
+"""
+import opensearch_handler
+from opensearch_handler import AdaptiveBatchSize, CircuitBreaker
+
+MB = 1024 * 1024
+
+
+def controller(**kwargs):
+    settings = dict(initial_bytes=5 * MB, min_bytes=1 * MB, max_bytes=8 * MB, step_bytes=1 * MB,
+                    target_latency_ms=1000)
+    settings.update(kwargs)
+    return AdaptiveBatchSize(**settings)
+
+
+def test_setpoint_grows_additively_up_to_the_maximum():
+    aimd = controller()
+
+    assert [aimd.observe(200, took_ms=150) for _ in range(4)] == [6 * MB, 7 * MB, 8 * MB, 8 * MB]
+    assert aimd.increases == 4
+
+
+def test_setpoint_is_cut_multiplicatively_down_to_the_minimum():
+    aimd = controller()
+
+    assert aimd.observe(200, throttled=True) == int(2.5 * MB)
+    assert aimd.observe(1500) == int(1.25 * MB)
+    assert aimd.observe(0, failed=True) == 1 * MB
+    assert aimd.decreases == 3
+
+
+def test_slow_cluster_holds_the_setpoint():
+    aimd = controller()
+
+    # Round trip within target but the cluster's own took is over it: neither grow nor cut
+    assert aimd.observe(900, took_ms=1200) == 5 * MB
+
+
+def test_disabled_controller_stays_at_the_maximum():
+    aimd = controller(enabled=False)
+
+    assert aimd.observe(5000, throttled=True) == 8 * MB
+
+
+def test_throttled_bulk_response_shrinks_the_next_batches(manager, cluster):
+    cluster.status = lambda doc, attempt: 429 if doc['@id'] == 'b' and attempt == 0 else 201
+    before = manager.batch_controller.setpoint
+
+    manager.index_stream([({'@id': doc_id, '@timestamp': '2025-01-29T03:04:05+00:00'}, f'seq-{doc_id}')
+                          for doc_id in ('a', 'b')])
+
+    assert manager.batch_controller.setpoint == max(manager.batch_controller.min_bytes,
+                                                    int(before * manager.batch_controller.decrease_factor))
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def breaker(monkeypatch, health='green', threshold=3):
+    clock = Clock()
+    monkeypatch.setattr(opensearch_handler.time, 'monotonic', clock)
+    probes = []
+
+    def health_check():
+        # The probe must not hold the lock that batch outcomes are recorded under
+        assert not circuit._lock.locked()
+        probes.append(health)
+        return health
+    circuit = CircuitBreaker(threshold, 60, health_check)
+    return circuit, clock, probes
+
+
+def test_breaker_opens_after_consecutive_failures(monkeypatch):
+    circuit, _, probes = breaker(monkeypatch)
+
+    circuit.record_failure()
+    circuit.record_success()
+    for _ in range(3):
+        circuit.record_failure()
+
+    assert circuit.state == 'open'
+    assert not circuit.allow_request()
+    assert probes == ['green', 'green']
+
+
+def test_breaker_opens_on_first_failure_when_the_cluster_is_red(monkeypatch):
+    circuit, _, _ = breaker(monkeypatch, health='red')
+
+    circuit.record_failure()
+
+    assert circuit.state == 'open'
+
+
+def test_breaker_probes_after_cooldown_and_closes_on_success(monkeypatch):
+    circuit, clock, probes = breaker(monkeypatch)
+    for _ in range(3):
+        circuit.record_failure()
+    probes.clear()
+
+    clock.now += 59
+    assert not circuit.allow_request()
+    assert probes == []
+
+    clock.now += 1
+    assert circuit.allow_request()
+    assert circuit.state == 'half_open'
+    assert probes == ['green']
+
+    circuit.record_success()
+    assert circuit.state == 'closed'
+
+
+def test_breaker_stays_open_when_the_probe_finds_the_cluster_down(monkeypatch):
+    circuit, clock, _ = breaker(monkeypatch, health=None)
+    circuit._open('test')
+
+    clock.now += 60
+    assert not circuit.allow_request()
+    assert circuit.state == 'open'
+    assert circuit.opened_at == clock.now
+
+
+def test_failed_probe_batch_reopens_the_breaker(monkeypatch):
+    circuit, clock, _ = breaker(monkeypatch)
+    circuit._open('test')
+    clock.now += 60
+    circuit.allow_request()
+
+    circuit.record_failure()
+
+    assert circuit.state == 'open'
+
+
+def test_open_breaker_spills_batches_instead_of_sending_them(manager, cluster):
+    manager.breaker._open('test')
+
+    result = manager.index_stream([({'@id': doc_id, '@timestamp': '2025-01-29T03:04:05+00:00'}, f'seq-{doc_id}')
+                                   for doc_id in ('a', 'b')])
+
+    assert cluster.bulk_calls == []
+    [(items, reason, metadata)] = manager.spill_sink.writes
+    assert reason == 'breaker'
+    assert len(items) == 2
+    assert metadata['origin-first'] == 'seq-a' and metadata['origin-last'] == 'seq-b'
+    assert result['batch_summary']['breaker_spilled_batches'] == 1
+    assert result['failed_origins'] == set()
+
+
+def test_open_breaker_fails_records_when_the_spill_fails(manager, cluster):
+    manager.breaker._open('test')
+    manager.spill_sink.available = False
+
+    result = manager.index_stream([({'@id': 'a', '@timestamp': '2025-01-29T03:04:05+00:00'}, 'seq-a')])
+
+    assert cluster.bulk_calls == []
+    assert result['failed_origins'] == {'seq-a'}
+
+
+def test_half_open_breaker_admits_one_trial_batch(monkeypatch):
+    circuit, clock, _ = breaker(monkeypatch)
+    circuit._open('test')
+    clock.now += 60
+
+    assert circuit.allow_request()
+    assert circuit.trial_pending()
+    assert not circuit.allow_request()
+
+    circuit.record_success()
+    assert not circuit.trial_pending()
+    assert circuit.allow_request() and circuit.allow_request()
+
+
+def test_failed_trial_batch_spills_the_batches_held_behind_it(manager, cluster, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(opensearch_handler.time, 'monotonic', clock)
+    manager.max_batch_size = 1
+    manager.item_retry_attempts = 1
+    cluster.status = lambda doc, attempt: 429
+    manager.breaker._open('test')
+    clock.now += manager.breaker.reset_seconds
+
+    result = manager.index_stream([({'@id': doc_id, '@timestamp': '2025-01-29T03:04:05+00:00'}, f'seq-{doc_id}')
+                                   for doc_id in ('a', 'b', 'c')])
+
+    assert [[doc['@id'] for doc in call] for call in cluster.bulk_calls] == [['a']]
+    assert [reason for _, reason, _ in manager.spill_sink.writes] == ['breaker', 'breaker']
+    assert manager.breaker.state == 'open'
+    assert result['failed_origins'] == {'seq-a'}
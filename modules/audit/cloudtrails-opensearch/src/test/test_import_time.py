@@ -0,0 +1,95 @@
+# test_import_time.py
+"""Modules opensearch_handler loads on a cold start, and whether requirements.txt is current
+
+Runs a fresh interpreter under `-X importtime` that imports the handler and serves one Kinesis
+invocation against a stubbed OpenSearch session, and checks in the modules it reports that
+the ones only the S3 spill, Firehose re-ingest and parse workers use (LAZY_MODULES) were not
+loaded on the way. Also checks that requirements.txt still matches the handler's imports (see
+src/layer_manifest.py). How long the cold start takes is measured by bench_cold_start.py, not
+asserted here. Runs under pytest or directly:
+
+    python3 src/test/test_import_time.py
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, SRC_DIR)
+
+import layer_manifest  # noqa: E402
+
+# queue and uuid are imported lazily by the handler too, but botocore and requests load them
+LAZY_MODULES = ('boto3', 's3transfer', 'multiprocessing')
+
+# Child process: import the handler and serve one invocation, then report how long each took
+FIRST_INVOCATION = '''
+import json, sys, time
+started = time.perf_counter()
+import opensearch_handler
+imported = time.perf_counter()
+import base64, gzip, requests
+
+def request(session, method, url, data=None, **kwargs):
+    response = requests.Response()
+    response.url = url
+    response.status_code, body = 200, {}
+    if '_index_template' in url and method == 'GET':
+        response.status_code = 404
+    elif url.endswith('_bulk'):
+        body = {'took': 1, 'errors': False, 'items': [{'index': {'status': 201}} for _ in data.splitlines()[1::2]]}
+    response._content = json.dumps(body).encode()
+    return response
+
+requests.Session.request = request
+payload = {'messageType': 'DATA_MESSAGE', 'logGroup': '/aws/lambda/sbeacon-backend', 'logStream': 's',
+           'logEvents': [{'id': '1', 'timestamp': 1738119845000, 'message': '{"a": 1}'}]}
+data = base64.b64encode(gzip.compress(json.dumps(payload).encode())).decode()
+opensearch_handler.handler({'Records': [{'kinesis': {'kinesisSchemaVersion': '1.0', 'sequenceNumber': '1',
+                                                     'data': data}}]}, None)
+invoked = time.perf_counter()
+print(json.dumps({'import_ms': (imported - started) * 1000, 'invocation_ms': (invoked - imported) * 1000}),
+      file=sys.stderr)
+'''
+
+
+def first_invocation(*options):
+    """stderr lines of a fresh interpreter, started with options, running FIRST_INVOCATION"""
+    env = dict(os.environ, AWS_XRAY_SDK_ENABLED='false', AWS_XRAY_CONTEXT_MISSING='IGNORE_ERROR',
+               OPENSEARCH_DOMAIN_ENDPOINT='search.example.com', AWS_ACCESS_KEY_ID='AKIDEXAMPLE',
+               AWS_SECRET_ACCESS_KEY='secret')
+    result = subprocess.run([sys.executable, *options, '-c', FIRST_INVOCATION], cwd=SRC_DIR, env=env,
+                            capture_output=True, text=True, check=True)
+    return result.stderr.splitlines()
+
+
+def imported_modules(lines):
+    """Module names of the `import time: self | cumulative | module` lines of -X importtime"""
+    return {line.rsplit('|', 1)[1].strip() for line in lines
+            if line.startswith('import time:') and not line.endswith('imported package')}
+
+
+def test_sdks_load_lazily():
+    modules = imported_modules(first_invocation('-X', 'importtime'))
+
+    assert {'opensearch_handler', 'requests'} <= modules
+    loaded = sorted(name for name in modules if name.split('.')[0] in LAZY_MODULES)
+    assert not loaded, f"loaded by import and a plain Kinesis invocation: {', '.join(loaded)}"
+
+
+def test_layer_manifest_is_current():
+    try:
+        manifest = layer_manifest.build_manifest()
+    except SystemExit as e:
+        pytest.skip(str(e))
+    with open(layer_manifest.REQUIREMENTS) as f:
+        assert f.read() == '\n'.join(manifest) + '\n', \
+            "requirements.txt is out of date; run src/layer_manifest.py --write"
+
+
+if __name__ == "__main__":
+    test_sdks_load_lazily()
+    test_layer_manifest_is_current()
+    print("Import time tests passed")
@@ -0,0 +1,180 @@
+# test_log_processing.py
+"""CloudWatch Logs payloads to documents: record decoding and inflating, line classification,
+REPORT parsing and the correlation of Lambda lifecycle lines
+
+    python3 -m pytest src/test/test_log_processing.py
+"""
+import base64
+import gzip
+import json
+import math
+
+import pytest
+
+from opensearch_handler import (
+    TRACER,
+    CloudWatchLogProcessor,
+    correlate_invocations,
+    decode_record_data,
+    inflate_gzip,
+    process_kinesis_record,
+    transform_firehose_records,
+)
+
+REQUEST_ID = '6f1d3c4e-8b2a-4c1e-9f0a-1b2c3d4e5f60'
+
+
+def payload(*messages, log_group='/aws/lambda/sbeacon-backend', timestamp=1738119845000):
+    return {
+        'messageType': 'DATA_MESSAGE', 'owner': '123456789012',
+        'logGroup': log_group, 'logStream': '2025/01/29/[$LATEST]abc',
+        'logEvents': [{'id': str(n), 'timestamp': timestamp + n, 'message': message}
+                      for n, message in enumerate(messages)]
+    }
+
+
+def test_lines_are_classified():
+    documents = CloudWatchLogProcessor().process_payload(payload(
+        f"START RequestId: {REQUEST_ID} Version: $LATEST",
+        f"[INFO]\t2025-01-29T03:04:05.000Z\t{REQUEST_ID}\tResponse Body: {{\"status\": \"ok\", \"volumeSize\": 3}}",
+        f"END RequestId: {REQUEST_ID}",
+        "Running query on dataset",
+    ))
+
+    # Lines carrying JSON are parsed as JSON before any marker is looked at
+    assert [doc['event_type'] for doc in documents] == ['lambda_start', 'json', 'lambda_end']
+    assert documents[0]['request_id'] == REQUEST_ID
+    assert documents[1]['volumeSize'] == 3
+    assert documents[2]['request_id'] == REQUEST_ID
+
+
+def test_platform_markers_only_count_at_the_start_of_a_line():
+    documents = CloudWatchLogProcessor().process_payload(payload(
+        f"[INFO]\t2025-01-29T03:04:05.000Z\t{REQUEST_ID}\tretrying after END RequestId: {REQUEST_ID}",
+        f"END RequestId: {REQUEST_ID}",
+        "START RequestId:",
+    ))
+
+    assert [(doc['event_type'], doc['request_id']) for doc in documents] == [('lambda_end', REQUEST_ID)]
+
+
+def test_report_durations_do_not_overwrite_each_other():
+    report = (f"REPORT RequestId: {REQUEST_ID}\tDuration: 812.45 ms\tBilled Duration: 813 ms\t"
+              f"Memory Size: 2048 MB\tMax Memory Used: 190 MB\tInit Duration: 402.11 ms\t")
+
+    [doc] = CloudWatchLogProcessor().process_payload(payload(report))
+
+    assert doc['event_type'] == 'lambda_report'
+    assert doc['request_id'] == REQUEST_ID
+    assert doc['duration_ms'] == 812.45
+    assert doc['billed_duration_ms'] == 813
+    assert doc['memory_size_mb'] == 2048
+    assert doc['memory_used_mb'] == 190
+    assert doc['init_duration_ms'] == 402.11
+
+
+def test_report_fields_out_of_the_usual_order_are_still_parsed():
+    report = f"REPORT RequestId: {REQUEST_ID}\tMax Memory Used: 190 MB\tDuration: 5.00 ms\tBilled Duration: 6 ms"
+
+    assert CloudWatchLogProcessor.parse_report(report, 17) == {
+        'request_id': REQUEST_ID, 'memory_used_mb': 190, 'duration_ms': 5.0, 'billed_duration_ms': 6
+    }
+
+
+def test_kinesis_record_orjson_rejects_is_decoded_by_the_stdlib():
+    # A lone surrogate in the envelope and NaN in the message: orjson refuses both
+    message = '{"ratio": NaN, "name": "x\ud800"}'
+    data = gzip.compress(json.dumps({'messageType': 'DATA_MESSAGE', 'logGroup': '/aws/lambda/a', 'logEvents': [
+        {'id': '1', 'timestamp': 1738119845000, 'message': message}]}).encode())
+    record = {'kinesis': {'kinesisSchemaVersion': '1.0', 'sequenceNumber': '1',
+                          'data': base64.b64encode(data).decode()}}
+
+    [doc] = process_kinesis_record(record)
+
+    assert math.isnan(doc['ratio'])
+    assert doc['name'] == 'x\ud800'
+
+
+def outcome(decode, data):
+    """What a decode returns, or the type and message of what it raises"""
+    try:
+        return decode(data)
+    except Exception as e:
+        return type(e), str(e)
+
+
+MEMBERS = [gzip.compress(json.dumps(payload(f'{{"member": {n}}}')).encode()) for n in range(3)]
+
+
+@pytest.mark.parametrize('raw', [
+    MEMBERS[0] + MEMBERS[1] + MEMBERS[2],
+    MEMBERS[0] + b'\x00' * 7 + MEMBERS[1] + b'\x00',
+    MEMBERS[0] + b'not gzip',
+], ids=['members', 'zero-padded-members', 'trailing-garbage'])
+def test_multi_member_records_inflate_like_gzip_decompress(raw):
+    assert outcome(inflate_gzip, raw) == outcome(gzip.decompress, raw)
+
+
+@pytest.mark.parametrize('cut', [5, 20, -8, -4, -1])
+def test_truncated_records_fail_like_gzip_decompress(cut):
+    raw = (MEMBERS[0] + MEMBERS[1])[:cut]
+
+    assert outcome(inflate_gzip, raw) == outcome(gzip.decompress, raw)
+    assert outcome(inflate_gzip, raw)[0] is EOFError
+
+
+@pytest.mark.parametrize('data', ['abc', 'abcde', 'ab$c=', 'é', 'YQ==', b'\xff' + base64.b64encode(b'x')])
+def test_record_data_fails_like_b64decode(data):
+    # Kinesis and Firehose record data went through base64.b64decode before a2b_base64
+    assert outcome(decode_record_data, data) == outcome(base64.b64decode, data)
+
+
+def invocation_lines(request_id=REQUEST_ID):
+    prefix = f"[INFO]\t2025-01-29T03:04:05.000Z\t{request_id}\t"
+    return [
+        f"START RequestId: {request_id} Version: $LATEST",
+        prefix + 'Event Received: {"requestContext": {"accountId": "123456789012", "path": "/query"}}',
+        f"{prefix}Running query",
+        f"END RequestId: {request_id}",
+        f"REPORT RequestId: {request_id}\tDuration: 5.00 ms\tBilled Duration: 6 ms\t"
+        f"Memory Size: 2048 MB\tMax Memory Used: 190 MB\t",
+    ]
+
+
+def test_lifecycle_lines_of_a_request_merge_into_one_invocation():
+    documents = CloudWatchLogProcessor().process_payload(payload(*invocation_lines()))
+    origins = [f'seq-{n}' for n in range(len(documents))]
+
+    correlated, correlated_origins = correlate_invocations(documents, origins)
+
+    [invocation] = correlated
+    assert invocation['event_type'] == 'lambda_invocation'
+    assert invocation['request_id'] == REQUEST_ID
+    assert invocation['correlated_lines'] == 4
+    assert invocation['@id'] == documents[0]['@id']
+    assert invocation['@timestamp'] == documents[0]['@timestamp']
+    assert invocation['end_timestamp'] == documents[-1]['@timestamp']
+    assert invocation['event_data'] == {'requestContext': {'accountId': '123456789012', 'path': '/query'}}
+    assert invocation['duration_ms'] == 5.0
+    assert correlated_origins == ['seq-0']
+
+
+def test_request_without_its_report_keeps_its_documents():
+    documents = CloudWatchLogProcessor().process_payload(payload(*invocation_lines()[:-1]))
+
+    correlated, _ = correlate_invocations(documents)
+
+    assert correlated is documents
+
+
+def test_correlation_is_not_traced_per_document():
+    TRACER._timings = {}
+    event = {'records': [{'recordId': 'r1', 'data': base64.b64encode(
+        gzip.compress(json.dumps(payload('{"a": 1}')).encode())).decode()}]}
+    documents = CloudWatchLogProcessor().process_payload(payload(*invocation_lines()))
+
+    correlate_invocations(documents)
+    assert 'firehose_transform' not in TRACER.timings()
+
+    transform_firehose_records(event, CloudWatchLogProcessor(), lambda doc: doc)
+    assert TRACER.timings()['firehose_transform']['calls'] == 1
@@ -0,0 +1,66 @@
+# test_metric_rollup.py
+"""Per-minute REPORT metric rollups: the quantile sketch's error bound and merging partial rows
+
+    python3 -m pytest src/test/test_metric_rollup.py
+"""
+import random
+import statistics
+
+import pytest
+
+from opensearch_handler import ROLLUP_SKETCH_ACCURACY, MetricRollup, QuantileSketch
+
+
+def durations(count, seed=11):
+    rng = random.Random(seed)
+    return [rng.lognormvariate(5, 1.2) for _ in range(count)]
+
+
+def test_quantiles_are_within_the_relative_error():
+    # 10001 values: the inclusive cut points fall exactly on order statistics
+    values = durations(10001)
+    sketch = QuantileSketch()
+    for value in values:
+        sketch.add(value)
+
+    cuts = statistics.quantiles(values, n=100, method='inclusive')
+    for q, exact in ((0.5, cuts[49]), (0.9, cuts[89]), (0.99, cuts[98])):
+        assert sketch.quantile(q) == pytest.approx(exact, rel=ROLLUP_SKETCH_ACCURACY)
+
+
+def test_sketches_round_trip_and_merge_exactly():
+    values = durations(3000)
+    whole, left, right = QuantileSketch(), QuantileSketch(), QuantileSketch()
+    for n, value in enumerate(values):
+        whole.add(value)
+        (left if n % 3 else right).add(value)
+
+    merged = QuantileSketch.from_dict(left.to_dict())
+    merged.merge(QuantileSketch.from_dict(right.to_dict()))
+
+    assert merged.count == whole.count
+    assert merged.bins == whole.bins
+    assert [merged.quantile(q) for q in (0.5, 0.99)] == [whole.quantile(q) for q in (0.5, 0.99)]
+
+
+def report(n, duration):
+    return {'event_type': 'lambda_report', '@id': f'id-{n}', '@log_group': '/aws/lambda/a',
+            '@timestamp': f'2025-01-29T03:04:{n % 60:02d}+00:00', 'duration_ms': duration}
+
+
+def test_partial_rows_of_a_minute_merge_through_their_sketches():
+    values = durations(600)
+    invocations = [MetricRollup(), MetricRollup()]
+    for n, value in enumerate(values):
+        invocations[n < 200].add(report(n, value))
+
+    rows = [rollup.documents()[0]['rollup']['duration_ms'] for rollup in invocations]
+    merged = QuantileSketch.from_dict(rows[0]['sketch'])
+    merged.merge(QuantileSketch.from_dict(rows[1]['sketch']))
+
+    assert sum(row['count'] for row in rows) == len(values)
+    assert sum(row['sum'] for row in rows) == pytest.approx(sum(values))
+    assert min(row['min'] for row in rows) == min(values)
+    assert max(row['max'] for row in rows) == max(values)
+    exact = statistics.quantiles(values, n=100, method='inclusive')
+    assert merged.quantile(0.5) == pytest.approx(exact[49], rel=2 * ROLLUP_SKETCH_ACCURACY)
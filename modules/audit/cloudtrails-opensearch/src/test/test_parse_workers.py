@@ -0,0 +1,104 @@
+# test_parse_workers.py
+"""Kinesis record parsing on forked ParseWorkers sharing the parent's field budget, and when
+the container forks them again after a worker died
+
+    python3 -m pytest src/test/test_parse_workers.py
+"""
+import base64
+import gzip
+import json
+import threading
+
+import pytest
+
+import opensearch_handler
+from opensearch_handler import (
+    FLATTENED_FIELD,
+    FieldBudget,
+    ParseWorkers,
+    get_parse_workers,
+    stream_kinesis_documents,
+)
+
+INDEX = 'logs-cloudtrail-2025.01.29'
+
+
+def kinesis_records(count, fields):
+    records = []
+    for number in range(count):
+        message = json.dumps({f'field_{number}_{n}': n for n in range(fields)})
+        payload = {'messageType': 'DATA_MESSAGE', 'logGroup': '/aws/lambda/sbeacon-backend',
+                   'logStream': 'stream', 'logEvents': [{'id': str(number), 'timestamp': 1738119845000,
+                                                         'message': message}]}
+        records.append({'kinesis': {'kinesisSchemaVersion': '1.0', 'sequenceNumber': f'4959{number:04d}',
+                                    'data': base64.b64encode(gzip.compress(json.dumps(payload).encode())).decode()}})
+    return records
+
+
+@pytest.fixture
+def workers():
+    pool = ParseWorkers(2)
+    yield pool
+    pool.close()
+
+
+def test_workers_share_the_parent_field_budget(workers):
+    records = kinesis_records(8, 5)
+    # Room for the fields every document shares plus 10 of the 40 fields of their own
+    baseline = FieldBudget()
+    for doc, _ in stream_kinesis_documents(records[:1]):
+        baseline.apply(INDEX, doc)
+    limit = baseline.report()['paths_by_index'][INDEX] - 5 + 10
+    budget = FieldBudget(index_limit=limit)
+
+    items = list(workers.stream(records, field_budget=budget))
+
+    assert len(items) == 8
+    assert budget.report()['paths_by_index'] == {INDEX: limit}
+    docs = [json.loads(item.splitlines()[1]) for _, item, _ in items]
+    assert sum(key.startswith('field_') for doc in docs for key in doc) == 10
+    assert sum(len(doc.get(FLATTENED_FIELD, {})) for doc in docs) == 30
+
+
+@pytest.fixture
+def container_workers(monkeypatch):
+    """get_parse_workers() with two workers, starting from a container that has no pool yet"""
+    monkeypatch.setattr(opensearch_handler, 'PARSE_WORKERS', '2')
+    monkeypatch.setattr(opensearch_handler, '_parse_workers', None)
+    monkeypatch.setattr(opensearch_handler, '_parse_workers_held_back', False)
+    yield
+    if opensearch_handler._parse_workers is not None:
+        opensearch_handler._parse_workers.close()
+
+
+def kill_one(pool):
+    process, _ = pool._workers[0]
+    process.kill()
+    process.join()
+
+
+def test_dead_pool_is_restarted_from_a_single_threaded_process(container_workers):
+    pool = get_parse_workers()
+    kill_one(pool)
+
+    restarted = get_parse_workers()
+
+    assert restarted is not pool and restarted.alive()
+    assert len(list(restarted.stream(kinesis_records(4, 2)))) == 4
+
+
+def test_dead_pool_is_not_forked_again_while_other_threads_run(container_workers):
+    pool = get_parse_workers()
+    kill_one(pool)
+    release = threading.Event()
+    executor = threading.Thread(target=release.wait, name='bulk-executor')
+    executor.start()
+    try:
+        assert get_parse_workers() is None
+    finally:
+        release.set()
+        executor.join()
+
+    # Held back for the rest of the container, also once the thread is gone
+    assert get_parse_workers() is None
+    assert opensearch_handler._parse_workers is None